@@ -0,0 +1,43 @@
+"""Materialized idea post membership
+
+Revision ID: 1f4a9c2b7e30
+Revises: 4e7ced6a5406
+Create Date: 2026-10-18 14:40:12.518302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f4a9c2b7e30'
+down_revision = '4e7ced6a5406'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_post_membership',
+            sa.Column('idea_id', sa.Integer,
+                      sa.ForeignKey('idea.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      primary_key=True),
+            sa.Column('post_id', sa.Integer,
+                      sa.ForeignKey('post.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      primary_key=True, index=True))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    from assembl.models.idea_post_membership import \
+        rebuild_idea_post_membership
+    db = m.get_session_maker()()
+    with transaction.manager:
+        for (discussion_id,) in db.query(m.Discussion.id):
+            rebuild_idea_post_membership(db, discussion_id)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_post_membership')
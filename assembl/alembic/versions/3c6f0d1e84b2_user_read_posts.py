@@ -0,0 +1,45 @@
+"""Compact store of the posts read by each user
+
+Revision ID: 3c6f0d1e84b2
+Revises: 5b2d8e0c91af
+Create Date: 2026-10-18 17:32:09.842117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c6f0d1e84b2'
+down_revision = '5b2d8e0c91af'
+
+from alembic import context, op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+import transaction
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'user_read_posts',
+            sa.Column('discussion_id', sa.Integer,
+                      sa.ForeignKey('discussion.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      primary_key=True),
+            sa.Column('user_id', sa.Integer,
+                      sa.ForeignKey('agent_profile.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      primary_key=True, index=True),
+            sa.Column('post_ids', ARRAY(sa.Integer), nullable=False,
+                      server_default='{}'))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    from assembl.models.read_posts import rebuild_read_posts
+    db = m.get_session_maker()()
+    with transaction.manager:
+        for (discussion_id,) in db.query(m.Discussion.id):
+            rebuild_read_posts(db, discussion_id)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('user_read_posts')
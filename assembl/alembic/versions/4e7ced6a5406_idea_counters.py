@@ -0,0 +1,48 @@
+"""Persistent idea post counters
+
+Revision ID: 4e7ced6a5406
+Revises: 33735b0850fc
+Create Date: 2026-10-18 10:12:31.204519
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e7ced6a5406'
+down_revision = '33735b0850fc'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_counters',
+            sa.Column('idea_id', sa.Integer,
+                      sa.ForeignKey('idea.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      primary_key=True),
+            sa.Column('discussion_id', sa.Integer,
+                      sa.ForeignKey('discussion.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      nullable=False, index=True),
+            sa.Column('num_posts', sa.Integer, nullable=False),
+            sa.Column('num_contributors', sa.Integer, nullable=False))
+        op.create_table(
+            'idea_user_counters',
+            sa.Column('idea_id', sa.Integer,
+                      sa.ForeignKey('idea_counters.idea_id',
+                                    ondelete='CASCADE', onupdate='CASCADE'),
+                      primary_key=True),
+            sa.Column('user_id', sa.Integer,
+                      sa.ForeignKey('agent_profile.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      primary_key=True, index=True),
+            sa.Column('num_posts', sa.Integer, nullable=False),
+            sa.Column('num_read_posts', sa.Integer, nullable=False))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_user_counters')
+        op.drop_table('idea_counters')
@@ -0,0 +1,43 @@
+"""Transitive closure of the idea hierarchy
+
+Revision ID: 5b2d8e0c91af
+Revises: 1f4a9c2b7e30
+Create Date: 2026-10-18 16:05:47.301226
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b2d8e0c91af'
+down_revision = '1f4a9c2b7e30'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_closure',
+            sa.Column('ancestor_id', sa.Integer,
+                      sa.ForeignKey('idea.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      primary_key=True),
+            sa.Column('descendant_id', sa.Integer,
+                      sa.ForeignKey('idea.id', ondelete='CASCADE',
+                                    onupdate='CASCADE'),
+                      primary_key=True, index=True),
+            sa.Column('depth', sa.Integer, nullable=False))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    from assembl.models.idea_closure import rebuild_idea_closure
+    db = m.get_session_maker()()
+    with transaction.manager:
+        for (discussion_id,) in db.query(m.Discussion.id):
+            rebuild_idea_closure(db, discussion_id)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_closure')
@@ -0,0 +1,27 @@
+"""Fill the idea counters of existing discussions
+
+Revision ID: 7d3e5a1c9b42
+Revises: 3c6f0d1e84b2
+Create Date: 2026-10-18 21:04:51.377120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d3e5a1c9b42'
+down_revision = '3c6f0d1e84b2'
+
+import transaction
+
+
+def upgrade(pyramid_env):
+    # The counters are not computed when read anymore
+    from assembl import models as m
+    from assembl.models.idea_counters import rebuild_idea_counts
+    db = m.get_session_maker()()
+    with transaction.manager:
+        for (discussion_id,) in db.query(m.Discussion.id):
+            rebuild_idea_counts(db, discussion_id)
+
+
+def downgrade(pyramid_env):
+    pass
@@ -1,8 +1,13 @@
 """Sundry utility functions having to do with users or permissions"""
 from csv import reader
+from collections import defaultdict, OrderedDict
 from datetime import datetime, timedelta
+from itertools import chain
+from time import time
 import base64
 
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
 from sqlalchemy.sql.expression import and_
 from pyramid.security import (Everyone, Authenticated, forget)
 from pyramid.httpexceptions import HTTPNotFound
@@ -12,6 +17,8 @@ from pyramid.threadlocal import get_current_request
 import transaction
 
 from assembl.lib.locale import _
+from ..lib.caching import create_version_stamps
+from ..lib.config import get_config
 from ..lib.sqla import get_session_maker, mark_changed
 from . import R_SYSADMIN, P_READ, SYSTEM_ROLES
 from .password import verify_data_token, Validity
@@ -49,59 +56,180 @@ def get_user(request):
         return User.get(logged_in)
 
 
+# Any change to roles or permission names
+ALL_PERMISSIONS = ('all',)
+
+
+class PermissionCache(object):
+    """Process-wide cache of what permissions depend on: the role to
+    permissions matrix of each discussion (('discussion', id)), the roles
+    of each user, global and local (('user', id)), and the permission names
+    (ALL_PERMISSIONS).
+
+    As for the discussion structure cache, each key has a version,
+    incremented when a transaction that changed it is committed; entries
+    of an older version are reloaded. The versions are kept in redis if
+    ``structure_cache_redis`` is set, so that all processes see the
+    changes. Sessions with uncommitted changes bypass the cache, and so
+    does everyone while an increment of a version is failing.
+    Entries are also reloaded after ``permission_cache_seconds``, whatever
+    their version, in case a change of another process was missed.
+    Cached values must not be modified."""
+
+    max_entries = 10000
+
+    def __init__(self):
+        self._versions = None
+        self._max_age = None
+        self.entries = OrderedDict()
+
+    @property
+    def max_age(self):
+        if self._max_age is None:
+            self._max_age = float(
+                get_config().get('permission_cache_seconds', 300))
+        return self._max_age
+
+    @property
+    def versions(self):
+        if self._versions is None:
+            self._versions = create_version_stamps('assembl:permissions:')
+        return self._versions
+
+    def get(self, db, key, loader):
+        changes = db.info.get('permission_changes', ())
+        if key in changes or ALL_PERMISSIONS in changes or \
+                _unflushed_changes(db):
+            return loader()
+        # Read the version before loading, so concurrent changes
+        # leave the entry outdated.
+        version = self.versions.get_many([key, ALL_PERMISSIONS])
+        now = time()
+        entry = self.entries.get(key)
+        if entry is not None and version is not None and \
+                entry[0] == version and now - entry[2] < self.max_age:
+            return entry[1]
+        value = loader()
+        if version is not None:
+            self.entries[key] = (version, value, now)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        self.versions.incr(key)
+
+    def invalidate_on_commit(self, target, key):
+        session = inspect(target).session
+        if session is not None:
+            session.info.setdefault('permission_changes', set()).add(key)
+        req = get_current_request()
+        if req is not None:
+            req.permissions_memo = {}
+
+
+permission_cache = PermissionCache()
+
+
+def _unflushed_changes(db):
+    return any(isinstance(instance, permission_classes)
+               for instance in chain(db.new, db.dirty, db.deleted))
+
+
+def _load_role_permissions(db, discussion_id):
+    role_permissions = defaultdict(set)
+    for (role, permission) in db.query(Role.name, Permission.name
+            ).select_from(DiscussionPermission).join(Role, Permission
+            ).filter(DiscussionPermission.discussion_id == discussion_id):
+        role_permissions[role].add(permission)
+    return {role: frozenset(permissions)
+            for (role, permissions) in role_permissions.iteritems()}
+
+
+def _load_user_roles(db, user_id):
+    global_roles = frozenset(role for (role,) in db.query(Role.name).join(
+        UserRole).filter(UserRole.user_id == user_id))
+    local_roles = defaultdict(set)
+    for (discussion_id, role) in db.query(
+            LocalUserRole.discussion_id, Role.name).join(Role).filter(
+            LocalUserRole.user_id == user_id,
+            LocalUserRole.requested == False):  # noqa: E712
+        local_roles[discussion_id].add(role)
+    return (global_roles, {
+        discussion_id: frozenset(roles)
+        for (discussion_id, roles) in local_roles.iteritems()})
+
+
+def get_role_permissions(discussion_id):
+    """dictionary role name -> frozenset of permission names, in this
+    discussion. Cached across requests; do not modify it."""
+    db = get_session_maker()()
+    return permission_cache.get(
+        db, ('discussion', discussion_id),
+        lambda: _load_role_permissions(db, discussion_id))
+
+
+def _all_permissions(db):
+    return permission_cache.get(
+        db, ALL_PERMISSIONS,
+        lambda: frozenset(name for (name,) in db.query(Permission.name)))
+
+
+def _user_roles(db, user_id, discussion_id):
+    (global_roles, local_roles) = permission_cache.get(
+        db, ('user', user_id), lambda: _load_user_roles(db, user_id))
+    return global_roles.union(local_roles.get(discussion_id, ()))
+
+
+def _memoized(key, compute):
+    # The request memo is dropped when roles or permissions change
+    req = get_current_request()
+    if req is None or _unflushed_changes(get_session_maker()()):
+        return compute()
+    memo = getattr(req, 'permissions_memo', None)
+    if memo is None:
+        memo = req.permissions_memo = {}
+    if key not in memo:
+        memo[key] = compute()
+    return memo[key]
+
+
 def get_roles(user_id, discussion_id=None):
     if user_id in SYSTEM_ROLES:
         return [user_id]
-    session = get_session_maker()()
-    roles = session.query(Role.name).join(UserRole).filter(
-        UserRole.user_id == user_id)
-    if discussion_id:
-        roles = roles.union(
-            session.query(Role.name).join(
-                LocalUserRole).filter(and_(
-                    LocalUserRole.user_id == user_id,
-                    LocalUserRole.requested == False,  # noqa: E712
-                    LocalUserRole.discussion_id == discussion_id)))
-    return [x[0] for x in roles.distinct()]
+    return list(_memoized(
+        ('roles', user_id, discussion_id),
+        lambda: _user_roles(
+            get_session_maker()(), user_id, discussion_id or None)))
+
+
+def _compute_permissions(user_id, discussion_id):
+    db = get_session_maker()()
+    if user_id not in SYSTEM_ROLES:
+        roles = _user_roles(db, user_id, discussion_id)
+        if R_SYSADMIN in roles:
+            return _all_permissions(db)
+        roles = roles.union((Authenticated, Everyone))
+    elif user_id == Authenticated:
+        roles = (Authenticated, Everyone)
+    else:
+        roles = (user_id,)
+    if not discussion_id:
+        return frozenset()
+    role_permissions = get_role_permissions(discussion_id)
+    return frozenset().union(*(
+        role_permissions.get(role, ()) for role in roles))
 
 
-def get_permissions(user_id, discussion_id):
+def _permissions(user_id, discussion_id):
     user_id = user_id or Everyone
-    session = get_session_maker()()
-    if user_id == Everyone:
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role).filter(
-                (DiscussionPermission.discussion_id == discussion_id) & (Role.name == user_id))
-    elif user_id == Authenticated:
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role).filter(
-                (DiscussionPermission.discussion_id == discussion_id) & (Role.name.in_((Authenticated, Everyone))))
-    else:
-        sysadmin = session.query(UserRole).filter_by(
-            user_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-        if sysadmin:
-            return [x[0] for x in session.query(Permission.name).all()]
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role, UserRole).filter(
-                UserRole.user_id == user_id,
-                DiscussionPermission.discussion_id == discussion_id
-            ).union(session.query(Permission.name).join(
-                DiscussionPermission, Role, LocalUserRole).filter(and_(
-                    LocalUserRole.user_id == user_id,
-                    LocalUserRole.requested == False,  # noqa: E712
-                    LocalUserRole.discussion_id == discussion_id,
-                    DiscussionPermission.discussion_id == discussion_id))
-            ).union(session.query(Permission.name).join(
-                DiscussionPermission, Role).filter(and_(
-                    DiscussionPermission.discussion_id == discussion_id,
-                    Role.name.in_((Authenticated, Everyone)))))
-    return [x[0] for x in permissions.distinct()]
+    return _memoized(
+        ('permissions', user_id, discussion_id),
+        lambda: _compute_permissions(user_id, discussion_id))
+
+
+def get_permissions(user_id, discussion_id):
+    return list(_permissions(user_id, discussion_id))
 
 
 def find_discussion_from_slug(slug):
@@ -320,51 +448,11 @@ def roles_with_permissions(discussion, *permissions):
 
 
 def user_has_permission(discussion_id, user_id, permission):
-    from ..models import Discussion
     # assume all ids valid
     user_id = user_id or Everyone
-    db = Discussion.default_db
-    if user_id == Everyone:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name == user_id).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    elif user_id == Authenticated:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    sysadmin = db.query(UserRole).filter_by(
-        user_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-    if sysadmin:
+    if user_id not in SYSTEM_ROLES and R_SYSADMIN in get_roles(user_id):
         return True
-    permission = db.query(DiscussionPermission).join(
-            Permission, Role, UserRole).filter(
-            DiscussionPermission.discussion_id == discussion_id).filter(
-                UserRole.user_id == user_id).filter(
-                    Permission.name == permission
-                ).union(
-                    db.query(DiscussionPermission
-                        ).join(Permission, Role, LocalUserRole).filter(and_(
-                            # Virtuoso disregards this explicit condition
-                            DiscussionPermission.discussion_id == discussion_id,
-                            # So I have to add this one as well.
-                            LocalUserRole.discussion_id == discussion_id,
-                            LocalUserRole.user_id == user_id,
-                            LocalUserRole.requested == False,  # noqa: E712
-                            Permission.name == permission))
-                ).union(
-                    db.query(DiscussionPermission).join(
-                        Permission, Role).filter(
-                        DiscussionPermission.discussion_id == discussion_id).filter(
-                        Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission)
-                ).first()
-    return permission is not None
+    return permission in _permissions(user_id, discussion_id)
 
 
 def users_with_permission(discussion_id, permission, id_only=True):
@@ -601,3 +689,56 @@ def add_multiple_users_csv(
             sender_name=sender_name, message_subject=message_subject,
             request=request)
     return i
+
+
+# Changes are noted during the flush, and the cached versions are
+# incremented when the transaction is committed.
+
+permission_classes = (
+    UserRole, LocalUserRole, DiscussionPermission, Role, Permission)
+
+
+def _permissions_after_commit(session):
+    for key in session.info.pop('permission_changes', ()):
+        permission_cache.invalidate(key)
+
+
+def _permissions_after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('permission_changes', None)
+
+
+def _user_ids(target):
+    history = inspect(target).attrs['user_id'].history
+    return set(chain(history.deleted or (), (target.user_id,)))
+
+
+def _user_role_changed(mapper, connection, target):
+    for user_id in _user_ids(target):
+        permission_cache.invalidate_on_commit(target, ('user', user_id))
+
+
+def _discussion_permission_changed(mapper, connection, target):
+    discussion_ids = set(chain(
+        inspect(target).attrs['discussion_id'].history.deleted or (),
+        (target.discussion_id,)))
+    for discussion_id in discussion_ids:
+        permission_cache.invalidate_on_commit(
+            target, ('discussion', discussion_id))
+
+
+def _role_changed(mapper, connection, target):
+    permission_cache.invalidate_on_commit(target, ALL_PERMISSIONS)
+
+
+event.listen(Session, 'after_commit', _permissions_after_commit)
+event.listen(
+    Session, 'after_transaction_end', _permissions_after_transaction_end)
+for _cls, _listener in (
+        (UserRole, _user_role_changed),
+        (LocalUserRole, _user_role_changed),
+        (DiscussionPermission, _discussion_permission_changed),
+        (Role, _role_changed),
+        (Permission, _role_changed)):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_cls, _event, _listener, propagate=True)
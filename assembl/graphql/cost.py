@@ -0,0 +1,204 @@
+"""Static cost of GraphQL queries, estimated before their execution.
+
+Each field has a weight: 1 for objects, 0 for scalars, unless given in
+``FIELD_WEIGHTS``. The cost of the fields selected under a list is
+multiplied by ``LIST_SIZE``, and under a connection by its ``first`` or
+``last`` argument, or ``CONNECTION_SIZE`` if the connection is not
+paginated.
+
+Queries which cost more, or are deeper, than the limits of the roles of the
+user in the discussion are rejected."""
+from graphql.error import GraphQLError
+from graphql.execution.base import get_field_def
+from graphql.language import ast
+from graphql.type.definition import (
+    GraphQLInterfaceType, GraphQLList, GraphQLNonNull, GraphQLObjectType,
+    GraphQLUnionType, get_named_type)
+from pyramid.security import Authenticated, Everyone
+
+from assembl.auth import R_SYSADMIN
+from assembl.auth.util import get_roles
+from assembl.lib.config import get_config
+from assembl.lib.logging import getLogger
+
+
+LIST_SIZE = 10
+CONNECTION_SIZE = 100
+
+# Scalar fields which need their own queries
+FIELD_WEIGHTS = {
+    'Idea.numChildren': 2,
+    'Idea.numContributors': 2,
+    'Idea.numPosts': 2,
+    'Idea.numTotalPosts': 2,
+    'Idea.numVotes': 2,
+    'Idea.totalSentiments': 2,
+    'IdeaMessageColumn.numPosts': 2,
+    'Question.numContributors': 2,
+    'Question.numPosts': 2,
+    'Question.totalSentiments': 2,
+    'Query.numParticipants': 2,
+    'Query.totalSentiments': 2,
+    'VoteSession.numParticipants': 2,
+}
+
+
+def is_connection(graphql_type):
+    return isinstance(graphql_type, GraphQLObjectType) and \
+        graphql_type.name.endswith('Connection') and \
+        'edges' in graphql_type.fields
+
+
+class CostEstimator(object):
+    """The cost and depth of an operation of a validated document."""
+
+    def __init__(self, schema, document, variables=None, weights=None):
+        self.schema = schema
+        self.variables = variables or {}
+        self.weights = FIELD_WEIGHTS if weights is None else weights
+        self.operations = {}
+        self.operation_name = None
+        self.fragments = {}
+        for definition in document.definitions:
+            if isinstance(definition, ast.OperationDefinition):
+                name = definition.name.value if definition.name else None
+                self.operations[name] = definition
+            elif isinstance(definition, ast.FragmentDefinition):
+                self.fragments[definition.name.value] = definition
+
+    def estimate(self, operation_name=None):
+        "The (cost, depth) of the operation"
+        if operation_name is None and len(self.operations) == 1:
+            operation = self.operations.values()[0]
+        else:
+            operation = self.operations.get(operation_name, None)
+        if operation is None:
+            # execution will fail on its own
+            return (0, 0)
+        if operation.name is not None:
+            self.operation_name = operation.name.value
+        if operation.operation == 'mutation':
+            root_type = self.schema.get_mutation_type()
+        elif operation.operation == 'subscription':
+            root_type = self.schema.get_subscription_type()
+        else:
+            root_type = self.schema.get_query_type()
+        return self.selection_cost(root_type, operation.selection_set)
+
+    def argument(self, field, name):
+        for argument in field.arguments or ():
+            if argument.name.value == name:
+                value = argument.value
+                if isinstance(value, ast.Variable):
+                    return self.variables.get(value.name.value, None)
+                if isinstance(value, ast.IntValue):
+                    return int(value.value)
+                if isinstance(value, ast.BooleanValue):
+                    return value.value
+        return None
+
+    def is_skipped(self, selection):
+        for directive in selection.directives or ():
+            name = directive.name.value
+            if name in ('skip', 'include'):
+                condition = bool(self.argument(directive, 'if'))
+                if condition == (name == 'skip'):
+                    return True
+        return False
+
+    def multiplier(self, parent_type, field, field_type):
+        if isinstance(field_type, GraphQLNonNull):
+            field_type = field_type.of_type
+        if isinstance(field_type, GraphQLList):
+            # the size of edges is counted on the connection
+            if is_connection(parent_type) and field.name.value == 'edges':
+                return 1
+            return LIST_SIZE
+        if is_connection(field_type):
+            size = self.argument(field, 'first') or \
+                self.argument(field, 'last')
+            return size if size and size > 0 else CONNECTION_SIZE
+        return 1
+
+    def selection_cost(self, parent_type, selection_set):
+        "The (cost, depth) of a selection set on an object of parent_type"
+        cost = depth = 0
+        for selection in selection_set.selections:
+            if self.is_skipped(selection):
+                continue
+            if isinstance(selection, ast.Field):
+                field_def = get_field_def(
+                    self.schema, parent_type, selection.name.value)
+                if field_def is None:
+                    continue
+                field_type = get_named_type(field_def.type)
+                is_object = isinstance(field_type, (
+                    GraphQLObjectType, GraphQLInterfaceType, GraphQLUnionType))
+                cost += self.weights.get("%s.%s" % (
+                    parent_type.name, selection.name.value), int(is_object))
+                field_depth = 1
+                if selection.selection_set is not None:
+                    (sub_cost, sub_depth) = self.selection_cost(
+                        field_type, selection.selection_set)
+                    cost += sub_cost * self.multiplier(
+                        parent_type, selection, field_def.type)
+                    field_depth += sub_depth
+                depth = max(depth, field_depth)
+                continue
+            if isinstance(selection, ast.FragmentSpread):
+                # validation rules out fragment cycles
+                fragment = self.fragments.get(selection.name.value, None)
+                if fragment is None:
+                    continue
+            else:
+                fragment = selection
+            fragment_type = parent_type
+            if fragment.type_condition is not None:
+                fragment_type = self.schema.get_type(
+                    fragment.type_condition.name.value) or parent_type
+            (sub_cost, sub_depth) = self.selection_cost(
+                fragment_type, fragment.selection_set)
+            cost += sub_cost
+            depth = max(depth, sub_depth)
+        return (cost, depth)
+
+
+def get_cost_limits(discussion, user_id):
+    """The (max_cost, max_depth) of the queries of a user in a discussion.
+    The ``graphql_max_cost`` and ``graphql_max_depth`` preferences give
+    them by role, and the most generous role of the user wins; the limits
+    default to the settings of the same name. 0 or None means no limit."""
+    roles = set(get_roles(user_id, discussion.id))
+    if user_id != Everyone:
+        roles.update((Authenticated, Everyone))
+    config = get_config()
+    limits = []
+    for name in ('graphql_max_cost', 'graphql_max_depth'):
+        by_role = discussion.preferences[name] or {}
+        values = [by_role[role] for role in roles if role in by_role]
+        if values:
+            limit = 0 if 0 in values else max(values)
+        elif R_SYSADMIN in roles:
+            limit = 0
+        else:
+            limit = int(config.get(name, 0) or 0)
+        limits.append(limit if limit > 0 else None)
+    return tuple(limits)
+
+
+def check_cost(schema, document, variables, operation_name, limits):
+    """Log the (cost, depth) of an operation, and return them;
+    raise a GraphQLError if it is over the limits."""
+    (max_cost, max_depth) = limits
+    estimator = CostEstimator(schema, document, variables)
+    (cost, depth) = estimator.estimate(operation_name)
+    getLogger().info(
+        'graphql_cost', opname=operation_name or estimator.operation_name,
+        cost=cost, depth=depth, max_cost=max_cost, max_depth=max_depth)
+    if max_depth is not None and depth > max_depth:
+        raise GraphQLError(
+            "Query depth %d is over the limit of %d" % (depth, max_depth))
+    if max_cost is not None and cost > max_cost:
+        raise GraphQLError(
+            "Query cost %d is over the limit of %d" % (cost, max_cost))
+    return (cost, depth)
@@ -0,0 +1,156 @@
+"""Parsed and validated GraphQL documents, and persisted queries.
+
+Parsing and validating a query against the schema is costly, and the front
+end sends the same few operations again and again, so documents are kept
+in a LRU cache keyed by the hash of the query.
+
+With persisted queries, the client sends the hash of a query of the
+registry written by ``assembl-graphql-schema-json --persisted-queries``
+instead of its text, as ``id`` or as the ``persistedQuery`` extension."""
+import io
+import os
+import re
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+import simplejson as json
+from graphql.error import GraphQLError, GraphQLSyntaxError
+from graphql.language.parser import parse
+from graphql.language.source import Source
+from graphql.validation import validate
+
+from assembl.lib.config import get_config
+
+
+def query_hash(query):
+    "The hash of a query text, which identifies its document"
+    if isinstance(query, unicode):
+        query = query.encode('utf-8')
+    return sha256(query).hexdigest()
+
+
+class DocumentCache(object):
+    """Parsed documents with their validation errors, by query hash,
+    dropping the least recently used ones."""
+
+    def __init__(self, schema, max_entries=500):
+        self.schema = schema
+        self.max_entries = max_entries
+        self.documents = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, query, key=None):
+        """The document of a query, and the list of its errors.
+        The key is the hash of the query, if already known."""
+        key = key or query_hash(query)
+        with self.lock:
+            entry = self.documents.pop(key, None)
+            if entry is not None:
+                self.documents[key] = entry
+                return entry
+        try:
+            document = parse(Source(query, 'GraphQL request'))
+        except GraphQLSyntaxError as e:
+            # Not worth keeping
+            return (None, [e])
+        entry = (document, validate(self.schema, document))
+        with self.lock:
+            self.documents[key] = entry
+            while len(self.documents) > self.max_entries:
+                self.documents.popitem(False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+
+
+IMPORT_RE = re.compile(r'^#import\s+"([^"]+)"', re.MULTILINE)
+
+
+def _with_imports(path, included):
+    with io.open(path, encoding='utf-8') as f:
+        text = f.read()
+    imports = []
+    for import_path in IMPORT_RE.findall(text):
+        import_path = os.path.normpath(os.path.join(
+            os.path.dirname(path), import_path))
+        if import_path not in included:
+            included.add(import_path)
+            imports.append(_with_imports(import_path, included))
+    return IMPORT_RE.sub(u'', text).lstrip() + u''.join(imports)
+
+
+def build_registry(graphql_dir):
+    """The persisted queries of the operations of the front end, by hash.
+    The fragments imported by an operation are put after it, once, so that
+    the query still starts with the operation."""
+    registry = {}
+    for (dirpath, dirnames, filenames) in os.walk(graphql_dir):
+        if os.path.basename(dirpath) == 'fragments':
+            continue
+        for filename in sorted(filenames):
+            if filename.endswith('.graphql'):
+                query = _with_imports(os.path.join(dirpath, filename), set())
+                registry[query_hash(query)] = query
+    return registry
+
+
+def write_registry(graphql_dir, output):
+    registry = build_registry(graphql_dir)
+    with open(output, 'w') as outfile:
+        json.dump(registry, outfile, indent=2, sort_keys=True)
+    return registry
+
+
+def load_registry(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+_document_cache = None
+_registry = None
+
+
+def get_document_cache():
+    "The document cache of the GraphQL schema"
+    global _document_cache
+    if _document_cache is None:
+        from assembl.graphql.schema import Schema
+        _document_cache = DocumentCache(Schema, int(
+            get_config().get('graphql_document_cache_size', 500)))
+    return _document_cache
+
+
+def get_registry():
+    """The persisted queries by hash, from the ``graphql_persisted_queries``
+    file; empty if it is not set."""
+    global _registry
+    if _registry is None:
+        path = get_config().get('graphql_persisted_queries', None)
+        _registry = load_registry(path) if path else {}
+    return _registry
+
+
+def get_query(params, persisted_only=False):
+    """The query text and hash of the parameters of a GraphQL request.
+    The query may be given by hash, if it is a persisted query.
+    Raises a PersistedQueryNotFound error if there is no query of that
+    hash, and a PersistedQueryNotSupported one for other queries if
+    persisted_only."""
+    query = params.get('query', None)
+    key = params.get('id', None)
+    extensions = params.get('extensions', None)
+    if not key and isinstance(extensions, dict):
+        key = (extensions.get('persistedQuery', None) or {}).get(
+            'sha256Hash', None)
+    if key:
+        persisted = get_registry().get(key, None)
+        if persisted is not None:
+            return (persisted, key)
+        if not query or query_hash(query) != key:
+            raise GraphQLError('PersistedQueryNotFound')
+    if persisted_only:
+        raise GraphQLError('PersistedQueryNotSupported')
+    return (query, key or (query_hash(query) if query else None))
@@ -26,6 +26,7 @@ from .langstring import (LangStringEntry, LangStringEntryInput,
                          langstring_from_input_entries, resolve_langstring,
                          resolve_langstring_entries,
                          update_langstring_from_input_entries)
+from .loaders import load_langstring
 from .permissions_helpers import require_cls_permission, require_instance_permission
 from .types import SecureObjectType, SQLAlchemyUnion
 from .user import AgentProfile
@@ -84,20 +85,26 @@ class IdeaInterface(graphene.Interface):
     message_columns = graphene.List(lambda: IdeaMessageColumn, description=docs.Idea.message_columns)
 
     def resolve_title(self, args, context, info):
-        return resolve_langstring(self.title, args.get('lang'))
+        return load_langstring(context, self, 'title').then(
+            lambda title: resolve_langstring(title, args.get('lang')))
 
     def resolve_title_entries(self, args, context, info):
-        return resolve_langstring_entries(self, 'title')
+        return load_langstring(context, self, 'title').then(
+            lambda title: resolve_langstring_entries(self, 'title'))
 
     def resolve_description(self, args, context, info):
-        description = resolve_langstring(self.description, args.get('lang'))
-        if description is None:
-            return u''
+        def resolve(description):
+            description = resolve_langstring(description, args.get('lang'))
+            if description is None:
+                return u''
 
-        return description
+            return description
+        return load_langstring(context, self, 'description').then(resolve)
 
     def resolve_description_entries(self, args, context, info):
-        return resolve_langstring_entries(self, 'description')
+        return load_langstring(context, self, 'description').then(
+            lambda description: resolve_langstring_entries(
+                self, 'description'))
 
     def resolve_top_keywords(self, args, context, info):
         result = self.top_keywords(display_lang=args.get('lang'))
@@ -0,0 +1,161 @@
+"""Request-scoped DataLoaders, to fetch the related rows of many nodes
+with a single query.
+
+Resolvers ask the loaders of the context (the pyramid request) for a key
+and return the promise; the keys asked by sibling nodes are loaded
+together. The loaders are dropped when the session flushes changes, so a
+query that follows a mutation does not see stale rows."""
+from collections import defaultdict
+
+from promise import Promise
+from promise.dataloader import DataLoader
+from pyramid.threadlocal import get_current_request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.sql.functions import count
+
+from assembl import models
+
+
+def batch_loader(load, default=None):
+    """A DataLoader from a function that takes a list of keys and returns
+    a dictionary of their values; missing keys get the default value."""
+    def batch_load_fn(keys):
+        values = load(keys)
+        return Promise.resolve([values.get(key, default) for key in keys])
+    return DataLoader(batch_load_fn)
+
+
+def model_loader(cls, *options):
+    "A DataLoader of instances of cls by id"
+    def load(ids):
+        return {instance.id: instance for instance in cls.default_db.query(
+            cls).options(*options).filter(cls.id.in_(ids))}
+    return batch_loader(load)
+
+
+def group_by_key(rows, key):
+    result = defaultdict(list)
+    for row in rows:
+        result[key(row)].append(row)
+    return result
+
+
+class Loaders(object):
+    """The DataLoaders of a GraphQL request."""
+
+    def __init__(self, user_id=None):
+        self.user_id = user_id if isinstance(user_id, (int, long)) else None
+        self.agent_profiles = model_loader(models.AgentProfile)
+        self.langstrings = model_loader(
+            models.LangString, joinedload(models.LangString.entries))
+        self.post_creator_ids = batch_loader(self.load_post_creator_ids)
+        self.sentiment_counts = batch_loader(self.load_sentiment_counts)
+        self.my_sentiments = batch_loader(self.load_my_sentiments)
+        self.post_attachments = batch_loader(
+            self.load_post_attachments, ())
+        self.profile_attachments = batch_loader(
+            self.load_profile_attachments, ())
+        self.extracts = batch_loader(self.load_extracts, ())
+        self.vote_counts = batch_loader(self.load_vote_counts, 0)
+
+    @property
+    def db(self):
+        return models.Content.default_db
+
+    def load_post_creator_ids(self, post_ids):
+        return dict(self.db.query(
+            models.Post.id, models.Post.creator_id).filter(
+            models.Post.id.in_(post_ids)))
+
+    def load_sentiment_counts(self, post_ids):
+        SentimentOfPost = models.SentimentOfPost
+        counts = {
+            post_id: {name: 0 for name in SentimentOfPost.all_sentiments}
+            for post_id in post_ids}
+        for (post_id, sentiment_type, num) in self.db.query(
+                SentimentOfPost.post_id, SentimentOfPost.type,
+                count(SentimentOfPost.id)).filter(
+                SentimentOfPost.post_id.in_(post_ids),
+                SentimentOfPost.tombstone_condition()).group_by(
+                SentimentOfPost.post_id, SentimentOfPost.type):
+            counts[post_id][
+                sentiment_type[SentimentOfPost.TYPE_PREFIX_LEN:]] = num
+        return counts
+
+    def load_my_sentiments(self, post_ids):
+        if self.user_id is None:
+            return {}
+        return {sentiment.post_id: sentiment for sentiment in self.db.query(
+            models.SentimentOfPost).filter(
+            models.SentimentOfPost.post_id.in_(post_ids),
+            models.SentimentOfPost.actor_id == self.user_id,
+            models.SentimentOfPost.tombstone_date == None)}  # noqa: E711
+
+    def load_post_attachments(self, post_ids):
+        return group_by_key(self.db.query(models.PostAttachment).filter(
+            models.PostAttachment.post_id.in_(post_ids)).options(
+            joinedload(models.PostAttachment.document)).order_by(
+            models.PostAttachment.id), lambda a: a.post_id)
+
+    def load_profile_attachments(self, user_ids):
+        return group_by_key(self.db.query(
+            models.AgentProfileAttachment).filter(
+            models.AgentProfileAttachment.user_id.in_(user_ids)).options(
+            joinedload(models.AgentProfileAttachment.document)).order_by(
+            models.AgentProfileAttachment.id), lambda a: a.user_id)
+
+    def load_extracts(self, post_ids):
+        return group_by_key(self.db.query(models.Extract).filter(
+            models.Extract.content_id.in_(post_ids)).options(
+            joinedload(models.Extract.text_fragment_identifiers)).order_by(
+            models.Extract.creation_date), lambda e: e.content_id)
+
+    def load_vote_counts(self, vote_spec_ids):
+        # There is no distinct on purpose here.
+        # For a token vote spec, voting on two categories is counted as 2 votes.
+        vote = models.AbstractIdeaVote
+        return dict(self.db.query(
+            vote.vote_spec_id, count(vote.voter_id)).filter(
+            vote.vote_spec_id.in_(vote_spec_ids),
+            vote.tombstone_date == None  # noqa: E711
+        ).group_by(vote.vote_spec_id))
+
+
+def get_loaders(context):
+    "The loaders of this GraphQL context, created on first use"
+    loaders = getattr(context, 'graphql_loaders', None)
+    if loaders is None:
+        loaders = context.graphql_loaders = Loaders(
+            context.authenticated_userid)
+    return loaders
+
+
+def load_langstring(context, obj, attr):
+    """A promise of the LangString of a relationship of obj, with its
+    entries. Langstrings not loaded yet are fetched together."""
+    state = inspect(obj)
+    if attr in state.dict:
+        langstring = state.dict[attr]
+        if langstring is None or langstring.id is None or \
+                'entries' in inspect(langstring).dict:
+            return Promise.resolve(langstring)
+        # Loading it again fills the entries of the same instance
+        langstring_id = langstring.id
+    else:
+        relationship = state.mapper.relationships[attr]
+        (column,) = relationship.local_columns
+        langstring_id = getattr(
+            obj, relationship.parent.get_property_by_column(column).key)
+    if langstring_id is None:
+        return Promise.resolve(None)
+    return get_loaders(context).langstrings.load(langstring_id)
+
+
+def _drop_loaders(session, flush_context):
+    req = get_current_request()
+    if getattr(req, 'graphql_loaders', None) is not None:
+        req.graphql_loaders = None
+
+
+event.listen(Session, 'after_flush', _drop_loaders)
@@ -2,10 +2,10 @@ from datetime import datetime
 
 import graphene
 from graphene.relay import Node
+from promise import Promise
 from graphene_sqlalchemy import SQLAlchemyObjectType
 from pyramid.httpexceptions import HTTPUnauthorized
 from pyramid.i18n import TranslationStringFactory
-from sqlalchemy.orm import joinedload
 from sqlalchemy import exists
 
 from assembl import models
@@ -24,6 +24,7 @@ from .attachment import Attachment
 from .idea import Idea, TagResult
 from .langstring import (LangStringEntry, resolve_best_langstring_entries,
                          resolve_langstring)
+from .loaders import get_loaders, load_langstring
 from .sentiment import SentimentCounts, SentimentTypes
 from .types import SecureObjectType, SQLAlchemyInterface
 from .user import AgentProfile
@@ -101,27 +102,31 @@ class PostInterface(SQLAlchemyInterface):
     def resolve_db_id(self, args, context, info):
         return self.id
 
+    def resolve_creator(self, args, context, info):
+        if self.creator_id is not None:
+            return get_loaders(context).agent_profiles.load(self.creator_id)
+
     def resolve_extracts(self, args, context, info):
-        return self.db.query(models.Extract
-                             ).join(models.Content, models.Extract.content == self
-                                    ).options(joinedload(models.Extract.text_fragment_identifiers)
-                                              ).order_by(models.Extract.creation_date
-                                                         ).all()
+        return get_loaders(context).extracts.load(self.id)
+
+    def resolve_attachments(self, args, context, info):
+        return get_loaders(context).post_attachments.load(self.id)
 
     def resolve_subject(self, args, context, info):
         # Use self.subject and not self.get_subject() because we still
         # want the subject even when the post is deleted.
-        subject = resolve_langstring(self.subject, args.get('lang'))
-        return subject
+        return load_langstring(context, self, 'subject').then(
+            lambda subject: resolve_langstring(subject, args.get('lang')))
 
     def resolve_body(self, args, context, info):
-        body = resolve_langstring(self.get_body(), args.get('lang'))
-        return body
+        return load_langstring(context, self, 'body').then(
+            lambda body: resolve_langstring(self.get_body(), args.get('lang')))
 
     def resolve_parent_post_creator(self, args, context, info):
         if self.parent_id:
-            post = models.Content.get(self.parent_id)
-            return post.creator
+            loaders = get_loaders(context)
+            return loaders.post_creator_ids.load(self.parent_id).then(
+                lambda creator_id: loaders.agent_profiles.load(creator_id))
 
     @staticmethod
     @abort_transaction_on_exception
@@ -145,19 +150,27 @@ class PostInterface(SQLAlchemyInterface):
         # flush so abort_transaction_on_exception decorator can catch the error
         post.db.flush()
 
+    @staticmethod
+    def _load_langstrings(post, context):
+        return Promise.all([
+            load_langstring(context, post, 'subject'),
+            load_langstring(context, post, 'body')])
+
     def resolve_subject_entries(self, args, context, info):
         # Use self.subject and not self.get_subject() because we still
         # want the subject even when the post is deleted.
-        PostInterface._maybe_translate(self, args.get('lang'), context)
-        subject = resolve_best_langstring_entries(
-            self.subject, args.get('lang'))
-        return subject
+        def resolve(langstrings):
+            PostInterface._maybe_translate(self, args.get('lang'), context)
+            return resolve_best_langstring_entries(
+                self.subject, args.get('lang'))
+        return PostInterface._load_langstrings(self, context).then(resolve)
 
     def resolve_body_entries(self, args, context, info):
-        PostInterface._maybe_translate(self, args.get('lang'), context)
-        body = resolve_best_langstring_entries(
-            self.get_body(), args.get('lang'))
-        return body
+        def resolve(langstrings):
+            PostInterface._maybe_translate(self, args.get('lang'), context)
+            return resolve_best_langstring_entries(
+                self.get_body(), args.get('lang'))
+        return PostInterface._load_langstrings(self, context).then(resolve)
 
     def resolve_sentiment_counts(self, args, context, info):
         # get the sentiment counts from the cache if it exists instead of
@@ -168,22 +181,25 @@ class PostInterface(SQLAlchemyInterface):
                 name: 0 for name in models.SentimentOfPost.all_sentiments
             }
             sentiment_counts.update(cache[self.id])
+            sentiment_counts = Promise.resolve(sentiment_counts)
         else:
-            sentiment_counts = self.sentiment_counts
+            sentiment_counts = get_loaders(context).sentiment_counts.load(
+                self.id)
 
-        return SentimentCounts(
+        return sentiment_counts.then(lambda sentiment_counts: SentimentCounts(
             dont_understand=sentiment_counts['dont_understand'],
             disagree=sentiment_counts['disagree'],
             like=sentiment_counts['like'],
             more_info=sentiment_counts['more_info'],
-        )
+        ))
 
     def resolve_my_sentiment(self, args, context, info):
-        my_sentiment = self.my_sentiment
-        if my_sentiment is None:
-            return None
+        def resolve(my_sentiment):
+            if my_sentiment is None:
+                return None
 
-        return my_sentiment.name.upper()
+            return my_sentiment.name.upper()
+        return get_loaders(context).my_sentiments.load(self.id).then(resolve)
 
     def resolve_indirect_idea_content_links(self, args, context, info):
         # example:
@@ -218,11 +234,13 @@ class PostInterface(SQLAlchemyInterface):
         return self.publication_state.name
 
     def resolve_original_locale(self, args, context, info):
-        entry = self.body.first_original()
-        if entry:
-            return entry.locale_code
+        def resolve(body):
+            entry = body.first_original()
+            if entry:
+                return entry.locale_code
 
-        return u''
+            return u''
+        return load_langstring(context, self, 'body').then(resolve)
 
     def resolve_type(self, args, context, info):
         return self.__class__.__name__
@@ -0,0 +1,188 @@
+"""Profiling of GraphQL operations by field.
+
+The :py:class:`ProfilingMiddleware` measures the wall time of each resolver,
+and the SQL statements executed while it runs, by ``Type.field``. SQL
+executed outside of a resolver, as when the DataLoaders fetch the rows of
+many nodes, is counted under ``(batched)``.
+
+The report of an operation can be added to the GraphQL response, as the
+``profile`` extension, and the reports of all operations are logged
+together every ``graphql_profiling_log_seconds``."""
+from collections import defaultdict
+from threading import Lock, local
+from time import time
+
+from pyramid.settings import asbool
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from assembl.lib.config import get_config
+from assembl.lib.logging import getLogger
+
+
+BATCHED = '(batched)'
+
+_current = local()
+
+
+class FieldStats(object):
+    __slots__ = ('calls', 'time', 'sql_count', 'sql_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+    def add(self, other):
+        self.calls += other.calls
+        self.time += other.time
+        self.sql_count += other.sql_count
+        self.sql_time += other.sql_time
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'time': round(self.time * 1000, 3),
+            'sql_count': self.sql_count,
+            'sql_time': round(self.sql_time * 1000, 3),
+        }
+
+
+def stats_report(fields, limit=None):
+    "Field stats as dicts, the slowest first; times are in milliseconds"
+    fields = sorted(
+        fields.items(), key=lambda (_, stats): stats.time + stats.sql_time,
+        reverse=True)
+    return [dict(stats.as_dict(), field=name)
+            for (name, stats) in fields[:limit]]
+
+
+class OperationProfile(object):
+    """The field stats of one GraphQL operation."""
+
+    def __init__(self):
+        self.start = time()
+        self.end = None
+        self.operation = None
+        self.fields = defaultdict(FieldStats)
+        self.stack = []
+
+    def sql_executed(self, duration):
+        stats = self.fields[self.stack[-1] if self.stack else BATCHED]
+        stats.sql_count += 1
+        stats.sql_time += duration
+
+    def finish(self):
+        self.end = time()
+
+    def report(self):
+        return {
+            'operation': self.operation,
+            'time': round(((self.end or time()) - self.start) * 1000, 3),
+            'sql_count': sum(s.sql_count for s in self.fields.itervalues()),
+            'sql_time': round(sum(
+                s.sql_time for s in self.fields.itervalues()) * 1000, 3),
+            'fields': stats_report(self.fields),
+        }
+
+
+class ProfilingMiddleware(object):
+    """Measures the resolvers of the operation profiled in this thread.
+    It should be the last middleware, to measure only the resolver."""
+
+    def resolve(self, next, source, gargs, context, info, *args, **kwargs):
+        profile = getattr(_current, 'profile', None)
+        if profile is None:
+            return next(source, gargs, context, info, *args, **kwargs)
+        if profile.operation is None and info.operation.name is not None:
+            profile.operation = info.operation.name.value
+        name = "%s.%s" % (info.parent_type.name, info.field_name)
+        profile.stack.append(name)
+        start = time()
+        try:
+            return next(source, gargs, context, info, *args, **kwargs)
+        finally:
+            stats = profile.fields[name]
+            stats.calls += 1
+            stats.time += time() - start
+            profile.stack.pop()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if getattr(_current, 'profile', None) is not None:
+        conn.info.setdefault('graphql_query_start', []).append(time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profile = getattr(_current, 'profile', None)
+    starts = conn.info.get('graphql_query_start', None)
+    if profile is not None and starts:
+        profile.sql_executed(time() - starts.pop())
+
+
+class ProfileSummary(object):
+    """The field stats of the operations profiled by this process, logged
+    and reset every interval seconds."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.since = time()
+        self.operations = defaultdict(lambda: defaultdict(FieldStats))
+        self.counts = defaultdict(int)
+
+    def add(self, profile):
+        with self.lock:
+            operation = profile.operation or '(anonymous)'
+            self.counts[operation] += 1
+            fields = self.operations[operation]
+            for (name, stats) in profile.fields.iteritems():
+                fields[name].add(stats)
+            if time() - self.since < self.interval:
+                return
+            operations, counts = self.operations, self.counts
+            self.reset()
+        log = getLogger()
+        for (operation, fields) in operations.iteritems():
+            log.info('graphql_profile', opname=operation,
+                     count=counts[operation],
+                     fields=stats_report(fields, 10))
+
+
+_summary = None
+_listening = False
+
+
+def start_profile():
+    """Start profiling the GraphQL operation of this thread, if
+    ``graphql_profiling`` is set. Returns the profile, or None."""
+    global _summary, _listening
+    config = get_config()
+    if not asbool(config.get('graphql_profiling', False)):
+        return None
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+    if _summary is None:
+        _summary = ProfileSummary(float(
+            config.get('graphql_profiling_log_seconds', 60)))
+    profile = _current.profile = OperationProfile()
+    return profile
+
+
+def end_profile(profile):
+    "Stop profiling, and add the profile to the summary of this process"
+    _current.profile = None
+    profile.finish()
+    _summary.add(profile)
+
+
+def profile_in_response():
+    return asbool(get_config().get('graphql_profiling_in_response', False))
@@ -14,6 +14,7 @@ from assembl.auth.util import get_permissions
 from assembl.lib.exceptions import LocalizableError
 from assembl.views import JSONError
 from .document import Document
+from .loaders import get_loaders
 from .types import SecureObjectType
 from .utils import DateTime, abort_transaction_on_exception
 from assembl.auth.password import random_string
@@ -80,9 +81,13 @@ class AgentProfile(SecureObjectType, SQLAlchemyObjectType):
 
     def resolve_image(self, args, context, info):
         PROFILE_PICTURE = models.AttachmentPurpose.PROFILE_PICTURE.value
-        for attachment in self.profile_attachments:
-            if attachment.attachmentPurpose == PROFILE_PICTURE:
-                return attachment.document
+
+        def resolve(profile_attachments):
+            for attachment in profile_attachments:
+                if attachment.attachmentPurpose == PROFILE_PICTURE:
+                    return attachment.document
+        return get_loaders(context).profile_attachments.load(
+            self.id).then(resolve)
 
     def resolve_has_password(self, args, context, info):
         return self.password is not None
@@ -1,14 +1,27 @@
+from contextlib import contextmanager
+
+import simplejson as json
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPUnauthorized
 from pyramid.security import Everyone
 from pyramid.request import Response
+from pyramid.settings import asbool
 from graphql_wsgi import graphql_wsgi as graphql_wsgi_wrapper
+from graphql.error import GraphQLError, format_error
+from graphql.execution import execute
 from graphql.execution.middleware import MiddlewareManager
+from graphql.utils.get_operation_ast import get_operation_ast
 
 from assembl.auth import CrudPermissions
 from assembl.auth.util import get_permissions
 from assembl.auth.util import find_discussion_from_slug
+from assembl.graphql.cost import check_cost, get_cost_limits
+from assembl.graphql.documents import get_document_cache, get_query
+from assembl.graphql.loaders import Loaders
+from assembl.graphql.profiling import (
+    ProfilingMiddleware, end_profile, profile_in_response, start_profile)
 from assembl.graphql.schema import Schema
+from assembl.lib.config import get_config
 from assembl.lib.logging import getLogger
 from assembl.lib.sqla import get_session_maker
 
@@ -33,17 +46,71 @@ class LoggingMiddleware(object):
             raise e
 
 
-class ReadOnlyMiddleware(object):
-    def resolve(self, next, source, gargs, context, info, *args, **kwargs):
-        session = get_session_maker()()
-        ro = session.readonly
-        if info.operation.operation == 'query' and info.operation.name.value != u'Post':
-            # Post query has a side-effect with maybe_translate so it requires a db write.
-            session.set_readonly()
+# Queries with side effects, which must not read from the replica.
+# Post query has a side-effect with maybe_translate so it requires a db write.
+PRIMARY_QUERIES = {u'Post'}
+
+
+@contextmanager
+def operation_routing(request, document, operation_name):
+    """Send the read queries of a query operation to the replica, if the
+    session can use it for this user; mutations use the primary."""
+    session = get_session_maker()()
+    was_readonly = session.readonly
+    operation = get_operation_ast(document, operation_name)
+    if operation is not None and operation.operation == 'query' and (
+            operation.name is None or
+            operation.name.value not in PRIMARY_QUERIES):
+        session.set_readonly(session.can_use_replica(
+            request.authenticated_userid))
+    try:
+        yield
+    finally:
+        session.set_readonly(was_readonly)
+
+
+def json_response(result, status=200):
+    return Response(
+        json.dumps(result), status=status, content_type='application/json',
+        charset='utf-8')
+
+
+def execute_json_request(request, query, key, middleware, limits):
+    """Execute a JSON GraphQL request, with the cached document of its
+    query, if its cost is within the limits.
+    Returns the result and the status of the response.
+    Other requests (file uploads) go through graphql_wsgi."""
+    params = request.json_body
+    if not query:
+        return ({'errors': [{'message': 'Must provide query string.'}]}, 400)
+    (document, errors) = get_document_cache().get(query, key)
+    if errors:
+        return ({'errors': [format_error(e) for e in errors]}, 400)
+    variables = params.get('variables', None) or {}
+    if isinstance(variables, basestring):
         try:
-            return next(source, gargs, context, info, *args, **kwargs)
-        finally:
-            session.set_readonly(ro)
+            variables = json.loads(variables)
+        except ValueError:
+            variables = None
+    if not isinstance(variables, dict):
+        return ({'errors': [
+            {'message': 'Variables must be a JSON object.'}]}, 400)
+    operation_name = params.get('operationName', None)
+    try:
+        check_cost(Schema, document, variables, operation_name, limits)
+    except GraphQLError as e:
+        return ({'errors': [format_error(e)]}, 400)
+    with operation_routing(request, document, operation_name):
+        result = execute(
+            Schema, document, context_value=request,
+            variable_values=variables, operation_name=operation_name,
+            middleware=middleware)
+    if result.invalid:
+        return ({'errors': [format_error(e) for e in result.errors]}, 400)
+    response = {'data': result.data}
+    if result.errors:
+        response['errors'] = [format_error(e) for e in result.errors]
+    return (response, 200)
 
 
 # Only allow POST+OPTIONS (query may be GET, but mutations should always be a POST,
@@ -83,21 +150,55 @@ def graphql_api(request):
     # don't check read permission for TextFields query needed on the signup
     # page because we don't have read permission on private debate
     check_read_permission = True
-    if request.content_type == 'application/json' and u'query' in request.json_body and (
-        request.json_body['query'].startswith(u'query TextFields(') or
-            request.json_body['query'].startswith(u'query UpdateShareCount(') or
-            request.json_body['query'].startswith(u'query TabsCondition(') or
-            request.json_body['query'].startswith(u'query LegalContents(') or
-            request.json_body['query'].startswith(u'query DiscussionPreferences')):
+    is_json = request.content_type == 'application/json'
+    query = key = None
+    if is_json:
+        try:
+            params = request.json_body
+        except (ValueError, TypeError):
+            params = None
+        if not isinstance(params, dict):
+            return json_response({'errors': [
+                {'message': 'Body must be a JSON object.'}]}, 400)
+        try:
+            (query, key) = get_query(params, asbool(
+                get_config().get('graphql_persisted_queries_only', False)))
+        except GraphQLError as e:
+            return json_response({'errors': [format_error(e)]}, 400)
+    if query and (
+        query.startswith(u'query TextFields(') or
+            query.startswith(u'query UpdateShareCount(') or
+            query.startswith(u'query TabsCondition(') or
+            query.startswith(u'query LegalContents(') or
+            query.startswith(u'query DiscussionPreferences')):
         check_read_permission = False
 
     if check_read_permission and not discussion.user_can(user_id, CrudPermissions.READ, permissions):
         raise HTTPUnauthorized()
 
-    middleware = MiddlewareManager(
-        LoggingMiddleware(), ReadOnlyMiddleware(), wrap_in_promise=False)
-    solver = graphql_wsgi_wrapper(Schema, middleware=middleware)
-    response = solver(request)
+    # Resolvers return the promises of these loaders, to fetch related
+    # rows of sibling nodes together
+    request.graphql_loaders = Loaders(user_id)
+    middlewares = [LoggingMiddleware()]
+    profile = start_profile()
+    if profile is not None:
+        middlewares.append(ProfilingMiddleware())
+    middleware = MiddlewareManager(*middlewares, wrap_in_promise=False)
+    try:
+        if is_json:
+            (result, status) = execute_json_request(
+                request, query, key, middleware,
+                get_cost_limits(discussion, user_id))
+            if profile is not None and profile_in_response():
+                profile.finish()
+                result['extensions'] = {'profile': profile.report()}
+            response = json_response(result, status)
+        else:
+            solver = graphql_wsgi_wrapper(Schema, middleware=middleware)
+            response = solver(request)
+    finally:
+        if profile is not None:
+            end_profile(profile)
     if has_cors:
         response.headerlist.extend(cors_headers)
     return response
@@ -2,7 +2,6 @@ import graphene
 from graphene.relay import Node
 from graphene_sqlalchemy import SQLAlchemyObjectType
 
-from sqlalchemy.orm import with_polymorphic
 from sqlalchemy.sql import func
 
 from assembl import models
@@ -17,6 +16,7 @@ from .langstring import (
     langstring_from_input_entries,
     update_langstring_from_input_entries,
     resolve_langstring, resolve_langstring_entries)
+from .loaders import get_loaders, load_langstring
 from .types import SecureObjectType, SQLAlchemyUnion
 from .utils import (
     abort_transaction_on_exception)
@@ -120,16 +120,22 @@ class VoteSpecificationInterface(graphene.Interface):
     num_votes = graphene.Int(required=True, description=docs.VoteSpecificationInterface.num_votes)
 
     def resolve_title(self, args, context, info):
-        return resolve_langstring(self.title, args.get('lang'))
+        return load_langstring(context, self, 'title').then(
+            lambda title: resolve_langstring(title, args.get('lang')))
 
     def resolve_title_entries(self, args, context, info):
-        return resolve_langstring_entries(self, 'title')
+        return load_langstring(context, self, 'title').then(
+            lambda title: resolve_langstring_entries(self, 'title'))
 
     def resolve_instructions(self, args, context, info):
-        return resolve_langstring(self.instructions, args.get('lang'))
+        return load_langstring(context, self, 'instructions').then(
+            lambda instructions: resolve_langstring(
+                instructions, args.get('lang')))
 
     def resolve_instructions_entries(self, args, context, info):
-        return resolve_langstring_entries(self, 'instructions')
+        return load_langstring(context, self, 'instructions').then(
+            lambda instructions: resolve_langstring_entries(
+                self, 'instructions'))
 
     def resolve_is_custom(self, args, context, info):
         return False if self.is_custom is None else self.is_custom
@@ -150,14 +156,7 @@ class VoteSpecificationInterface(graphene.Interface):
             vote_spec_id=self.id, tombstone_date=None, voter_id=user_id, idea_id=self.criterion_idea_id).all()
 
     def resolve_num_votes(self, args, context, info):
-        vote_class = with_polymorphic(models.AbstractIdeaVote, models.AbstractIdeaVote)
-        res = self.db.query(
-            vote_class.voter_id).filter_by(
-            vote_spec_id=self.id,
-            tombstone_date=None).count()
-        # There is no distinct on purpose here.
-        # For a token vote spec, voting on two categories is counted as 2 votes.
-        return res
+        return get_loaders(context).vote_counts.load(self.id)
 
 
 class TokenCategorySpecification(SecureObjectType, SQLAlchemyObjectType):
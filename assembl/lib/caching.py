@@ -1,5 +1,10 @@
+from collections import defaultdict
+
 from dogpile.cache import make_region
+from pyramid.settings import asbool
+
 from .config import get_config
+from .sentry import capture_exception
 
 
 def create_analytics_region():
@@ -13,4 +18,91 @@ def create_analytics_region():
             'db': config.get('redis_socket')
         }
     )
-    return visit_analytics_region
\ No newline at end of file
+    return visit_analytics_region
+
+
+class LocalVersionStamps(object):
+    """Version numbers of cached data, for the current process only."""
+
+    def __init__(self):
+        self.versions = defaultdict(int)
+
+    def get(self, key):
+        return self.versions[key]
+
+    def get_many(self, keys):
+        return [self.versions[key] for key in keys]
+
+    def incr(self, key):
+        self.versions[key] += 1
+
+
+class RedisVersionStamps(object):
+    """Version numbers of cached data, shared by all processes through redis.
+
+    If redis cannot be reached, get returns None, meaning "do not cache".
+    So does it after an increment failed, as entries of that key would not
+    be reloaded, until the increment is done again."""
+
+    attempts = 2
+
+    def __init__(self, redis, prefix):
+        self.redis = redis
+        self.prefix = prefix
+        # Keys whose increment failed
+        self.failed = set()
+
+    def redis_key(self, key):
+        return self.prefix + ":".join(str(k) for k in key)
+
+    def retry_failed(self):
+        "Increment the keys whose increment failed; whether all succeeded"
+        for key in list(self.failed):
+            try:
+                self.redis.incr(self.redis_key(key))
+            except Exception:
+                return False
+            self.failed.discard(key)
+        return True
+
+    def get(self, key):
+        if not self.retry_failed():
+            return None
+        try:
+            return int(self.redis.get(self.redis_key(key)) or 0)
+        except Exception:
+            capture_exception()
+            return None
+
+    def get_many(self, keys):
+        if not self.retry_failed():
+            return None
+        try:
+            return [int(v or 0) for v in self.redis.mget(
+                [self.redis_key(key) for key in keys])]
+        except Exception:
+            capture_exception()
+            return None
+
+    def incr(self, key):
+        for attempt in range(self.attempts):
+            try:
+                self.redis.incr(self.redis_key(key))
+                return
+            except Exception:
+                if attempt == self.attempts - 1:
+                    capture_exception()
+        self.failed.add(key)
+
+
+def create_version_stamps(prefix):
+    """Version stamps in redis if ``structure_cache_redis`` is set,
+    otherwise local to this process."""
+    config = get_config()
+    if asbool(config.get('structure_cache_redis', False)):
+        from redis import StrictRedis
+        redis = StrictRedis(
+            host=config.get('redis_host'), port=6379,
+            db=config.get('redis_socket'))
+        return RedisVersionStamps(redis, prefix)
+    return LocalVersionStamps()
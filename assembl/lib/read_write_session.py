@@ -1,8 +1,26 @@
+"""A session which sends read queries to a replica, when it can.
+
+The replica is used for read-only operations only, and not:
+
+- once the session has written, until the end of its transaction;
+- for a user who wrote in the last ``replica_pin_seconds`` (read your
+  writes), as the replica may not have their changes yet;
+- when the replica is more than ``replica_max_lag_seconds`` behind the
+  primary. The lag is checked every ``replica_lag_check_seconds``."""
+import os
 from contextlib import contextmanager
+from threading import Lock
+from time import time
 
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
 import sqlalchemy.orm as orm
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
 
+from .config import get_config
 from .logging import getLogger
+from .sentry import capture_exception
 
 log = getLogger()
 
@@ -18,11 +36,15 @@ class ReadWriteSession(orm.Session):
         if read_bind:
             read_bind.is_readonly = True
         self.readonly = readonly
+        self.wrote = False
         orm.Session.__init__(
             self, bind=bind, autoflush=autoflush, **options)
 
     def get_bind(self, mapper=None, clause=None):
-        use_read = self.read_bind and not self._flushing and self.readonly
+        if isinstance(clause, UpdateBase):
+            self.wrote = True
+        use_read = self.read_bind and not self._flushing and \
+            self.readonly and not self.wrote
         log.debug("using %s session%s" % (
             "read" if use_read else "write",
             " while flushing" if self._flushing else ""))
@@ -34,6 +56,17 @@ class ReadWriteSession(orm.Session):
         else:
             self.readonly = readonly
 
+    def can_use_replica(self, user_id=None):
+        """Whether the read queries of an operation of this user can go to
+        the replica"""
+        if self.read_bind is None or self.wrote:
+            return False
+        pins = get_primary_pins()
+        if user_id is not None and pins is not None and \
+                pins.is_pinned(user_id):
+            return False
+        return get_replica_monitor(self.read_bind).is_available()
+
 
 @contextmanager
 def readonly(session):
@@ -43,3 +76,158 @@ def readonly(session):
         yield session
     finally:
         session.set_readonly(was_readonly)
+
+
+class ReplicaMonitor(object):
+    """The replication lag of a read engine, checked at most every
+    check_interval seconds."""
+
+    def __init__(self, engine, max_lag, check_interval):
+        self.engine = engine
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.available = True
+        self.next_check = 0
+        self.lock = Lock()
+
+    def lag(self):
+        "Seconds since the last replayed transaction, 0 if up to date"
+        with self.engine.connect() as connection:
+            if connection.dialect.server_version_info >= (10,):
+                up_to_date = \
+                    "pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()"
+            else:
+                up_to_date = ("pg_last_xlog_receive_location() = "
+                              "pg_last_xlog_replay_location()")
+            return connection.execute(
+                "SELECT CASE WHEN NOT pg_is_in_recovery() OR %s THEN 0 "
+                "ELSE EXTRACT(EPOCH FROM now() - "
+                "pg_last_xact_replay_timestamp()) END" % (up_to_date,)
+            ).scalar() or 0
+
+    def is_available(self):
+        now = time()
+        if now < self.next_check or not self.lock.acquire(False):
+            return self.available
+        try:
+            self.next_check = now + self.check_interval
+            try:
+                lag = self.lag()
+                available = lag <= self.max_lag
+            except Exception:
+                capture_exception()
+                lag = None
+                available = False
+            if available != self.available:
+                if available:
+                    log.info("replica_available", lag=lag)
+                else:
+                    log.warning("replica_unavailable", lag=lag)
+            self.available = available
+        finally:
+            self.lock.release()
+        return self.available
+
+
+def get_replica_monitor(engine):
+    monitor = getattr(engine, 'replica_monitor', None)
+    if monitor is None:
+        config = get_config()
+        monitor = engine.replica_monitor = ReplicaMonitor(
+            engine, float(config.get('replica_max_lag_seconds', 5)),
+            float(config.get('replica_lag_check_seconds', 2)))
+    return monitor
+
+
+class LocalPrimaryPins(object):
+    """Users who wrote recently, for the current process only."""
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.lock = Lock()
+        self.pins = {}
+
+    def pin(self, user_id):
+        now = time()
+        with self.lock:
+            self.pins[user_id] = now + self.duration
+            if len(self.pins) > 10000:
+                self.pins = {user_id: until for (user_id, until)
+                             in self.pins.items() if until > now}
+
+    def is_pinned(self, user_id):
+        return self.pins.get(user_id, 0) > time()
+
+
+class RedisPrimaryPins(object):
+    """Users who wrote recently, shared by all processes through redis.
+    If redis cannot be reached, users are considered pinned."""
+
+    def __init__(self, redis, prefix, duration):
+        self.redis = redis
+        self.prefix = prefix
+        self.duration = duration
+
+    def pin(self, user_id):
+        try:
+            self.redis.setex(
+                "%s%s" % (self.prefix, user_id), int(self.duration) or 1, 1)
+        except Exception:
+            capture_exception()
+
+    def is_pinned(self, user_id):
+        try:
+            return self.redis.exists("%s%s" % (self.prefix, user_id))
+        except Exception:
+            capture_exception()
+            return True
+
+
+_pins = None
+_pins_pid = None
+
+
+def get_primary_pins():
+    """The users pinned to the primary database, or None if
+    ``replica_pin_seconds`` is not set."""
+    global _pins, _pins_pid
+    if _pins_pid == os.getpid():
+        return _pins
+    config = get_config()
+    duration = float(config.get('replica_pin_seconds', 0) or 0)
+    pins = None
+    if duration > 0:
+        if asbool(config.get('replica_pin_redis', False)):
+            from redis import StrictRedis
+            redis = StrictRedis(
+                host=config.get('redis_host'), port=6379,
+                db=config.get('redis_socket'))
+            pins = RedisPrimaryPins(redis, 'assembl:primary_pin:', duration)
+        else:
+            pins = LocalPrimaryPins(duration)
+    _pins, _pins_pid = pins, os.getpid()
+    return pins
+
+
+def _note_write(session, flush_context):
+    session.wrote = True
+
+
+def _pin_writer(session):
+    if not session.wrote or session.read_bind is None:
+        return
+    req = get_current_request()
+    user_id = req.authenticated_userid if req is not None else None
+    pins = get_primary_pins()
+    if user_id is not None and pins is not None:
+        pins.pin(user_id)
+
+
+def _forget_write(session, transaction):
+    if transaction.parent is None:
+        session.wrote = False
+
+
+event.listen(ReadWriteSession, 'after_flush', _note_write)
+event.listen(ReadWriteSession, 'after_commit', _pin_writer)
+event.listen(ReadWriteSession, 'after_transaction_end', _forget_write)
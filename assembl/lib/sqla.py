@@ -23,7 +23,8 @@ from sqlalchemy import (
 from sqlalchemy.exc import NoInspectionAvailable
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import AssociationProxy
-from sqlalchemy.orm import mapper, scoped_session, sessionmaker
+from sqlalchemy.orm import (
+    mapper, scoped_session, sessionmaker, joinedload, selectinload)
 from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY, MANYTOMANY
 from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.orm.util import has_identity
@@ -214,6 +215,223 @@ class TableLockCreationThread(Thread):
             self.exception = e
 
 
+def _translate_to_json(v, view_name, user_id, permissions, base_uri):
+    """Translate a value read on a model instance to JSON.
+
+    Base instances are given as their URI, or as nested JSON if a
+    view_name is given."""
+    if isinstance(v, Base):
+        p = getattr(v, 'user_can', None)
+        if p and not v.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            return None
+        if view_name:
+            return v.generic_json(
+                view_name, user_id, permissions, base_uri)
+        else:
+            return v.uri(base_uri)
+    elif isinstance(v, (
+            str, unicode, int, long, float, bool, types.NoneType)):
+        return v
+    elif isinstance(v, EnumSymbol):
+        return v.name
+    elif isinstance(v, datetime):
+        return v.isoformat() + "Z"
+    elif isinstance(v, dict):
+        v = {_translate_to_json(k, view_name, user_id, permissions, base_uri):
+             _translate_to_json(val, view_name, user_id, permissions, base_uri)
+             for k, val in v.items()}
+        return {k: val for (k, val) in v.items()
+                if val is not None}
+    elif isinstance(v, Iterable):
+        v = [_translate_to_json(i, view_name, user_id, permissions, base_uri)
+             for i in v]
+        return [x for x in v if x is not None]
+    else:
+        raise NotImplementedError("Cannot translate", v)
+
+
+# Serialization steps. Each factory returns a function that reads one
+# view_def entry from an instance into the result dict.
+
+def _literal_step(name, json_literal):
+    value = loads(json_literal)
+    if isinstance(value, (dict, list)):
+        # do not share mutable values between results
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = loads(json_literal)
+    else:
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = value
+    return step
+
+
+def _literal_value_step(name, value):
+    def step(ob, result, user_id, permissions, base_uri):
+        result[name] = value
+    return step
+
+
+def _self_step(name, view_name):
+    if view_name:
+        def step(ob, result, user_id, permissions, base_uri):
+            r = ob.generic_json(view_name, user_id, permissions, base_uri)
+            if r is not None:
+                result[name] = r
+    else:
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = ob.uri()
+    return step
+
+
+def _method_step(name, method_name, view_name):
+    def step(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, method_name)()
+        result[name] = _translate_to_json(
+            val, view_name, user_id, permissions, base_uri)
+    return step
+
+
+def _property_step(name, prop_name, view_name):
+    def step(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, prop_name)
+        if val is not None:
+            val = _translate_to_json(
+                val, view_name, user_id, permissions, base_uri)
+        if val is not None:
+            result[name] = val
+    return step
+
+
+def _fkey_uri_step(name, fkey_name, target_cls):
+    def step(ob, result, user_id, permissions, base_uri):
+        result[name] = target_cls.uri_generic(getattr(ob, fkey_name))
+    return step
+
+
+def _collection_step(name, prop_name, view_name, as_dict):
+    if view_name and as_dict:
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = {
+                sub.uri(base_uri):
+                sub.generic_json(view_name, user_id, permissions, base_uri)
+                for sub in getattr(ob, prop_name)
+                if sub.user_can(user_id, CrudPermissions.READ, permissions)}
+    elif view_name:
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = [
+                sub.generic_json(view_name, user_id, permissions, base_uri)
+                for sub in getattr(ob, prop_name)
+                if sub.user_can(user_id, CrudPermissions.READ, permissions)]
+    else:
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = [
+                sub.uri(base_uri) for sub in getattr(ob, prop_name)
+                if sub.user_can(user_id, CrudPermissions.READ, permissions)]
+    return step
+
+
+def _relation_step(name, prop_name, view_name, as_list):
+    def step(ob, result, user_id, permissions, base_uri):
+        sub = getattr(ob, prop_name)
+        if sub and sub.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            val = sub.generic_json(
+                view_name, user_id, permissions, base_uri)
+            if val is not None:
+                result[name] = [val] if as_list else val
+        else:
+            result[name] = [] if as_list else None
+    return step
+
+
+def _relation_id_step(name, fkey_name, target_cls, as_list):
+    def step(ob, result, user_id, permissions, base_uri):
+        uri = None
+        ob_id = getattr(ob, fkey_name)
+        if ob_id:
+            uri = target_cls.uri_generic(ob_id, base_uri)
+        if uri:
+            result[name] = [uri] if as_list else uri
+        else:
+            result[name] = [] if as_list else None
+    return step
+
+
+def _relation_uri_step(name, prop_name, as_list):
+    def step(ob, result, user_id, permissions, base_uri):
+        sub = getattr(ob, prop_name)
+        uri = sub.uri(base_uri) if sub else None
+        if uri:
+            result[name] = [uri] if as_list else uri
+        else:
+            result[name] = [] if as_list else None
+    return step
+
+
+class SerializationPlan(object):
+    """A view_def compiled for a given class.
+
+    Calling the plan on an instance gives the same JSON as
+    :py:meth:`BaseOps.generic_json`, without re-inspecting the class or
+    re-parsing the view_def. A plan without steps stands for a class
+    that the view_def does not show."""
+    __slots__ = ('view_def', 'steps', 'defaults', 'relations')
+
+    def __init__(self, view_def, steps, defaults=(), relations=()):
+        self.view_def = view_def
+        self.steps = steps
+        # (json name, attribute name, target class of foreign key or None)
+        self.defaults = defaults
+        # (relationship, view_def name or None) traversed by the steps
+        self.relations = relations
+
+    def __call__(self, ob, user_id, permissions, base_uri='local:'):
+        if self.steps is None:
+            return None
+        result = {}
+        for step in self.steps:
+            step(ob, result, user_id, permissions, base_uri)
+        for name, attr_name, target_cls in self.defaults:
+            val = getattr(ob, attr_name)
+            if target_cls is not None:
+                result[name] = target_cls.uri_generic(
+                    val, base_uri) if val else None
+            elif val:
+                if type(val) == datetime:
+                    val = val.isoformat() + "Z"
+                result[name] = val
+            else:
+                result[name] = None
+        return result
+
+
+_serialization_plans = {}
+
+
+def _eager_loading_options(cls, view_def_name, entity, parent, depth, seen):
+    plan = cls.get_serialization_plan(view_def_name)
+    if not plan.relations:
+        return
+    seen = seen | {(cls, view_def_name)}
+    for reln, view_name in plan.relations:
+        attr = getattr(entity, reln.key)
+        if reln.uselist:
+            option = (parent.selectinload(attr) if parent is not None
+                      else selectinload(attr))
+        else:
+            option = (parent.joinedload(attr) if parent is not None
+                      else joinedload(attr))
+        yield option
+        target_cls = reln.mapper.class_
+        if (view_name and depth > 1 and issubclass(target_cls, BaseOps)
+                and (target_cls, view_name) not in seen):
+            for sub_option in _eager_loading_options(
+                    target_cls, view_name, target_cls, option,
+                    depth - 1, seen):
+                yield sub_option
+
+
 class BaseOps(object):
     """Base class for SQLAlchemy models in Assembl.
 
@@ -640,21 +858,33 @@ class BaseOps(object):
             view_def[my_typename] = local_view
         return local_view
 
-    def generic_json(
-            self, view_def_name='default', user_id=None,
-            permissions=(P_READ, ), base_uri='local:'):
-        """Return a representation of this object as a JSON object,
-        according to the given view_def and access control."""
-        user_id = user_id or Everyone
-        if not self.user_can(user_id, CrudPermissions.READ, permissions):
-            return None
+    @classmethod
+    def get_serialization_plan(cls, view_def_name='default'):
+        """Return the :py:class:`SerializationPlan` of this class for the
+        given view_def, compiling it on first use.
+
+        Plans are cached process-wide, and recompiled if the view_def
+        object changed (i.e. if view_defs are not cached.)"""
         view_def = get_view_def(view_def_name or 'default')
-        my_typename = self.external_typename()
-        result = {}
-        local_view = self.expand_view_def(view_def)
+        key = (cls, view_def_name)
+        plan = _serialization_plans.get(key, None)
+        if plan is None or plan.view_def is not view_def:
+            plan = cls._compile_serialization_plan(view_def_name, view_def)
+            _serialization_plans[key] = plan
+        return plan
+
+    @classmethod
+    def _compile_serialization_plan(cls, view_def_name, view_def):
+        """Turn each entry of the view_def into a serialization step.
+
+        All introspection of the mapper and class, and all parsing of
+        the view_def specs, happens here rather than in
+        :py:meth:`generic_json`."""
+        my_typename = cls.external_typename()
+        local_view = cls.expand_view_def(view_def)
         if not local_view:
-            return None
-        mapper = self.__class__.__mapper__
+            return SerializationPlan(view_def, None)
+        mapper = cls.__mapper__
         relns = {r.key: r for r in mapper.relationships}
         cols = {c.key: c for c in mapper.columns}
         fkeys = {c for c in mapper.columns if c.foreign_keys}
@@ -665,11 +895,14 @@ class BaseOps(object):
         fkey_of_reln = {r.key: r._calculated_foreign_keys
                         for r in mapper.relationships}
         methods = dict(pyinspect.getmembers(
-            self.__class__, lambda m: pyinspect.ismethod(m)
+            cls, lambda m: pyinspect.ismethod(m)
             and m.func_code.co_argcount == 1))
         properties = dict(pyinspect.getmembers(
-            self.__class__, lambda p: pyinspect.isdatadescriptor(p)))
+            cls, lambda p: pyinspect.isdatadescriptor(p)))
+        method_relations = cls.view_def_method_relations
         known = set()
+        steps = []
+        relations = []
         for name, spec in local_view.iteritems():
             if name == "_default":
                 continue
@@ -693,6 +926,7 @@ class BaseOps(object):
                 subspec = spec["@id"]
             else:
                 subspec = spec
+            as_list = isinstance(spec, list)
             if subspec is True:
                 prop_name = name
                 view_name = None
@@ -702,7 +936,7 @@ class BaseOps(object):
                         view_def_name, my_typename, name)
                 if subspec[0] == "'":
                     # literals.
-                    result[name] = loads(subspec[1:])
+                    steps.append(_literal_step(name, subspec[1:]))
                     continue
                 if ':' in subspec:
                     prop_name, view_name = subspec.split(':', 1)
@@ -717,48 +951,12 @@ class BaseOps(object):
                 assert get_view_def(view_name),\
                     "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
                         view_def_name, my_typename, name, view_name)
-            #print prop_name, name, view_name
-
-            def translate_to_json(v):
-                if isinstance(v, Base):
-                    p = getattr(v, 'user_can', None)
-                    if p and not v.user_can(
-                            user_id, CrudPermissions.READ, permissions):
-                        return None
-                    if view_name:
-                        return v.generic_json(
-                            view_name, user_id, permissions, base_uri)
-                    else:
-                        return v.uri(base_uri)
-                elif isinstance(v, (
-                        str, unicode, int, long, float, bool, types.NoneType)):
-                    return v
-                elif isinstance(v, EnumSymbol):
-                    return v.name
-                elif isinstance(v, datetime):
-                    return v.isoformat() + "Z"
-                elif isinstance(v, dict):
-                    v = {translate_to_json(k): translate_to_json(val)
-                         for k, val in v.items()}
-                    return {k: val for (k, val) in v.items()
-                            if val is not None}
-                elif isinstance(v, Iterable):
-                    v = [translate_to_json(i) for i in v]
-                    return [x for x in v if x is not None]
-                else:
-                    raise NotImplementedError("Cannot translate", v)
 
             if prop_name == 'self':
-                if view_name:
-                    r = self.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if r is not None:
-                        result[name] = r
-                else:
-                    result[name] = self.uri()
+                steps.append(_self_step(name, view_name))
                 continue
             elif prop_name == '@view':
-                result[name] = view_def_name
+                steps.append(_literal_value_step(name, view_def_name))
                 continue
             elif prop_name[0] == '&':
                 prop_name = prop_name[1:]
@@ -767,8 +965,10 @@ class BaseOps(object):
                         view_def_name, my_typename, name, prop_name)
                 # Function call. PLEASE RETURN JSON, Base objects,
                 # or list or dicts thereof
-                val = getattr(self, prop_name)()
-                result[name] = translate_to_json(val)
+                steps.append(_method_step(name, prop_name, view_name))
+                if method_relations.get(prop_name, None) in relns:
+                    relations.append(
+                        (relns[method_relations[prop_name]], view_name))
                 continue
             elif prop_name in cols:
                 assert not view_name,\
@@ -781,28 +981,21 @@ class BaseOps(object):
                     "in viewdef %s, class %s, dict for literal property %s" % (
                         view_def_name, my_typename, prop_name)
                 known.add(prop_name)
-                val = getattr(self, prop_name)
-                if val is not None:
-                    val = translate_to_json(val)
-                if val is not None:
-                    result[name] = val
+                steps.append(_property_step(name, prop_name, None))
                 continue
             elif prop_name in properties:
                 known.add(prop_name)
                 if view_name or (prop_name not in fkey_of_reln) or (
                         relns[prop_name].direction != MANYTOONE):
-                    val = getattr(self, prop_name)
-                    if val is not None:
-                        val = translate_to_json(val)
-                    if val is not None:
-                        result[name] = val
+                    steps.append(_property_step(name, prop_name, view_name))
+                    if prop_name in relns:
+                        relations.append((relns[prop_name], view_name))
                 else:
-                    fkeys = list(fkey_of_reln[prop_name])
-                    assert(len(fkeys) == 1)
-                    fkey = fkeys[0]
-                    result[name] = relns[prop_name].mapper.class_.uri_generic(
-                        getattr(self, fkey.key))
-
+                    reln_fkeys = list(fkey_of_reln[prop_name])
+                    assert(len(reln_fkeys) == 1)
+                    steps.append(_fkey_uri_step(
+                        name, reln_fkeys[0].key,
+                        relns[prop_name].mapper.class_))
                 continue
             assert prop_name in relns,\
                     "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
@@ -810,105 +1003,86 @@ class BaseOps(object):
             known.add(prop_name)
             # Add derived prop?
             reln = relns[prop_name]
+            relations.append((reln, view_name))
             if reln.uselist:
-                vals = getattr(self, prop_name)
                 if view_name:
-                    if isinstance(spec, dict):
-                        result[name] = {
-                            ob.uri(base_uri):
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)}
-                    else:
-                        result[name] = [
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)]
+                    steps.append(_collection_step(
+                        name, prop_name, view_name, isinstance(spec, dict)))
                 else:
                     assert not isinstance(spec, dict),\
                         "in viewdef %s, class %s, dict without viewname for %s" % (
                             view_def_name, my_typename, name)
-                    result[name] = [
-                        ob.uri(base_uri) for ob in vals
-                        if ob.user_can(
-                            user_id, CrudPermissions.READ, permissions)]
+                    steps.append(_collection_step(
+                        name, prop_name, None, False))
                 continue
             assert not isinstance(spec, dict),\
                 "in viewdef %s, class %s, dict for non-list relation %s" % (
                     view_def_name, my_typename, prop_name)
             if view_name:
-                ob = getattr(self, prop_name)
-                if ob and ob.user_can(
-                        user_id, CrudPermissions.READ, permissions):
-                    val = ob.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if val is not None:
-                        if isinstance(spec, list):
-                            result[name] = [val]
-                        else:
-                            result[name] = val
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+                steps.append(_relation_step(name, prop_name, view_name, as_list))
+            elif len(reln._calculated_foreign_keys) == 1 \
+                    and reln._calculated_foreign_keys < fkeys:
+                # shortcut, avoid fetch
+                fkey = list(reln._calculated_foreign_keys)[0]
+                steps.append(_relation_id_step(
+                    name, fkey.name, reln.mapper.class_, as_list))
             else:
-                uri = None
-                if len(reln._calculated_foreign_keys) == 1 \
-                        and reln._calculated_foreign_keys < fkeys:
-                    # shortcut, avoid fetch
-                    fkey = list(reln._calculated_foreign_keys)[0]
-                    ob_id = getattr(self, fkey.name)
-                    if ob_id:
-                        uri = reln.mapper.class_.uri_generic(
-                            ob_id, base_uri)
-                else:
-                    ob = getattr(self, prop_name)
-                    if ob:
-                        uri = ob.uri(base_uri)
-                if uri:
-                    if isinstance(spec, list):
-                        result[name] = [uri]
-                    else:
-                        result[name] = uri
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+                steps.append(_relation_uri_step(name, prop_name, as_list))
+        # dynamic relationships cannot be eagerly loaded
+        relations = [(reln, view_name) for (reln, view_name) in relations
+                     if reln.lazy not in ('dynamic', 'noload')]
 
+        defaults = []
         if local_view.get('_default') is not False:
             for name, col in cols.items():
                 if name in known:
                     continue  # already done
                 as_rel = reln_of_fkeys.get(frozenset((col, )))
                 if as_rel:
-                    name = as_rel.key
-                    if name in known:
+                    if as_rel.key in known:
                         continue
-                    else:
-                        ob_id = getattr(self, col.key)
-                        if ob_id:
-                            result[name] = as_rel.mapper.class_.uri_generic(
-                                ob_id, base_uri)
-                        else:
-                            result[name] = None
+                    defaults.append(
+                        (as_rel.key, col.key, as_rel.mapper.class_))
                 else:
-                    ob = getattr(self, name)
-                    if ob:
-                        if type(ob) == datetime:
-                            ob = ob.isoformat() + "Z"
-                        result[name] = ob
-                    else:
-                        result[name] = None
-        return result
+                    defaults.append((name, name, None))
+        return SerializationPlan(view_def, steps, defaults, relations)
+
+    @classmethod
+    def eager_loading_options(
+            cls, view_def_name='default', entity=None, max_depth=3):
+        """Return the loader options for the relationships that
+        :py:meth:`generic_json` will traverse with this view_def.
+
+        Collections are loaded with selectinload and scalar relations with
+        joinedload, so serializing the results of a query takes a fixed
+        number of statements, independent of the number of rows.
+        Relationships specific to subclasses are not covered.
+
+        :param entity: the class or alias that the query selects
+        :param max_depth: how many levels of nested view_defs to follow"""
+        if not get_view_def(view_def_name or 'default'):
+            return []
+        return list(_eager_loading_options(
+            cls, view_def_name, entity or cls, None, max_depth, frozenset()))
+
+    def generic_json(
+            self, view_def_name='default', user_id=None,
+            permissions=(P_READ, ), base_uri='local:'):
+        """Return a representation of this object as a JSON object,
+        according to the given view_def and access control."""
+        user_id = user_id or Everyone
+        if not self.user_can(user_id, CrudPermissions.READ, permissions):
+            return None
+        plan = self.__class__.get_serialization_plan(view_def_name)
+        return plan(self, user_id, permissions, base_uri)
 
     dummy_context = DummyContext()
 
+    view_def_method_relations = {}
+    """Maps method names used in view_defs (as ``&method``) to the
+    relationship they read, so :py:meth:`eager_loading_options` can
+    load it beforehand."""
+
     def locked_object_creation(
             self, object_generator, lock_table_cls=None, num_attempts=3):
         """Utility method to create objects as a side effect.
@@ -1785,11 +1959,10 @@ def before_commit_listener(session):
 def after_commit_listener(session):
     """After commit, actually send the Json representation of changed objects
     to the :py:mod:`assembl.processes.changes_router`, through 0MQ."""
-    if not getattr(session, 'zsocket', None):
-        session.zsocket = get_pub_socket()
     if getattr(session, 'cdict2', None):
+        socket = get_pub_socket()
         for discussion, changes in session.cdict2.iteritems():
-            send_changes(session.zsocket, discussion, changes)
+            send_changes(socket, discussion, changes)
         del session.cdict2
 
 
@@ -1811,6 +1984,33 @@ event.listen(BaseOps, 'after_update', orm_update_listener, propagate=True)
 event.listen(BaseOps, 'after_delete', orm_delete_listener, propagate=True)
 
 
+class FlushChanges(object):
+    """Changes noted by mapper events during a flush, in
+    ``session.info[key]``, and given to ``apply(session, changes)`` at the
+    end of the flush, in the same transaction. Changes still pending when
+    the transaction ends are forgotten."""
+
+    def __init__(self, key, apply):
+        self.key = key
+        self.apply = apply
+        event.listen(Session, 'after_flush_postexec', self.after_flush)
+        event.listen(Session, 'after_transaction_end', self.forget)
+
+    def note(self, target, change):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault(self.key, []).append(change)
+
+    def after_flush(self, session, flush_context):
+        changes = session.info.pop(self.key, None)
+        if changes:
+            self.apply(session, changes)
+
+    def forget(self, session, transaction):
+        if transaction.parent is None:
+            session.info.pop(self.key, None)
+
+
 def connection_url(settings, prefix='db_', read_only=False):
     db_host = settings.get(prefix + 'host', None)
     db_user = settings.get(prefix + 'user', None)
@@ -2,28 +2,53 @@
 from __future__ import print_function
 import atexit
 from itertools import count
+from collections import defaultdict
+from os import getpid
+from threading import local
 
+import simplejson as json
 import zmq
 import zmq.devices
 from time import sleep
 
-context = zmq.Context.instance()
-
 INTERNAL_SOCKET = 'inproc://assemblchanges'
 CHANGES_SOCKET = None
 MULTIPLEX = True
 INITED = False
 DISPATCHER = None
+# How long (in ms) a new publisher waits for the changes router
+READY_TIMEOUT = 200
 
 _counter = count()
 _active_sockets = []
+_publishers = local()
+_context = None
+_context_pid = None
+
+
+def get_context():
+    """The ZMQ context of the current process.
+
+    A context cannot be used across a fork, and Context.instance() does not
+    check the pid, so a forked process creates its own."""
+    global _context, _context_pid, INITED
+    if _context_pid != getpid():
+        _context = zmq.Context()
+        _context_pid = getpid()
+        # The dispatcher thread and the sockets belong to the parent
+        INITED = False
+        del _active_sockets[:]
+    return _context
 
 
 def start_dispatch_thread():
     global INITED, DISPATCHER
+    context = get_context()
     if INITED:
         return
     DISPATCHER = zmq.devices.ThreadDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
+    # inproc sockets only connect within the same context
+    DISPATCHER.context_factory = lambda: context
     DISPATCHER.bind_in(INTERNAL_SOCKET)
     DISPATCHER.connect_out(CHANGES_SOCKET)
     DISPATCHER.setsockopt_in(zmq.IDENTITY, 'XSUB')
@@ -43,28 +68,78 @@ def stop_sockets():
     INITED = False
 
 
-def get_pub_socket():
+def wait_for_subscriber(socket, timeout=READY_TIMEOUT):
+    """Wait until a subscription reaches this XPUB socket, i.e. until the
+    changes router is listening, so the first changes are not lost.
+
+    This is the "slow joiner" symptom:
+    http://zguide.zeromq.org/page:all#Getting-the-Message-Out
+    Gives up after timeout (in ms), e.g. when the router is not running."""
+    if socket.poll(timeout, zmq.POLLIN):
+        socket.recv()
+        return True
+    return False
+
+
+def _drain_subscriptions(socket):
+    # Later subscriptions (e.g. router restarts) would pile up otherwise
+    while socket.poll(0, zmq.POLLIN):
+        socket.recv()
+
+
+def create_pub_socket():
     if MULTIPLEX:
         start_dispatch_thread()
-    socket = context.socket(zmq.PUB)
+    # Like PUB, but receives the subscriptions, which tells us when
+    # the changes router is connected.
+    socket = get_context().socket(zmq.XPUB)
     if MULTIPLEX:
         socket.connect(INTERNAL_SOCKET)
     else:
         socket.connect(CHANGES_SOCKET)
     _active_sockets.append(socket)
-    # Related to "slow joiner" symptom
-    # http://zguide.zeromq.org/page:all#Getting-the-Message-Out
-    # It would be better to get the "ready" signal back but this is
-    # adequate for now.
-    sleep(0.2)
+    wait_for_subscriber(socket)
     return socket
 
 
+def get_pub_socket():
+    """The publisher socket of the current thread, connected once.
+
+    Sockets cannot be shared between threads, or kept across a fork."""
+    socket = getattr(_publishers, 'socket', None)
+    if socket is None or _publishers.pid != getpid() or socket.closed:
+        socket = _publishers.socket = create_pub_socket()
+        _publishers.pid = getpid()
+    else:
+        _drain_subscriptions(socket)
+    return socket
+
+
+def split_private_changes(changeset):
+    """Separate the changes visible to all from the changes addressed
+    to a single user through ``@private``, indexed by user URI."""
+    public = []
+    private = defaultdict(list)
+    for change in changeset:
+        if '@private' not in change:
+            public.append(change)
+        elif change['@private'] is not None:
+            private[change['@private']].append(change)
+    return public, private
+
+
 def send_changes(socket, discussion, changeset):
+    """Send a changeset to the changes router.
+
+    The frames are the discussion, the order, the public changes,
+    then the URI and the changes of each user with private changes;
+    so the router can forward them without decoding them."""
     order = _counter.next()
-    socket.send(discussion, zmq.SNDMORE)
-    socket.send(str(order), zmq.SNDMORE)
-    socket.send_json(changeset)
+    public, private = split_private_changes(changeset)
+    frames = [discussion, str(order), json.dumps(public)]
+    for user_uri, changes in private.iteritems():
+        frames.extend((bytes(user_uri), json.dumps(changes)))
+    socket.send_multipart(frames)
     print("sent", order, discussion, changeset)
 
 
@@ -377,6 +377,11 @@ from .section import Section  # noqa: E402, F401
 
 from .vote_session import VoteSession, VoteProposal  # noqa: E402, F401
 from .landing_page import LandingPageModuleType, LandingPageModule  # noqa: E402, F401
+from .path_utils import DiscussionGlobalData  # noqa: E402, F401
+from .idea_counters import IdeaCounters, IdeaUserCounters  # noqa: E402, F401
+from .idea_post_membership import IdeaPostMembership  # noqa: E402, F401
+from .idea_closure import IdeaClosure  # noqa: E402, F401
+from .read_posts import UserReadPosts  # noqa: E402, F401
 
 
 def includeme(config):
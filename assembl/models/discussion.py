@@ -219,15 +219,8 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         self.logo_url = url
 
     def read_post_ids(self, user_id):
-        from .post import Post
-        from .action import ViewPost
-        return (x[0] for x in self.db.query(Post.id).join(
-            ViewPost
-        ).filter(
-            Post.discussion_id == self.id,
-            ViewPost.actor_id == user_id,
-            ViewPost.post_id == Post.id
-        ))
+        from .read_posts import UserReadPosts
+        return UserReadPosts.all_post_ids(self.db, self.id, user_id)
 
     def get_read_posts_ids_preload(self, user_id):
         from .post import Post
@@ -422,12 +415,9 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         ).filter(Synthesis.discussion_id == self.id, condition)
 
     def get_permissions_by_role(self):
-        roleperms = self.db.query(Role.name, Permission.name).select_from(
-            DiscussionPermission).join(Role, Permission).filter(
-                DiscussionPermission.discussion_id == self.id).all()
-        roleperms.sort()
-        byrole = groupby(roleperms, lambda (r, p): r)
-        return {r: [p for (r2, p) in rps] for (r, rps) in byrole}
+        from ..auth.util import get_role_permissions
+        return {role: sorted(permissions) for (role, permissions)
+                in get_role_permissions(self.id).iteritems()}
 
     def get_roles_by_permission(self):
         permroles = self.db.query(Permission.name, Role.name).select_from(
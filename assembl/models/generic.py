@@ -278,6 +278,11 @@ class Content(TombstonableMixin, DiscussionBoundBase):
     message_classifier = Column(String(100), index=True,
                                 doc=docs.PostInterface.message_classifier)
 
+    view_def_method_relations = {
+        'get_subject': 'subject',
+        'get_body': 'body',
+    }
+
     def __init__(self, *args, **kwargs):
         if (kwargs.get('subject', None) is None and
                 kwargs.get('subject_id', None) is None):
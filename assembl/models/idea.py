@@ -64,7 +64,8 @@ class IdeaVisitor(object):
 
     The visit is started by :py:meth:`Idea.visit_ideas_depth_first`,
     :py:meth:`Idea.visit_ideas_breadth_first` or
-    :py:meth:`Idea.visit_idea_ids_depth_first`
+    :py:meth:`Idea.visit_idea_ids_depth_first`, which all walk the
+    :py:class:`DiscussionGraph` of the discussion.
 
     .. _Visitor: https://sourcemaking.com/design_patterns/visitor
     """
@@ -140,6 +141,126 @@ class WordCountVisitor(IdeaVisitor):
         return self.counter.best(num)
 
 
+class DiscussionGraph(object):
+    """A snapshot of the idea hierarchy of a discussion, as ids.
+
+    Holds the children and parents of each idea, in link order; the root
+    idea is the child of None. It is loaded with two queries, and cached
+    across requests by :py:meth:`Idea.discussion_graph`, so it must not be
+    modified. Visits of the idea tree run against it, rather than walking
+    the relationships of each idea."""
+
+    def __init__(self, root_id, links):
+        "links are (source_id, target_id) pairs, in order"
+        children = defaultdict(list)
+        parents = defaultdict(list)
+        for (source_id, target_id) in links:
+            children[source_id].append(target_id)
+            parents[target_id].append(source_id)
+        children[None] = [root_id]
+        self.root_id = root_id
+        self.children = dict(children)
+        self.parents = dict(parents)
+        self.parent_of = {
+            idea_id: parent_ids[0]
+            for (idea_id, parent_ids) in self.parents.iteritems()}
+
+    @classmethod
+    def load(cls, db, discussion_id):
+        """The live ideas and links of a discussion"""
+        idea_types = dict(db.query(Idea.id, Idea.sqla_type).filter_by(
+            discussion_id=discussion_id, tombstone_date=None))
+        links = db.query(IdeaLink.source_id, IdeaLink.target_id).join(
+            Idea, Idea.id == IdeaLink.source_id
+        ).filter(
+            Idea.discussion_id == discussion_id,
+            IdeaLink.tombstone_date == None,  # noqa: E711
+        ).order_by(IdeaLink.order)
+        (root_id,) = [id for (id, sqla_type) in idea_types.iteritems()
+                      if sqla_type == 'root_idea']
+        return cls(root_id, [
+            (source_id, target_id) for (source_id, target_id) in links
+            if source_id in idea_types and target_id in idea_types])
+
+    def descendant_ids(self, idea_id, inclusive=True):
+        """The ids of the ideas below this one, depth first"""
+        result = []
+        visited = set()
+        stack = [idea_id]
+        while stack:
+            idea_id = stack.pop()
+            if idea_id in visited:
+                continue
+            visited.add(idea_id)
+            result.append(idea_id)
+            stack.extend(reversed(self.children.get(idea_id, ())))
+        return result if inclusive else result[1:]
+
+    def visit_depth_first(self, idea_visitor, idea_id=None, ideas=None):
+        """Visit the ideas below idea_id (the root idea by default).
+
+        The visitor is given ids, or the values of the ideas dictionary
+        if provided; ideas missing from it are not visited, but their
+        children are."""
+        if idea_id is None:
+            idea_id = self.root_id
+        return self._visit_depth_first(
+            idea_visitor, idea_id, ideas, set(), 0, None)
+
+    def _visit_depth_first(
+            self, idea_visitor, idea_id, ideas, visited, level, prev_result):
+        if idea_id in visited:
+            # not necessary in a tree, but let's start to think graph.
+            return False
+        visited.add(idea_id)
+        idea = idea_id if ideas is None else ideas.get(idea_id, None)
+        result = None
+        if idea is not None:
+            result = idea_visitor.visit_idea(idea, level, prev_result)
+        child_results = []
+        if result is not IdeaVisitor.CUT_VISIT:
+            for child_id in self.children.get(idea_id, ()):
+                r = self._visit_depth_first(
+                    idea_visitor, child_id, ideas, visited, level + 1, result)
+                if r:
+                    child_results.append((
+                        child_id if ideas is None else ideas.get(child_id),
+                        r))
+        return idea_visitor.end_visit(idea, level, result, child_results)
+
+    def visit_breadth_first(self, idea_visitor, idea_id=None, ideas=None):
+        """Visit the ideas below idea_id level by level.
+        Parameters as in :py:meth:`visit_depth_first`."""
+        if idea_id is None:
+            idea_id = self.root_id
+        get = (lambda id: id) if ideas is None else ideas.get
+        result = idea_visitor.visit_idea(get(idea_id), 0, None)
+        if result is not IdeaVisitor.CUT_VISIT:
+            return self._visit_breadth_first(
+                idea_visitor, idea_id, get, {idea_id}, 1, result)
+
+    def _visit_breadth_first(
+            self, idea_visitor, idea_id, get, visited, level, prev_result):
+        children = []
+        result = True
+        child_results = []
+        for child_id in self.children.get(idea_id, ()):
+            if child_id in visited:
+                continue
+            child = get(child_id)
+            result = idea_visitor.visit_idea(child, level, prev_result)
+            visited.add(child_id)
+            if result != IdeaVisitor.CUT_VISIT:
+                children.append(child_id)
+                if result:
+                    child_results.append((child, result))
+        for child_id in children:
+            self._visit_breadth_first(
+                idea_visitor, child_id, get, visited, level + 1, result)
+        return idea_visitor.end_visit(
+            get(idea_id), level, prev_result, child_results)
+
+
 class Idea(HistoryMixin, DiscussionBoundBase):
     """
     An idea (or concept) distilled from the conversation flux.
@@ -335,6 +456,27 @@ class Idea(HistoryMixin, DiscussionBoundBase):
     def get_ancestors_query_cls(
             cls, target_id=bindparam('root_id', type_=Integer),
             inclusive=True, tombstone_date=None):
+        """The ids of the ancestors of an idea, or of a list of ideas."""
+        if tombstone_date is not None:
+            return cls._get_ancestors_by_links(
+                target_id, inclusive, tombstone_date)
+        from .idea_closure import IdeaClosure
+        if isinstance(target_id, (list, tuple)):
+            condition = IdeaClosure.descendant_id.in_(target_id)
+        else:
+            condition = (IdeaClosure.descendant_id == target_id)
+        if not inclusive:
+            condition = condition & (IdeaClosure.depth > 0)
+        select_exp = select([IdeaClosure.ancestor_id.label('id')]).where(
+            condition)
+        if isinstance(target_id, (list, tuple)):
+            select_exp = select_exp.distinct()
+        return select_exp.alias('ancestors')
+
+    @classmethod
+    def _get_ancestors_by_links(
+            cls, target_id, inclusive=True, tombstone_date=None):
+        # The closure only follows live links, walk the links of the past.
         if isinstance(target_id, list):
             root_condition = IdeaLink.target_id.in_(target_id)
         else:
@@ -386,11 +528,21 @@ class Idea(HistoryMixin, DiscussionBoundBase):
 
     def get_associated_phase(self):
         from .timeline import Phases, get_phase_by_identifier
-        query = self.get_ancestors_query(
-            tombstone_date=self.tombstone_date, subquery=True)
-        res = self.db.query(Idea).filter(Idea.id.in_(query)
-            ).join(Idea.discussion_phase
-            ).options(contains_eager(Idea.discussion_phase)).all()
+        if self.tombstone_date is None:
+            from .idea_closure import IdeaClosure
+            # closest ancestor with a phase first
+            res = self.db.query(Idea).join(
+                IdeaClosure, IdeaClosure.ancestor_id == Idea.id
+                ).filter(IdeaClosure.descendant_id == self.id
+                ).join(Idea.discussion_phase
+                ).options(contains_eager(Idea.discussion_phase)
+                ).order_by(IdeaClosure.depth).all()
+        else:
+            query = self.get_ancestors_query(
+                tombstone_date=self.tombstone_date, subquery=True)
+            res = self.db.query(Idea).filter(Idea.id.in_(query)
+                ).join(Idea.discussion_phase
+                ).options(contains_eager(Idea.discussion_phase)).all()
         root_idea = res[0] if res else None
         if root_idea:
             return root_idea.discussion_phase
@@ -401,40 +553,31 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         from .announcement import IdeaAnnouncement
         if self.announcement:
             return self.announcement
-        aq = self.get_ancestors_query()
+        from .idea_closure import IdeaClosure
         announcements = self.db.query(IdeaAnnouncement
-            ).filter(IdeaAnnouncement.idea_id.in_(aq),
+            ).join(IdeaClosure, IdeaClosure.ancestor_id == IdeaAnnouncement.idea_id
+            ).filter(IdeaClosure.descendant_id == self.id,
                      IdeaAnnouncement.should_propagate_down == True  # noqa: E712
-            ).all()
-        # assume order is preserved from aq...
-        if announcements:
-            return announcements[-1]
+            ).order_by(IdeaClosure.depth)
+        # from the closest ancestor
+        return announcements.first()
 
     @classmethod
     def get_descendants_query_cls(
             cls, root_idea_id=bindparam('root_idea_id', type_=Integer),
             inclusive=True):
-        link = select(
-            [IdeaLink.source_id, IdeaLink.target_id]
-            ).select_from(
-                IdeaLink
-            ).where(
-                (IdeaLink.tombstone_date == None) & (IdeaLink.source_id == root_idea_id)  # noqa: E711
-            ).cte(recursive=True)
-        source_alias = aliased(link)
-        targets_alias = aliased(IdeaLink)
-        parent_link = targets_alias.source_id == source_alias.c.target_id
-        children = select(
-            [targets_alias.source_id, targets_alias.target_id]
-            ).select_from(targets_alias).where(parent_link & (targets_alias.tombstone_date == None))  # noqa: E711
-        with_children = link.union(children)
-        select_exp = select([with_children.c.target_id.label('id')]
-            ).select_from(with_children)
-        if inclusive:
-            if isinstance(root_idea_id, int):
-                root_idea_id = literal_column(str(root_idea_id), Integer)
-            select_exp = select_exp.union(
-                select([root_idea_id.label('id')]))
+        """The ids of the descendants of an idea, or of a list of ideas."""
+        from .idea_closure import IdeaClosure
+        if isinstance(root_idea_id, (list, tuple)):
+            condition = IdeaClosure.ancestor_id.in_(root_idea_id)
+        else:
+            condition = (IdeaClosure.ancestor_id == root_idea_id)
+        if not inclusive:
+            condition = condition & (IdeaClosure.depth > 0)
+        select_exp = select([IdeaClosure.descendant_id.label('id')]).where(
+            condition)
+        if isinstance(root_idea_id, (list, tuple)):
+            select_exp = select_exp.distinct()
         return select_exp.alias('descendants')
 
     def get_descendants_query(
@@ -475,7 +618,8 @@ class Idea(HistoryMixin, DiscussionBoundBase):
             cls, discussion_id, root_idea_id, partial=False,
             include_deleted=False, include_moderating=None, user_id=None):
         from .generic import Content
-        counters = cls.prepare_counters(discussion_id)
+        from .idea_post_membership import IdeaPostMembership
+        from .path_utils import related_content_query
         discussion_data = cls.get_discussion_data(discussion_id)
         if include_moderating is None:
             include_moderating = discussion_data.include_moderating
@@ -483,15 +627,20 @@ class Idea(HistoryMixin, DiscussionBoundBase):
             user_id = user_id or discussion_data.user_id
         if user_id == Everyone:
             user_id = None
+        db = cls.default_db()
         if partial:
-            return counters.paths[root_idea_id].as_clause_base(
-                cls.default_db(), include_deleted=include_deleted,
+            return IdeaPostMembership.related_posts_subquery(
+                db, root_idea_id, include_deleted=include_deleted,
                 include_moderating=include_moderating, user_id=user_id)
-        else:
-            return counters.paths[root_idea_id].as_clause(
-                cls.default_db(), discussion_id, counters.user_id, Content,
-                include_deleted=include_deleted,
-                include_moderating=include_moderating)
+        subq = IdeaPostMembership.related_posts_subquery(
+            db, root_idea_id, include_deleted=include_deleted,
+            include_moderating=include_moderating,
+            user_id=user_id if include_moderating else None)
+        viewer_id = discussion_data.user_id
+        if viewer_id == Everyone:
+            viewer_id = None
+        return related_content_query(
+            db, subq, discussion_id, viewer_id, Content)
 
     def top_keywords(
             self, limit=30, group=True, display_lang='en', filter_lang=None):
@@ -579,7 +728,8 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         discussion_data = None
         if req:
             discussion_data = getattr(req, "discussion_data", None)
-        if not discussion_data:
+        if not discussion_data or \
+                discussion_data.discussion_id != discussion_id:
             discussion_data = DiscussionGlobalData(
                 cls.default_db(), discussion_id,
                 req.authenticated_userid if req else None)
@@ -628,139 +778,76 @@ class Idea(HistoryMixin, DiscussionBoundBase):
 
     @property
     def num_posts(self):
-        counters = self.prepare_counters(self.discussion_id)
-        return counters.get_counts(self.id)[0]
+        return self.num_total_and_read_posts[0]
 
     @property
     def num_contributors(self):
-        counters = self.prepare_counters(self.discussion_id)
-        return counters.get_counts(self.id)[1]
+        return self.num_total_and_read_posts[1]
 
     @property
     def num_read_posts(self):
-        counters = self.prepare_counters(self.discussion_id)
-        return counters.get_counts(self.id)[2]
+        return self.num_total_and_read_posts[2]
 
     @property
     def num_total_and_read_posts(self):
-        counters = self.prepare_counters(self.discussion_id)
-        return counters.get_counts(self.id)
+        "Post, contributor and read post counts, kept in IdeaCounters"
+        discussion_data = self.get_discussion_data(self.discussion_id)
+        return discussion_data.idea_counts(self.id)
 
     def prefetch_descendants(self):
-        # TODO maparent: descendants only. Let's just prefetch all ideas.
-        ideas = self.db.query(Idea).filter_by(
-            discussion_id=self.discussion_id, tombstone_date=None).all()
-        ideas_by_id = {idea.id: idea for idea in ideas}
-        children_id_dict = self.children_dict(self.discussion_id)
-        return {
-            id: [ideas_by_id[child_id] for child_id in child_ids]
-            for (id, child_ids) in children_id_dict.iteritems()
-        }
+        """dictionary idea.id -> idea, for this idea and those below it,
+        loaded in a single query."""
+        graph = self.discussion_graph(self.discussion_id)
+        query = self.db.query(Idea)
+        if self.id == graph.root_id:
+            query = query.filter_by(
+                discussion_id=self.discussion_id, tombstone_date=None)
+        else:
+            query = query.filter(Idea.id.in_(graph.descendant_ids(self.id)))
+        ideas_by_id = {idea.id: idea for idea in query}
+        ideas_by_id[self.id] = self
+        return ideas_by_id
 
     def visit_ideas_depth_first(self, idea_visitor):
-        children_dict = self.prefetch_descendants()
-        return self._visit_ideas_depth_first(idea_visitor, set(), 0, None, children_dict)
+        return self.discussion_graph(self.discussion_id).visit_depth_first(
+            idea_visitor, self.id, self.prefetch_descendants())
 
-    def _visit_ideas_depth_first(
-            self, idea_visitor, visited, level, prev_result, children_dict):
-        if self in visited:
-            # not necessary in a tree, but let's start to think graph.
-            return False
-        result = idea_visitor.visit_idea(self, level, prev_result)
-        visited.add(self)
-        child_results = []
-        if result is not IdeaVisitor.CUT_VISIT:
-            for child in children_dict.get(self.id, ()):
-                r = child._visit_ideas_depth_first(
-                    idea_visitor, visited, level + 1, result, children_dict)
-                if r:
-                    child_results.append((child, r))
-        return idea_visitor.end_visit(self, level, result, child_results)
+    @classmethod
+    def discussion_graph(cls, discussion_id):
+        """The :py:class:`DiscussionGraph` of the discussion.
+
+        Cached across requests; do not modify it."""
+        from .path_utils import structure_cache, HIERARCHY
+        return structure_cache.get(
+            cls.default_db, discussion_id, HIERARCHY,
+            lambda: DiscussionGraph.load(cls.default_db, discussion_id))
 
     @classmethod
     def children_dict(cls, discussion_id):
-        # We do not want a subclass
-        cls = [c for c in cls.mro() if c.__name__ == "Idea"][0]
-        source = aliased(cls, name="source")
-        target = aliased(cls, name="target")
-        link_info = list(cls.default_db.query(
-            IdeaLink.target_id, IdeaLink.source_id
-        ).join(source, source.id == IdeaLink.source_id
-        ).join(target, target.id == IdeaLink.target_id
-        ).filter(
-            source.discussion_id == discussion_id,
-            IdeaLink.tombstone_date == None,  # noqa: E711
-            source.tombstone_date == None,  # noqa: E711
-            target.tombstone_date == None,  # noqa: E711
-            target.discussion_id == discussion_id
-        ).order_by(IdeaLink.order))
-        if not link_info:
-            (root_id,) = cls.default_db.query(
-                RootIdea.id).filter_by(discussion_id=discussion_id).first()
-            return {None: (root_id,), root_id: ()}
-        child_nodes = {child for (child, parent) in link_info}
-        children_of = defaultdict(list)
-        for (child, parent) in link_info:
-            children_of[parent].append(child)
-        root = set(children_of.keys()) - child_nodes
-        assert len(root) == 1
-        children_of[None] = [root.pop()]
-        return children_of
+        """dictionary parent_idea.id -> [child_idea.id], in order.
+        The root idea is the child of None.
+
+        Cached across requests; do not modify it."""
+        return cls.discussion_graph(discussion_id).children
 
     @classmethod
-    def visit_idea_ids_depth_first(
-            cls, idea_visitor, discussion_id, children_dict=None):
-        # Lightweight descent
-        if children_dict is None:
-            children_dict = cls.children_dict(discussion_id)
-        root_id = children_dict[None][0]
-        return cls._visit_idea_ids_depth_first(
-            root_id, idea_visitor, children_dict, set(), 0, None)
+    def parent_dict(cls, discussion_id):
+        """dictionary child_idea.id -> parent_idea.id.
+
+        Cached across requests; do not modify it."""
+        return cls.discussion_graph(discussion_id).parent_of
 
     @classmethod
-    def _visit_idea_ids_depth_first(
-            cls, idea_id, idea_visitor, children_dict, visited,
-            level, prev_result):
-        if idea_id in visited:
-            # not necessary in a tree, but let's start to think graph.
-            return False
-        result = idea_visitor.visit_idea(idea_id, level, prev_result)
-        visited.add(idea_id)
-        child_results = []
-        if result is not IdeaVisitor.CUT_VISIT:
-            for child_id in children_dict[idea_id]:
-                r = cls._visit_idea_ids_depth_first(
-                    child_id, idea_visitor, children_dict, visited, level + 1, result)
-                if r:
-                    child_results.append((child_id, r))
-        return idea_visitor.end_visit(idea_id, level, result, child_results)
+    def visit_idea_ids_depth_first(
+            cls, idea_visitor, discussion_id, graph=None):
+        # Lightweight descent
+        if graph is None:
+            graph = cls.discussion_graph(discussion_id)
+        return graph.visit_depth_first(idea_visitor)
 
     def visit_ideas_breadth_first(self, idea_visitor):
-        self.prefetch_descendants()
-        result = idea_visitor.visit_idea(self, 0, None)
-        visited = {self}
-        if result is not IdeaVisitor.CUT_VISIT:
-            return self._visit_ideas_breadth_first(
-                idea_visitor, visited, 1, result)
-
-    def _visit_ideas_breadth_first(
-            self, idea_visitor, visited, level, prev_result):
-        children = []
-        result = True
-        child_results = []
-        for child in self.get_children():
-            if child in visited:
-                continue
-            result = idea_visitor.visit_idea(child, level, prev_result)
-            visited.add(child)
-            if result != IdeaVisitor.CUT_VISIT:
-                children.append(child)
-                if result:
-                    child_results.append((child, result))
-        for child in children:
-            child._visit_ideas_breadth_first(
-                idea_visitor, visited, level + 1, result)
-        return idea_visitor.end_visit(self, level, prev_result, child_results)
+        return self.discussion_graph(self.discussion_id).visit_breadth_first(
+            idea_visitor, self.id, self.prefetch_descendants())
 
     def most_common_words(self, lang=None, num=8):
         if lang:
@@ -892,47 +979,75 @@ class Idea(HistoryMixin, DiscussionBoundBase):
     @classmethod
     def get_idea_ids_showing_post(cls, post_id):
         "Given a post, give the ID of the ideas that show this message"
+        return cls.get_idea_ids_showing_posts([post_id]).get(post_id, [])
+
+    @classmethod
+    def get_idea_ids_showing_posts(cls, post_ids):
+        """Given posts, give the ID of the ideas that show each message,
+        by post ID."""
         from sqlalchemy.sql.functions import func
         from .idea_content_link import IdeaContentPositiveLink
         from .post import Post
-        (ancestry, discussion_id, idea_link_ids) = cls.default_db.query(
-            Post.ancestry, Post.discussion_id,
+        if not post_ids:
+            return {}
+        posts = cls.default_db.query(
+            Post.id, Post.ancestry, Post.discussion_id,
             func.idea_content_links_above_post(Post.id)
-            ).filter(Post.id == post_id).first()
-        post_path = "%s%d," % (ancestry, post_id)
-        if not idea_link_ids:
-            return []
-        idea_link_ids = [int(id) for id in idea_link_ids.split(',') if id]
+            ).filter(Post.id.in_(post_ids)).all()
+        links_by_post = {}
+        for (post_id, ancestry, discussion_id, idea_link_ids) in posts:
+            links_by_post[post_id] = [
+                int(id) for id in (idea_link_ids or '').split(',') if id]
+        all_link_ids = set(chain(*links_by_post.values()))
+        if not all_link_ids:
+            return {post_id: [] for post_id in post_ids}
         # This could be combined with previous in postgres.
-        root_ideas = cls.default_db.query(
-            IdeaContentPositiveLink.idea_id.distinct()
+        root_idea_by_link = dict(cls.default_db.query(
+            IdeaContentPositiveLink.id, IdeaContentPositiveLink.idea_id
             ).filter(
                 IdeaContentPositiveLink.idea_id != None,  # noqa: E711
-                IdeaContentPositiveLink.id.in_(idea_link_ids)).all()
-        if not root_ideas:
-            return []
-        root_ideas = [x for (x,) in root_ideas]
-        discussion_data = cls.get_discussion_data(discussion_id)
-        counter = cls.prepare_counters(discussion_id)
-        idea_contains = {}
-        for root_idea_id in root_ideas:
-            for idea_id in discussion_data.idea_ancestry(root_idea_id):
-                if idea_id in idea_contains:
-                    break
-                idea_contains[idea_id] = counter.paths[idea_id].includes_post(post_path)
-        ideas = [id for (id, incl) in idea_contains.iteritems() if incl]
-        return ideas
+                IdeaContentPositiveLink.id.in_(all_link_ids)))
+        result = {post_id: [] for post_id in post_ids}
+        for (post_id, ancestry, discussion_id, _) in posts:
+            root_ideas = {
+                root_idea_by_link[link_id]
+                for link_id in links_by_post[post_id]
+                if link_id in root_idea_by_link}
+            if not root_ideas:
+                continue
+            post_path = "%s%d," % (ancestry, post_id)
+            discussion_data = cls.get_discussion_data(discussion_id)
+            counter = cls.prepare_counters(discussion_id)
+            idea_contains = {}
+            for root_idea_id in root_ideas:
+                for idea_id in discussion_data.idea_ancestry(root_idea_id):
+                    if idea_id in idea_contains:
+                        break
+                    idea_contains[idea_id] = counter.paths[
+                        idea_id].includes_post(post_path)
+            result[post_id] = [
+                id for (id, incl) in idea_contains.iteritems() if incl]
+        return result
 
     @classmethod
     def idea_read_counts(cls, discussion_id, post_id, user_id):
         """Given a post and a user, give the total and read count
             of posts for each affected idea"""
-        idea_ids = cls.get_idea_ids_showing_post(post_id)
-        if not idea_ids:
-            return []
-        ideas = cls.default_db.query(cls).filter(cls.id.in_(idea_ids))
-        return [(idea.id, idea.num_read_posts)
-                for idea in ideas]
+        return cls.idea_read_counts_by_post(
+            discussion_id, [post_id], user_id)[post_id]
+
+    @classmethod
+    def idea_read_counts_by_post(cls, discussion_id, post_ids, user_id):
+        """Given posts and a user, give the read count of posts
+            for each affected idea, by post ID"""
+        idea_ids_by_post = cls.get_idea_ids_showing_posts(post_ids)
+        discussion_data = cls.get_discussion_data(discussion_id)
+        discussion_data.prefetch_idea_counts(
+            set(chain(*idea_ids_by_post.values())))
+        return {
+            post_id: [(idea_id, discussion_data.idea_counts(idea_id)[2])
+                      for idea_id in idea_ids]
+            for (post_id, idea_ids) in idea_ids_by_post.items()}
 
     def get_widget_creation_urls(self):
         from .widgets import GeneratedIdeaWidgetLink
@@ -1294,16 +1409,15 @@ class RootIdea(Idea):
     def num_read_posts(self):
         """ In the root idea, num_read_posts is the count of all non-deleted read mesages in the discussion """
         from .post import Post, countable_publication_states
-        from .action import ViewPost
+        from .read_posts import UserReadPosts
         discussion_data = self.get_discussion_data(self.discussion_id)
         result = self.db.query(Post).filter(
             Post.publication_state.in_(countable_publication_states),
             Post.discussion_id == self.discussion_id,
             Post.hidden == False,  # noqa: E712
-            Post.tombstone_condition()
-        ).join(
-            ViewPost,
-            (ViewPost.post_id == Post.id) & (ViewPost.tombstone_date == None) & (ViewPost.actor_id == discussion_data.user_id)
+            Post.tombstone_condition(),
+            UserReadPosts.is_read_clause(
+                self.db, self.discussion_id, discussion_data.user_id, Post.id)
         ).count()
         return int(result)
 
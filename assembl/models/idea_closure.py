@@ -0,0 +1,127 @@
+"""Transitive closure of the idea hierarchy.
+
+Every idea is its own ancestor at depth 0, and its parents' ancestors at
+depth + 1, following the live :py:class:`.idea.IdeaLink`. This allows to
+find the ancestors or descendants of many ideas with a simple indexed
+query, instead of walking the links with a recursive query."""
+from sqlalchemy import Column, Integer, ForeignKey, event, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import literal_column
+
+from ..lib.sqla import Base, FlushChanges
+from .idea import Idea, IdeaLink
+from .path_utils import attribute_changed
+
+# Guards against cycles in the links
+MAX_DEPTH = 100
+
+class IdeaClosure(Base):
+    """An (ancestor, descendant) pair of ideas, with the length of the
+    shortest path of live links between them."""
+    __tablename__ = 'idea_closure'
+    ancestor_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True, index=True)
+    depth = Column(Integer, nullable=False)
+
+    @classmethod
+    def ancestors_by_idea(cls, db, idea_ids, inclusive=True):
+        """The ancestor ids of each idea, closest first."""
+        q = db.query(cls.descendant_id, cls.ancestor_id).filter(
+            cls.descendant_id.in_(idea_ids)).order_by(
+            cls.descendant_id, cls.depth)
+        if not inclusive:
+            q = q.filter(cls.depth > 0)
+        result = {id: [] for id in idea_ids}
+        for (idea_id, ancestor_id) in q:
+            result[idea_id].append(ancestor_id)
+        return result
+
+
+def add_idea_closure(db, idea_ids):
+    "Make new ideas their own ancestors"
+    if idea_ids:
+        db.execute(IdeaClosure.__table__.insert(), [
+            dict(ancestor_id=id, descendant_id=id, depth=0)
+            for id in idea_ids])
+
+
+def add_link_closure(db, source_id, target_id):
+    "Connect the ancestors of the source to the descendants of the target"
+    above = aliased(IdeaClosure)
+    below = aliased(IdeaClosure)
+    table = IdeaClosure.__table__
+    query = select([
+        above.ancestor_id, below.descendant_id,
+        above.depth + below.depth + 1]).where(
+        (above.descendant_id == source_id) & (below.ancestor_id == target_id))
+    stmt = insert(table).from_select(
+        ['ancestor_id', 'descendant_id', 'depth'], query)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.ancestor_id, table.c.descendant_id],
+        set_=dict(depth=func.least(table.c.depth, stmt.excluded.depth))))
+
+
+def rebuild_idea_closure(db, discussion_id):
+    """Compute again the closure of the ideas of a discussion."""
+    table = IdeaClosure.__table__
+    idea_ids = select([Idea.id]).where(Idea.discussion_id == discussion_id)
+    db.execute(table.delete().where(table.c.descendant_id.in_(idea_ids)))
+    paths = select([
+        Idea.id.label('ancestor_id'), Idea.id.label('descendant_id'),
+        literal_column('0', Integer).label('depth')]).where(
+        Idea.discussion_id == discussion_id).cte(recursive=True)
+    step = select([
+        paths.c.ancestor_id, IdeaLink.target_id, paths.c.depth + 1]).where(
+        (IdeaLink.source_id == paths.c.descendant_id) &
+        (IdeaLink.tombstone_date == None) &  # noqa: E711
+        (paths.c.depth < MAX_DEPTH))
+    paths = paths.union(step)
+    db.execute(table.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select([paths.c.ancestor_id, paths.c.descendant_id,
+                func.min(paths.c.depth)]).group_by(
+            paths.c.ancestor_id, paths.c.descendant_id)))
+
+
+# Changes are noted during the flush, and applied at the end of the flush,
+# so queries in the same transaction see the new hierarchy.
+
+def _apply_changes(session, changes):
+    rebuilds = {id for (kind, id, _) in changes if kind == 'discussion'}
+    add_idea_closure(session, [
+        id for (kind, id, _) in changes if kind == 'idea'])
+    for (kind, source_id, target_id) in changes:
+        if kind == 'link':
+            add_link_closure(session, source_id, target_id)
+    for discussion_id in rebuilds:
+        rebuild_idea_closure(session, discussion_id)
+
+
+def _idea_inserted(mapper, connection, target):
+    _changes.note(target, ('idea', target.id, None))
+
+
+def _link_inserted(mapper, connection, target):
+    if target.tombstone_date is None:
+        _changes.note(target, ('link', target.source_id, target.target_id))
+
+
+def _link_changed(mapper, connection, target):
+    # Removing paths is not local when there are many parents
+    _changes.note(target, ('discussion', target.get_discussion_id(), None))
+
+
+def _link_updated(mapper, connection, target):
+    if attribute_changed(target, 'source_id', 'target_id', 'tombstone_date'):
+        _link_changed(mapper, connection, target)
+
+
+_changes = FlushChanges('idea_closure_changes', _apply_changes)
+event.listen(Idea, 'after_insert', _idea_inserted, propagate=True)
+event.listen(IdeaLink, 'after_insert', _link_inserted, propagate=True)
+event.listen(IdeaLink, 'after_update', _link_updated, propagate=True)
+event.listen(IdeaLink, 'after_delete', _link_changed, propagate=True)
@@ -0,0 +1,414 @@
+"""Persistent post and contributor counts of ideas.
+
+Computing the posts of an idea means combining the idea-content links of
+the idea and its descendants (see :py:mod:`.path_utils`), which is costly.
+Those counts are stored for every idea, and kept up to date incrementally
+when posts are published, moderated, moved, deleted or read. When the
+content links or the idea hierarchy change, the counts of the affected
+ideas and their ancestors are computed again, in the same transaction.
+
+Changes to the counters of a discussion take a transaction-level advisory
+lock, so a computation never misses an increment committed meanwhile."""
+from sqlalchemy import (
+    Column, Integer, ForeignKey, event, func, inspect, literal, select)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.functions import count
+from pyramid.threadlocal import get_current_request
+
+from ..lib.sqla import Base, FlushChanges
+from .auth import AgentProfile
+from .discussion import Discussion
+from .post import Post, countable_publication_states
+from .idea import Idea, IdeaLink
+from .idea_content_link import IdeaContentLink
+from .idea_closure import IdeaClosure
+from .idea_post_membership import IdeaPostMembership, has_descendants
+from .action import ViewPost
+from .read_posts import UserReadPosts
+from .path_utils import attribute_changed
+
+
+class IdeaCounters(Base):
+    """The number of posts and contributors of an idea."""
+    __tablename__ = 'idea_counters'
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    num_posts = Column(Integer, nullable=False, default=0)
+    num_contributors = Column(Integer, nullable=False, default=0)
+
+
+class IdeaUserCounters(Base):
+    """The number of posts of an idea written and read by a user.
+
+    Complete for each idea that has an :py:class:`IdeaCounters` row."""
+    __tablename__ = 'idea_user_counters'
+    idea_id = Column(Integer, ForeignKey(
+        IdeaCounters.idea_id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    user_id = Column(Integer, ForeignKey(
+        AgentProfile.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True, index=True)
+    num_posts = Column(Integer, nullable=False, default=0)
+    num_read_posts = Column(Integer, nullable=False, default=0)
+
+
+def load_idea_counts(db, discussion_id, user_id=None):
+    """Stored (num_posts, num_contributors, num_read_posts) of the ideas
+    of the discussion, by idea id."""
+    q = db.query(
+        IdeaCounters.idea_id, IdeaCounters.num_posts,
+        IdeaCounters.num_contributors, IdeaUserCounters.num_read_posts
+    ).outerjoin(
+        IdeaUserCounters,
+        (IdeaUserCounters.idea_id == IdeaCounters.idea_id) &
+        (IdeaUserCounters.user_id == user_id)
+    ).filter(IdeaCounters.discussion_id == discussion_id)
+    return {
+        idea_id: (num_posts, num_contributors, num_read_posts or 0)
+        for (idea_id, num_posts, num_contributors, num_read_posts) in q}
+
+
+# First key of the advisory locks of idea counters, the second being the
+# discussion id
+IDEA_COUNTERS_LOCK = 0x1dea
+
+
+def lock_idea_counts(db, discussion_ids):
+    """Lock the counters of these discussions until the end of the
+    transaction. Always in the same order, to avoid deadlocks."""
+    for discussion_id in sorted(set(discussion_ids)):
+        db.execute(select([func.pg_advisory_xact_lock(
+            IDEA_COUNTERS_LOCK, discussion_id)]))
+
+
+def compute_idea_counts(db, discussion_id, idea_ids, user_id=None):
+    """Compute the counts of these ideas, without storing them.
+
+    Returns (num_posts, num_contributors, num_read_posts) by idea id."""
+    counter = Idea.prepare_counters(discussion_id)
+    result = {}
+    for idea_id in idea_ids:
+        posts_by_creator, read_by_user = counter.get_counts_by_user(idea_id)
+        num_posts = sum(posts_by_creator.itervalues())
+        posts_by_creator.pop(None, None)
+        result[idea_id] = (
+            num_posts, len(posts_by_creator), read_by_user.get(user_id, 0))
+    return result
+
+
+def store_idea_counts(db, discussion_id, idea_ids=None):
+    """Compute again and store the counts of these ideas, or of all the
+    ideas of the discussion. The counters must be locked."""
+    delete = IdeaCounters.__table__.delete()
+    if idea_ids is None:
+        db.execute(delete.where(IdeaCounters.discussion_id == discussion_id))
+        idea_ids = [id for (id,) in db.query(Idea.id).filter_by(
+            discussion_id=discussion_id, tombstone_date=None)]
+    elif idea_ids:
+        db.execute(delete.where(IdeaCounters.idea_id.in_(idea_ids)))
+        idea_ids = [id for (id,) in db.query(Idea.id).filter(
+            Idea.id.in_(idea_ids), Idea.tombstone_date == None)]  # noqa: E711
+    if not idea_ids:
+        return
+    # The hierarchy and content links may have changed in this request
+    discussion_data = Idea.get_discussion_data(discussion_id)
+    discussion_data.reset_hierarchy()
+    discussion_data.reset_content_links()
+    counter = Idea.prepare_counters(discussion_id)
+    counters = []
+    user_counters = []
+    for idea_id in idea_ids:
+        posts_by_creator, read_by_user = counter.get_counts_by_user(idea_id)
+        num_posts = sum(posts_by_creator.itervalues())
+        posts_by_creator.pop(None, None)
+        counters.append(dict(
+            idea_id=idea_id, discussion_id=discussion_id,
+            num_posts=num_posts, num_contributors=len(posts_by_creator)))
+        user_counters.extend(
+            dict(idea_id=idea_id, user_id=uid,
+                 num_posts=posts_by_creator.get(uid, 0),
+                 num_read_posts=read_by_user.get(uid, 0))
+            for uid in set(posts_by_creator) | set(read_by_user))
+    db.execute(IdeaCounters.__table__.insert(), counters)
+    if user_counters:
+        db.execute(IdeaUserCounters.__table__.insert(), user_counters)
+
+
+def rebuild_idea_counts(db, discussion_id):
+    """Compute again the counts of all ideas of a discussion."""
+    lock_idea_counts(db, [discussion_id])
+    store_idea_counts(db, discussion_id)
+
+
+def _add_to_user_counters(db, user_query, num_posts=0, num_read_posts=0):
+    """Add to the user counters of (idea_id, user_id) pairs given by
+    the query. Creates missing rows."""
+    table = IdeaUserCounters.__table__
+    stmt = insert(table).from_select(
+        ['idea_id', 'user_id', 'num_posts', 'num_read_posts'],
+        user_query.add_columns(
+            literal(num_posts), literal(num_read_posts)).statement)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['idea_id', 'user_id'],
+        set_=dict(
+            num_posts=table.c.num_posts + stmt.excluded.num_posts,
+            num_read_posts=(
+                table.c.num_read_posts + stmt.excluded.num_read_posts))))
+
+
+def _update_contributors(db, idea_ids):
+    contributors = db.query(count(IdeaUserCounters.user_id)).filter(
+        IdeaUserCounters.idea_id == IdeaCounters.idea_id,
+        IdeaUserCounters.num_posts > 0).as_scalar()
+    db.query(IdeaCounters).filter(IdeaCounters.idea_id.in_(idea_ids)).update(
+        {IdeaCounters.num_contributors: contributors},
+        synchronize_session=False)
+
+
+def _counted_posts(db, post_ids):
+    return {id for (id,) in db.query(Post.id).filter(
+        Post.id.in_(post_ids), Post.hidden == False,  # noqa: E712
+        Post.publication_state.in_(countable_publication_states))}
+
+
+def apply_post_change(db, post_id, creator_id, delta, idea_ids=None):
+    """A post is counted (delta=1) or not anymore (delta=-1).
+
+    idea_ids are the ideas that show the post, if already known."""
+    if idea_ids is None:
+        idea_ids = Idea.get_idea_ids_showing_post(post_id)
+    if not idea_ids:
+        return
+    db.query(IdeaCounters).filter(IdeaCounters.idea_id.in_(idea_ids)).update(
+        {IdeaCounters.num_posts: IdeaCounters.num_posts + delta},
+        synchronize_session=False)
+    stored = db.query(IdeaCounters.idea_id).filter(
+        IdeaCounters.idea_id.in_(idea_ids))
+    _add_to_user_counters(
+        db, stored.add_columns(literal(creator_id)), num_posts=delta)
+    _update_contributors(db, idea_ids)
+    # Users who had already read it
+    _add_to_user_counters(db, stored.add_columns(UserReadPosts.user_id).filter(
+        UserReadPosts.discussion_id == IdeaCounters.discussion_id,
+        UserReadPosts.post_ids.any(post_id)),
+        num_read_posts=delta)
+
+
+def apply_read_change(db, post_id, user_id, delta):
+    """A user read a post (delta=1) or marked it unread (delta=-1)."""
+    if _counted_posts(db, [post_id]):
+        _apply_read_change(
+            db, post_id, user_id, delta,
+            Idea.get_idea_ids_showing_post(post_id))
+
+
+def apply_read_changes(db, reads):
+    """Users read posts or marked them unread, as a list of
+    (post_id, user_id, delta)."""
+    if not reads:
+        return
+    post_ids = {post_id for (post_id, _, _) in reads}
+    idea_ids = Idea.get_idea_ids_showing_posts(post_ids)
+    counted = _counted_posts(db, post_ids)
+    for (post_id, user_id, delta) in reads:
+        if post_id in counted:
+            _apply_read_change(db, post_id, user_id, delta, idea_ids[post_id])
+
+
+def _apply_read_change(db, post_id, user_id, delta, idea_ids):
+    if not idea_ids:
+        return
+    _add_to_user_counters(db, db.query(IdeaCounters.idea_id).filter(
+        IdeaCounters.idea_id.in_(idea_ids)).add_columns(literal(user_id)),
+        num_read_posts=delta)
+
+
+def recompute_idea_counts(db, discussion_id, idea_ids):
+    """Compute again the counts of these ideas and their ancestors.
+    The counters must be locked."""
+    ancestors = IdeaClosure.ancestors_by_idea(db, idea_ids)
+    idea_ids = set(idea_ids)
+    for ids in ancestors.itervalues():
+        idea_ids.update(ids)
+    store_idea_counts(db, discussion_id, idea_ids)
+
+
+def apply_post_move(db, post_id, creator_id, old_idea_ids, idea_ids):
+    """A counted post without descendants is shown by other ideas."""
+    old_idea_ids = set(old_idea_ids)
+    idea_ids = set(idea_ids)
+    apply_post_change(db, post_id, creator_id, -1, old_idea_ids - idea_ids)
+    apply_post_change(db, post_id, creator_id, 1, idea_ids - old_idea_ids)
+
+
+# Changes are noted during the flush, and applied to the counters at the
+# end of the flush, in the same transaction.
+
+def _apply_changes(session, changes):
+    stale = {change[1:] for change in changes if change[0] == 'stale'}
+    moves = [change[1:] for change in changes if change[0] == 'moved']
+    post_ids = {change[1] for change in changes
+                if change[0] in ('post', 'read')}
+    discussion_ids = {discussion_id for (discussion_id, _) in stale}
+    discussion_ids.update(move[0] for move in moves)
+    if post_ids:
+        discussion_ids.update(id for (id,) in session.query(
+            Post.discussion_id).filter(Post.id.in_(post_ids)).distinct())
+    lock_idea_counts(session, discussion_ids)
+    # Bulk imports and reads flush many changes at once
+    idea_ids = Idea.get_idea_ids_showing_posts(
+        {change[1] for change in changes if change[0] == 'post'})
+    for change in changes:
+        if change[0] == 'post':
+            apply_post_change(
+                session, *change[1:], idea_ids=idea_ids[change[1]])
+    apply_read_changes(session, [
+        change[1:] for change in changes if change[0] == 'read'])
+    # Replies are flushed before they are given their parent: their
+    # counts move from the ideas that showed them to those that show them.
+    shown_in = Idea.get_idea_ids_showing_posts(
+        {post_id for (_, post_id, _, _, _) in moves})
+    for (discussion_id, post_id, creator_id, was_counted, old_idea_ids) \
+            in moves:
+        idea_ids = shown_in.get(post_id, ())
+        if has_descendants(session, post_id):
+            # The descendants were moved along, in bulk
+            stale.update((discussion_id, idea_id) for idea_id
+                         in set(old_idea_ids).union(idea_ids))
+        elif was_counted:
+            apply_post_move(
+                session, post_id, creator_id, old_idea_ids, idea_ids)
+    # Computed last, from the state that includes the changes above
+    stale_by_discussion = {}
+    for (discussion_id, idea_id) in stale:
+        stale_by_discussion.setdefault(discussion_id, set()).add(idea_id)
+    for (discussion_id, idea_ids) in stale_by_discussion.items():
+        recompute_idea_counts(session, discussion_id, idea_ids)
+    request = get_current_request()
+    discussion_data = getattr(request, 'discussion_data', None)
+    if discussion_data is not None:
+        discussion_data.reset_idea_counts()
+
+
+def _is_counted(post, old=False):
+    if old:
+        state, hidden = (
+            _old_or_current_value(post, 'publication_state'),
+            _old_or_current_value(post, 'hidden'))
+    else:
+        state, hidden = post.publication_state, post.hidden
+    return state in countable_publication_states and not hidden
+
+
+def _old_or_current_value(target, attribute):
+    history = inspect(target).attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(target, attribute)
+
+
+def _post_inserted(mapper, connection, target):
+    if _is_counted(target):
+        _changes.note(target, ('post', target.id, target.creator_id, 1))
+
+
+def _post_updated(mapper, connection, target):
+    if attribute_changed(target, 'publication_state', 'hidden'):
+        was_counted = _is_counted(target, True)
+        if was_counted != _is_counted(target):
+            _changes.note(target, (
+                'post', target.id, target.creator_id,
+                -1 if was_counted else 1))
+    if attribute_changed(target, 'ancestry'):
+        _note_move(mapper, connection, target)
+
+
+def _note_move(mapper, connection, target):
+    # The membership of the post is not computed again yet
+    table = IdeaPostMembership.__table__
+    old_idea_ids = [id for (id,) in connection.execute(
+        select([table.c.idea_id]).where(table.c.post_id == target.id))]
+    _changes.note(target, (
+        'moved', target.discussion_id, target.id, target.creator_id,
+        _is_counted(target, True), old_idea_ids))
+
+
+def _view_inserted(mapper, connection, target):
+    if target.tombstone_date is None:
+        _changes.note(target, ('read', target.post_id, target.actor_id, 1))
+
+
+def _view_updated(mapper, connection, target):
+    if attribute_changed(target, 'tombstone_date'):
+        was_live = _old_or_current_value(target, 'tombstone_date') is None
+        if was_live != (target.tombstone_date is None):
+            _changes.note(target, (
+                'read', target.post_id, target.actor_id,
+                -1 if was_live else 1))
+
+
+def _view_deleted(mapper, connection, target):
+    if target.tombstone_date is None:
+        _changes.note(target, ('read', target.post_id, target.actor_id, -1))
+
+
+def _content_link_changed(mapper, connection, target):
+    if attribute_changed(target, 'idea_id', 'content_id'):
+        idea_id = _old_or_current_value(target, 'idea_id')
+        if idea_id is not None and idea_id != target.idea_id:
+            _changes.note(target, (
+                'stale', target.get_discussion_id(), idea_id))
+        _content_link_added_or_deleted(mapper, connection, target)
+
+
+def _content_link_added_or_deleted(mapper, connection, target):
+    if target.idea_id is not None:
+        _changes.note(target, (
+            'stale', target.get_discussion_id(), target.idea_id))
+
+
+def _idea_link_changed(mapper, connection, target):
+    discussion_id = target.get_discussion_id()
+    for idea_id in (target.source_id, target.target_id):
+        _changes.note(target, ('stale', discussion_id, idea_id))
+
+
+def _idea_link_updated(mapper, connection, target):
+    if attribute_changed(target, 'source_id', 'target_id', 'tombstone_date'):
+        discussion_id = target.get_discussion_id()
+        for attribute in ('source_id', 'target_id'):
+            _changes.note(target, (
+                'stale', discussion_id,
+                _old_or_current_value(target, attribute)))
+        _idea_link_changed(mapper, connection, target)
+
+
+def _idea_inserted(mapper, connection, target):
+    _changes.note(target, ('stale', target.discussion_id, target.id))
+
+
+def _idea_changed(mapper, connection, target):
+    if attribute_changed(target, 'tombstone_date'):
+        _changes.note(target, ('stale', target.discussion_id, target.id))
+
+
+_changes = FlushChanges('idea_counter_changes', _apply_changes)
+event.listen(Post, 'after_insert', _post_inserted, propagate=True)
+event.listen(Post, 'after_update', _post_updated, propagate=True)
+# Before the membership of the post is deleted with it
+event.listen(Post, 'before_delete', _note_move, propagate=True)
+event.listen(ViewPost, 'after_insert', _view_inserted, propagate=True)
+event.listen(ViewPost, 'after_update', _view_updated, propagate=True)
+event.listen(ViewPost, 'after_delete', _view_deleted, propagate=True)
+for _event in ('after_insert', 'after_delete'):
+    event.listen(IdeaContentLink, _event, _content_link_added_or_deleted,
+                 propagate=True)
+    event.listen(IdeaLink, _event, _idea_link_changed, propagate=True)
+event.listen(IdeaContentLink, 'after_update', _content_link_changed,
+             propagate=True)
+event.listen(IdeaLink, 'after_update', _idea_link_updated, propagate=True)
+event.listen(Idea, 'after_insert', _idea_inserted, propagate=True)
+event.listen(Idea, 'after_update', _idea_changed, propagate=True)
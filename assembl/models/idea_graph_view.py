@@ -21,7 +21,7 @@ from .discussion import Discussion
 from .langstrings import LangString
 from ..auth import (
     CrudPermissions, P_ADMIN_DISC, P_EDIT_SYNTHESIS)
-from .idea import Idea, IdeaLink, RootIdea, IdeaVisitor
+from .idea import Idea, IdeaLink, RootIdea, IdeaVisitor, DiscussionGraph
 from assembl.views.traversal import AbstractCollectionDefinition
 
 FULLTEXT_SYNTHESIS_TYPE = 'fulltext_synthesis'
@@ -217,40 +217,20 @@ class ExplicitSubGraphView(IdeaGraphView):
             SubGraphIdeaAssociation
             ).filter_by(sub_graph_id=self.id).all()
 
+    def get_graph(self, root_id):
+        "The :py:class:`.idea.DiscussionGraph` of the links of this view"
+        links = self.db.query(IdeaLink.source_id, IdeaLink.target_id).join(
+            SubGraphIdeaLinkAssociation
+            ).filter_by(sub_graph_id=self.id).order_by(IdeaLink.order)
+        return DiscussionGraph(root_id, links)
+
     def visit_ideas_depth_first(self, idea_visitor):
         # prefetch
         ideas_by_id = {idea.id: idea for idea in self.get_ideas()}
-        children_links = defaultdict(list)
-        for link in self.get_idea_links():
-            children_links[link.source_id].append(link)
-        for links in children_links.itervalues():
-            links.sort(key=lambda l: l.order)
         root = self.discussion.root_idea
         root = ideas_by_id.get(root.base_id, root)
-        return self._visit_ideas_depth_first(
-            root.id, ideas_by_id, children_links, idea_visitor, set(), 0, None)
-
-    def _visit_ideas_depth_first(
-            self, idea_id, ideas_by_id, children_links, idea_visitor,
-            visited, level, prev_result):
-        result = None
-        if idea_id in visited:
-            # not necessary in a tree, but let's start to think graph.
-            return False
-        idea = ideas_by_id.get(idea_id, None)
-        if idea:
-            result = idea_visitor.visit_idea(idea, level, prev_result)
-        visited.add(idea_id)
-        child_results = []
-        if result is not IdeaVisitor.CUT_VISIT:
-            for link in children_links[idea_id]:
-                child_id = link.target_id
-                r = self._visit_ideas_depth_first(
-                    child_id, ideas_by_id, children_links, idea_visitor,
-                    visited, level + 1, result)
-                if r:
-                    child_results.append((child_id, r))
-        return idea_visitor.end_visit(idea, level, result, child_results)
+        return self.get_graph(root.id).visit_depth_first(
+            idea_visitor, root.id, ideas_by_id)
 
     @classmethod
     def extra_collections(cls):
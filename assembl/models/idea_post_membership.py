@@ -0,0 +1,212 @@
+"""Materialized relation between ideas and the posts they show.
+
+Which posts an idea shows is defined by the idea-content links of the idea
+and its descendants, through post ancestry (see :py:mod:`.path_utils`).
+Expressed directly, that is a cascade of regular expressions on ancestry
+which postgres cannot index; so the relation is stored, and maintained
+when posts are created or moved, and when content links or the idea
+hierarchy change."""
+from sqlalchemy import (
+    Column, Integer, ForeignKey, event, exists, inspect, literal, select)
+from sqlalchemy.orm import with_polymorphic
+
+from ..lib.sqla import Base, FlushChanges
+from .generic import Content
+from .post import Post
+from .idea import Idea, IdeaLink
+from .idea_content_link import IdeaContentLink
+from .path_utils import attribute_changed, filter_publication_states
+
+
+class IdeaPostMembership(Base):
+    """A post shown by an idea, whatever its publication state.
+
+    Same as :py:meth:`.path_utils.PostPathLocalCollection.as_clause_base`
+    on the combined paths of the idea."""
+    __tablename__ = 'idea_post_membership'
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    post_id = Column(Integer, ForeignKey(
+        Post.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True, index=True)
+
+    @classmethod
+    def related_posts_subquery(
+            cls, db, idea_id, include_deleted=False,
+            include_moderating=None, user_id=None):
+        """The ids of posts shown by the idea, as a post_id column.
+        Parameters as in as_clause_base."""
+        post = with_polymorphic(
+            Post, [], Post.__table__,
+            aliased=False, flat=True)
+        content = with_polymorphic(
+            Content, [], Content.__table__,
+            aliased=False, flat=True)
+        q = db.query(post.id.label("post_id")).join(
+            content, content.id == post.id
+        ).join(cls, cls.post_id == post.id).filter(cls.idea_id == idea_id)
+        q = filter_publication_states(
+            q, post, content, include_deleted, include_moderating, user_id)
+        return q.subquery("relposts")
+
+
+def compute_idea_membership(db, discussion_id, idea_ids):
+    """Compute again the posts shown by those ideas."""
+    counter = Idea.prepare_counters(discussion_id)
+    table = IdeaPostMembership.__table__
+    db.execute(table.delete().where(table.c.idea_id.in_(idea_ids)))
+    for idea_id in idea_ids:
+        subq = counter.paths[idea_id].as_clause_base(
+            db, include_deleted=None, any_state=True)
+        db.execute(table.insert().from_select(
+            ['idea_id', 'post_id'],
+            db.query(literal(idea_id), subq.c.post_id).statement))
+
+
+def compute_post_membership(db, post_ids):
+    """Compute again the ideas that show these posts."""
+    if not post_ids:
+        return
+    table = IdeaPostMembership.__table__
+    db.execute(table.delete().where(table.c.post_id.in_(post_ids)))
+    rows = [dict(idea_id=idea_id, post_id=post_id)
+            for (post_id, idea_ids)
+            in Idea.get_idea_ids_showing_posts(post_ids).items()
+            for idea_id in idea_ids]
+    if rows:
+        db.execute(table.insert(), rows)
+
+
+def rebuild_idea_post_membership(db, discussion_id):
+    """Compute again the posts shown by all ideas of a discussion."""
+    idea_ids = [id for (id,) in db.query(Idea.id).filter_by(
+        discussion_id=discussion_id, tombstone_date=None)]
+    compute_idea_membership(db, discussion_id, idea_ids)
+
+
+def _with_ancestors(discussion_id, idea_ids):
+    parents = Idea.parent_dict(discussion_id)
+    result = set()
+    for idea_id in idea_ids:
+        while idea_id and idea_id not in result:
+            result.add(idea_id)
+            idea_id = parents.get(idea_id, None)
+    return result
+
+
+# Changes are noted during the flush, and applied at the end of the flush,
+# in the same transaction.
+
+def _apply_changes(session, changes):
+    table = IdeaPostMembership.__table__
+    whole_discussions = {
+        discussion_id for (kind, discussion_id, _) in changes
+        if kind == 'discussion'}
+    ideas = {}
+    for (kind, discussion_id, id) in changes:
+        if kind == 'ideas' and discussion_id not in whole_discussions:
+            ideas.setdefault(discussion_id, set()).add(id)
+    # A moved post takes its descendants along, and their ancestry is
+    # changed in bulk: compute again the ideas that showed the post,
+    # and those that show it now.
+    moved = [(discussion_id, post_id)
+             for (kind, discussion_id, post_id) in changes
+             if kind == 'moved' and discussion_id not in whole_discussions
+             and has_descendants(session, post_id)]
+    posts = {id for (kind, _, id) in changes if kind in ('post', 'moved')}
+    posts -= {post_id for (_, post_id) in moved}
+    for (discussion_id, post_id) in moved:
+        ideas.setdefault(discussion_id, set()).update(
+            id for (id,) in session.execute(select([table.c.idea_id]).where(
+                table.c.post_id == post_id)))
+    # The paths kept for this request may predate these changes.
+    for discussion_id in whole_discussions | set(ideas):
+        Idea.get_discussion_data(discussion_id).reset_hierarchy()
+    for discussion_id in whole_discussions | set(ideas) | {
+            discussion_id for (kind, discussion_id, _) in changes
+            if kind == 'moved'}:
+        Idea.get_discussion_data(discussion_id).reset_content_links()
+    shown_in = Idea.get_idea_ids_showing_posts(
+        [post_id for (_, post_id) in moved])
+    for (discussion_id, post_id) in moved:
+        ideas[discussion_id].update(shown_in[post_id])
+    for discussion_id in whole_discussions:
+        rebuild_idea_post_membership(session, discussion_id)
+    for discussion_id, idea_ids in ideas.items():
+        if idea_ids:
+            compute_idea_membership(
+                session, discussion_id,
+                _with_ancestors(discussion_id, idea_ids))
+    compute_post_membership(session, posts)
+
+
+def has_descendants(db, post_id):
+    table = Post.__table__
+    ancestry = db.execute(select([table.c.ancestry]).where(
+        table.c.id == post_id)).scalar()
+    prefix = "%s%d," % (ancestry or '', post_id)
+    return db.execute(select([exists().where(
+        table.c.ancestry.like(prefix + '%'))])).scalar()
+
+
+def _old_value_or_none(target, attribute):
+    history = inspect(target).attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+
+
+def _post_changed(mapper, connection, target):
+    _changes.note(target, ('post', target.discussion_id, target.id))
+
+
+def _post_updated(mapper, connection, target):
+    if attribute_changed(target, 'ancestry'):
+        _changes.note(target, ('moved', target.discussion_id, target.id))
+
+
+def _content_link_changed(mapper, connection, target):
+    if target.idea_id is not None:
+        _changes.note(target, (
+            'ideas', target.get_discussion_id(), target.idea_id))
+
+
+def _content_link_updated(mapper, connection, target):
+    if attribute_changed(target, 'idea_id', 'content_id'):
+        _content_link_changed(mapper, connection, target)
+        old_idea_id = _old_value_or_none(target, 'idea_id')
+        if old_idea_id is not None:
+            _changes.note(target, (
+                'ideas', target.get_discussion_id(), old_idea_id))
+
+
+def _idea_link_changed(mapper, connection, target):
+    # Only the ideas above the link show different posts
+    _changes.note(target, (
+        'ideas', target.get_discussion_id(), target.source_id))
+
+
+def _idea_link_updated(mapper, connection, target):
+    if attribute_changed(target, 'source_id', 'target_id', 'tombstone_date'):
+        _idea_link_changed(mapper, connection, target)
+        old_source_id = _old_value_or_none(target, 'source_id')
+        if old_source_id is not None:
+            _changes.note(target, (
+                'ideas', target.get_discussion_id(), old_source_id))
+
+
+def _idea_updated(mapper, connection, target):
+    if attribute_changed(target, 'tombstone_date'):
+        _changes.note(target, ('discussion', target.discussion_id, None))
+
+
+_changes = FlushChanges('idea_membership_changes', _apply_changes)
+event.listen(Post, 'after_insert', _post_changed, propagate=True)
+event.listen(Post, 'after_update', _post_updated, propagate=True)
+for _event in ('after_insert', 'after_delete'):
+    event.listen(IdeaContentLink, _event, _content_link_changed,
+                 propagate=True)
+    event.listen(IdeaLink, _event, _idea_link_changed, propagate=True)
+event.listen(IdeaContentLink, 'after_update', _content_link_updated,
+             propagate=True)
+event.listen(IdeaLink, 'after_update', _idea_link_updated, propagate=True)
+event.listen(Idea, 'after_update', _idea_updated, propagate=True)
@@ -442,6 +442,10 @@ class LangString(Base):
 
     id = Column(Integer, primary_key=True)
 
+    view_def_method_relations = {
+        'best_entries_in_request_with_originals': 'entries',
+    }
+
     def add_entry(self, entry, allow_replacement=True):
         """Add a LangStringEntry to the langstring.
         Previous versions with the same language will be tombstoned,
@@ -527,7 +527,7 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
                             new_parent = parent.message.message if algorithm_parent_message_id else None
                             if debug:
                                 print(repr(new_parent))
-                            container.message.message.set_parent(new_parent)
+                            new_parents[container.message.message] = new_parent
                         else:
                             if debug:
                                 print("Skipped reparenting:  the current parent \
@@ -539,7 +539,11 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
                         print("Current message ID: None, was a dummy container")
                     update_threading(container.children, parent, debug=debug)
 
+        # Reparent all at once, so each thread is moved in one statement
+        new_parents = {}
         update_threading(threaded_emails.values(), debug=False)
+        if new_parents:
+            ImportedPost.set_parents(emails[0].db, new_parents)
 
     def reprocess_content(self):
         """ Allows re-parsing all content as if it were imported for the first time
@@ -5,13 +5,14 @@ from functools import total_ordering
 from collections import defaultdict
 from bisect import bisect_right
 
-from sqlalchemy import String
-from sqlalchemy.orm import (with_polymorphic, aliased)
+from sqlalchemy import String, event, inspect
+from sqlalchemy.orm import with_polymorphic, Session
 from sqlalchemy.sql.expression import or_, union, except_
 from sqlalchemy.sql.functions import count
 
 from ..auth import P_MODERATE
 from ..auth.util import user_has_permission
+from ..lib.caching import create_version_stamps
 from .idea_content_link import (
     IdeaContentLink, IdeaContentPositiveLink, IdeaContentNegativeLink)
 from .post import (
@@ -22,10 +23,8 @@ from .idea import IdeaVisitor, Idea, IdeaLink, RootIdea
 from .discussion import Discussion
 from .action import ViewPost
 
-# TODO: Write a discussion structure cache manager.
-# This will have caches of parent, children, counts, etc. at need
-# and understand the invalidation relationships
-# Tie it to request? use request.set_property?
+HIERARCHY = 'hierarchy'
+CONTENT_LINKS = 'content_links'
 
 
 # Cas à surveiller:
@@ -57,6 +56,35 @@ from .action import ViewPost
 # I1 < P1, P2, P3
 
 
+def filter_publication_states(
+        query, post, content, include_deleted=False,
+        include_moderating=None, user_id=None):
+    """Filter posts by publication state, see
+    :py:meth:`PostPathLocalCollection.as_clause_base`"""
+    states = set(countable_publication_states)  # Or just published?
+    states.update(deleted_publication_states)
+    if include_deleted is not None:
+        if include_deleted is True:
+            states = set(deleted_publication_states)
+        else:
+            query = query.filter(content.tombstone_date == None)  # noqa: E711
+    if include_moderating is True:
+        states.add(PublicationStates.SUBMITTED_AWAITING_MODERATION)
+    state_condition = post.publication_state.in_(states)
+    if user_id:
+        if include_moderating == "mine":
+            state_condition = state_condition | (
+                post.publication_state.in_([
+                    PublicationStates.SUBMITTED_AWAITING_MODERATION,
+                    PublicationStates.DRAFT]) &
+                (post.creator_id == user_id))
+        else:
+            state_condition = state_condition | (
+                (post.publication_state == PublicationStates.DRAFT) &
+                (post.creator_id == user_id))
+    return query.filter(state_condition)
+
+
 @total_ordering
 class PostPathData(object):
     "Data about a single post_path."
@@ -223,7 +251,7 @@ class PostPathLocalCollection(object):
 
     def as_clause_base(self, db, include_breakpoints=False,
                        include_deleted=False, include_moderating=None,
-                       user_id=None):
+                       user_id=None, any_state=False):
         """Express collection as a SQLAlchemy query clause.
 
         :param bool include_breakpoints: Include posts where
@@ -236,6 +264,8 @@ class PostPathLocalCollection(object):
             a "mine" value means only those belonging to this user.
             There is not currently a way to only get those posts. (todo?)
             NOTE: that parameter is interpreted differently in Idea.get_related_posts_query
+        :param bool any_state: Ignore the publication state and the previous
+            parameters.
         """
         assert self.reduced
 
@@ -251,28 +281,10 @@ class PostPathLocalCollection(object):
             else:
                 query = db.query(post.id)
             query = query.join(content, content.id == post.id)
-            states = set(countable_publication_states)  # Or just published?
-            states.update(deleted_publication_states)
-            if include_deleted is not None:
-                if include_deleted is True:
-                    states = set(deleted_publication_states)
-                else:
-                    query = query.filter(content.tombstone_date == None)  # noqa: E711
-            if include_moderating is True:
-                states.add(PublicationStates.SUBMITTED_AWAITING_MODERATION)
-            state_condition = post.publication_state.in_(states)
-            if user_id:
-                if include_moderating == "mine":
-                    state_condition = state_condition | (
-                        post.publication_state.in_([
-                            PublicationStates.SUBMITTED_AWAITING_MODERATION,
-                            PublicationStates.DRAFT]) &
-                        (post.creator_id == user_id))
-                else:
-                    state_condition = state_condition | (
-                        (post.publication_state == PublicationStates.DRAFT) &
-                        (post.creator_id == user_id))
-            query = query.filter(state_condition)
+            if not any_state:
+                query = filter_publication_states(
+                    query, post, content, include_deleted,
+                    include_moderating, user_id)
             return post, query
         if not self.paths:
             post, q = base_query(True)
@@ -352,21 +364,27 @@ class PostPathLocalCollection(object):
         subq = self.as_clause_base(
             db, include_deleted=include_deleted, include_moderating=include_moderating,
             user_id=user_id if include_moderating else None)
-        content = content or with_polymorphic(
-            Content, [], Content.__table__,
-            aliased=False, flat=True)
+        return related_content_query(db, subq, discussion_id, user_id, content)
 
-        q = db.query(content).filter(
-            (content.discussion_id == discussion_id) & (content.hidden == False)  # noqa: E712
-            ).join(subq, content.id == subq.c.post_id)
 
-        if user_id:
-            # subquery?
-            q = q.outerjoin(
-                ViewPost,
-                (ViewPost.post_id == content.id) & (ViewPost.tombstone_date == None) & (ViewPost.actor_id == user_id)  # noqa: E711
-            ).add_columns(ViewPost.id)
-        return q
+def related_content_query(db, subq, discussion_id, user_id=None, content=None):
+    """The visible content of the discussion among the post_ids of subq,
+    with the ViewPost id of the user if given."""
+    content = content or with_polymorphic(
+        Content, [], Content.__table__,
+        aliased=False, flat=True)
+
+    q = db.query(content).filter(
+        (content.discussion_id == discussion_id) & (content.hidden == False)  # noqa: E712
+        ).join(subq, content.id == subq.c.post_id)
+
+    if user_id:
+        # subquery?
+        q = q.outerjoin(
+            ViewPost,
+            (ViewPost.post_id == content.id) & (ViewPost.tombstone_date == None) & (ViewPost.actor_id == user_id)  # noqa: E711
+        ).add_columns(ViewPost.id)
+    return q
 
 
 class PostPathGlobalCollection(object):
@@ -422,10 +440,10 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         super(PostPathCombiner, self).__init__(discussion)
         self.postponed_paths = []
 
-    def init_from(self, post_path_global_collection):
+    def init_from(self, post_path_global_collection, discussion=None):
         for id, paths in post_path_global_collection.paths.iteritems():
             self.paths[id] = paths.clone()
-        self.discussion = post_path_global_collection.discussion
+        self.discussion = discussion or post_path_global_collection.discussion
 
     def visit_idea(self, idea, level, prev_result):
         if isinstance(idea, Idea):
@@ -491,28 +509,8 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
             Post, [], Post.__table__,
             aliased=False, flat=True)
         q = q.join(post, post.id == content.id)
-        states = set(countable_publication_states)  # Or just published?
-        states.update(deleted_publication_states)
-        if include_deleted is not None:
-            if include_deleted is True:
-                states = set(deleted_publication_states)
-            else:
-                q = q.filter(content.tombstone_date == None)  # noqa: E711
-        if include_moderating is True:
-            states.add(PublicationStates.SUBMITTED_AWAITING_MODERATION)
-        state_condition = post.publication_state.in_(states)
-        if user_id:
-            if include_moderating == "mine":
-                state_condition = state_condition | (
-                    post.publication_state.in_([
-                        PublicationStates.SUBMITTED_AWAITING_MODERATION,
-                        PublicationStates.DRAFT]) &
-                    (post.creator_id == user_id))
-            else:
-                state_condition = state_condition | (
-                    (post.publication_state == PublicationStates.DRAFT) &
-                    (post.creator_id == user_id))
-        q = q.filter(state_condition)
+        q = filter_publication_states(
+            q, post, content, include_deleted, include_moderating, user_id)
 
         if user_id:
             # subquery?
@@ -607,6 +605,35 @@ class PostPathCounter(PostPathCombiner):
         self.contributor_counts[idea_id] = contributor_count
         return (post_count, contributor_count, viewed_count)
 
+    def get_counts_by_user(self, idea_id):
+        """The number of posts of an idea by their creator,
+        and the number of posts of the idea read by each user."""
+        path_collection = self.paths[idea_id]
+        if not path_collection:
+            return {}, {}
+        content = with_polymorphic(
+            Content, [], Content.__table__,
+            aliased=False, flat=True)
+        post = with_polymorphic(
+            Post, [], Post.__table__,
+            aliased=False, flat=True)
+        q = path_collection.as_clause(
+            self.discussion.db, self.discussion.id, content=content,
+            include_deleted=None, include_moderating=None)
+        q = q.join(
+            post, (content.id == post.id) &
+                  (post.publication_state.in_(countable_publication_states)))
+        posts_by_creator = dict(q.with_entities(
+            post.creator_id, count(content.id)).group_by(post.creator_id))
+        from .read_posts import UserReadPosts
+        read_by_user = dict(q.join(
+            UserReadPosts,
+            (UserReadPosts.discussion_id == self.discussion.id) &
+            UserReadPosts.post_ids.any(content.id)
+            ).with_entities(UserReadPosts.user_id, count(content.id)
+            ).group_by(UserReadPosts.user_id))
+        return posts_by_creator, read_by_user
+
     def get_orphan_counts(self, include_deleted=False):
         return self.get_counts_for_query(
             self.orphan_clause(self.user_id, include_deleted=include_deleted))
@@ -626,6 +653,124 @@ class PostPathCounter(PostPathCombiner):
         return result
 
 
+class DiscussionStructureCache(object):
+    """Process-wide cache of the structure of discussions: the idea
+    hierarchy (HIERARCHY) and the raw post paths of idea-content links
+    (CONTENT_LINKS).
+
+    Each (discussion, kind) has a version, incremented when a transaction
+    that changed it is committed; entries of an older version are reloaded.
+    The versions are kept in redis if ``structure_cache_redis`` is set,
+    so that all processes see the changes.
+    Sessions with uncommitted changes bypass the cache.
+    Cached values must not be modified."""
+
+    def __init__(self):
+        self._versions = None
+        self.entries = {}
+
+    @property
+    def versions(self):
+        if self._versions is None:
+            self._versions = create_version_stamps('assembl:structure:')
+        return self._versions
+
+    def get(self, db, discussion_id, kind, loader):
+        key = (discussion_id, kind)
+        if key in db.info.get('structure_changes', ()):
+            return loader()
+        # Read the version before loading, so concurrent changes
+        # leave the entry outdated.
+        version = self.versions.get(key)
+        entry = self.entries.get(key)
+        if entry is not None and version is not None and entry[0] == version:
+            return entry[1]
+        value = loader()
+        if version is not None:
+            self.entries[key] = (version, value)
+        return value
+
+    def invalidate(self, discussion_id, kind):
+        self.versions.incr((discussion_id, kind))
+
+    def invalidate_on_commit(self, target, discussion_id, kind):
+        session = inspect(target).session
+        if session is not None and discussion_id is not None:
+            session.info.setdefault('structure_changes', set()).add(
+                (discussion_id, kind))
+
+
+structure_cache = DiscussionStructureCache()
+
+
+def _structure_after_commit(session):
+    for (discussion_id, kind) in session.info.pop('structure_changes', ()):
+        structure_cache.invalidate(discussion_id, kind)
+
+
+def _structure_after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('structure_changes', None)
+
+
+def attribute_changed(target, *attributes):
+    "Whether any of these attributes is changed by the current flush."
+    state = inspect(target)
+    return any(state.attrs[attr].history.has_changes() for attr in attributes)
+
+
+def _idea_link_changed(mapper, connection, target):
+    structure_cache.invalidate_on_commit(
+        target, target.get_discussion_id(), HIERARCHY)
+
+
+def _idea_changed(mapper, connection, target):
+    if attribute_changed(target, 'tombstone_date'):
+        _idea_added_or_deleted(mapper, connection, target)
+
+
+def _idea_added_or_deleted(mapper, connection, target):
+    structure_cache.invalidate_on_commit(
+        target, target.discussion_id, HIERARCHY)
+
+
+def _content_link_changed(mapper, connection, target):
+    if attribute_changed(target, 'idea_id', 'content_id'):
+        _content_link_added_or_deleted(mapper, connection, target)
+
+
+def _content_link_added_or_deleted(mapper, connection, target):
+    structure_cache.invalidate_on_commit(
+        target, target.get_discussion_id(), CONTENT_LINKS)
+
+
+def _content_changed(mapper, connection, target):
+    if attribute_changed(target, 'hidden'):
+        structure_cache.invalidate_on_commit(
+            target, target.discussion_id, CONTENT_LINKS)
+
+
+def _post_changed(mapper, connection, target):
+    if attribute_changed(target, 'ancestry'):
+        structure_cache.invalidate_on_commit(
+            target, target.discussion_id, CONTENT_LINKS)
+
+
+event.listen(Session, 'after_commit', _structure_after_commit)
+event.listen(
+    Session, 'after_transaction_end', _structure_after_transaction_end)
+for _cls, _on_update, _on_insert_delete in (
+        (IdeaLink, _idea_link_changed, _idea_link_changed),
+        (Idea, _idea_changed, _idea_added_or_deleted),
+        (IdeaContentLink, _content_link_changed,
+         _content_link_added_or_deleted)):
+    event.listen(_cls, 'after_update', _on_update, propagate=True)
+    event.listen(_cls, 'after_insert', _on_insert_delete, propagate=True)
+    event.listen(_cls, 'after_delete', _on_insert_delete, propagate=True)
+event.listen(Content, 'after_update', _content_changed, propagate=True)
+event.listen(Post, 'after_update', _post_changed, propagate=True)
+
+
 class DiscussionGlobalData(object):
     "Cache for global discussion data, lasts as long as the pyramid request object."
 
@@ -640,6 +785,7 @@ class DiscussionGlobalData(object):
         self._children_dict = None
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._idea_counts = None
 
     @property
     def discussion(self):
@@ -653,18 +799,7 @@ class DiscussionGlobalData(object):
 
         TODO: Make it dict(id->id[]) for multiparenting"""
         if self._parent_dict is None:
-            source = aliased(Idea, name="source")
-            target = aliased(Idea, name="target")
-            self._parent_dict = dict(self.db.query(
-                IdeaLink.target_id, IdeaLink.source_id
-                ).join(source, source.id == IdeaLink.source_id
-                ).join(target, target.id == IdeaLink.target_id
-                ).filter(
-                source.discussion_id == self.discussion_id,
-                IdeaLink.tombstone_date == None,  # noqa: E711
-                source.tombstone_date == None,
-                target.tombstone_date == None,
-                target.discussion_id == self.discussion_id))
+            self._parent_dict = Idea.parent_dict(self.discussion_id)
         return self._parent_dict
 
     def idea_ancestry(self, idea_id):
@@ -676,41 +811,69 @@ class DiscussionGlobalData(object):
     @property
     def children_dict(self):
         if self._children_dict is None:
-            if not self.parent_dict:
-                (root_id,) = self.db.query(
-                    RootIdea.id).filter_by(
-                    discussion_id=self.discussion_id).first()
-                self._children_dict = {None: (root_id,), root_id: ()}
-                return self._children_dict
-            children = defaultdict(list)
-            for child, parent in self.parent_dict.iteritems():
-                children[parent].append(child)
-            root = set(children.keys()) - set(self.parent_dict.keys())
-            assert len(root) == 1
-            children[None] = [root.pop()]
-            self._children_dict = children
+            self._children_dict = Idea.children_dict(self.discussion_id)
         return self._children_dict
 
+    def load_post_path_collection(self):
+        paths = PostPathGlobalCollection(self.discussion)
+        # The cached value outlives the session
+        paths.discussion = None
+        return paths
+
     @property
     def post_path_collection_raw(self):
         if self._post_path_collection_raw is None:
-            self._post_path_collection_raw = PostPathGlobalCollection(self.discussion)
+            self._post_path_collection_raw = structure_cache.get(
+                self.db, self.discussion_id, CONTENT_LINKS,
+                self.load_post_path_collection)
         return self._post_path_collection_raw
 
     def post_path_counter(self, user_id, calc_all):
         if (self._post_path_counter is None or not isinstance(self._post_path_counter, PostPathCounter)):
             counter = PostPathCounter(
-                self.discussion, user_id, None if calc_all else ())
-            counter.init_from(self.post_path_collection_raw)
+                None, user_id, None if calc_all else ())
+            counter.init_from(self.post_path_collection_raw, self.discussion)
             self.discussion.root_idea.visit_ideas_depth_first(counter)
             self._post_path_counter = counter
         return self._post_path_counter
 
+    def idea_counts(self, idea_id):
+        """(num_posts, num_contributors, num_read_posts) of an idea,
+        from the persistent counters. They are computed, but not stored,
+        for an idea which has none yet."""
+        from .idea_counters import load_idea_counts, compute_idea_counts
+        if self._idea_counts is None:
+            self._idea_counts = load_idea_counts(
+                self.db, self.discussion_id, self.user_id)
+        counts = self._idea_counts.get(idea_id, None)
+        if counts is None:
+            self._idea_counts.update(compute_idea_counts(
+                self.db, self.discussion_id, [idea_id], self.user_id))
+            counts = self._idea_counts[idea_id]
+        return counts
+
+    def prefetch_idea_counts(self, idea_ids):
+        """Compute the missing counts of these ideas together,
+        without storing them."""
+        from .idea_counters import load_idea_counts, compute_idea_counts
+        if self._idea_counts is None:
+            self._idea_counts = load_idea_counts(
+                self.db, self.discussion_id, self.user_id)
+        missing = [id for id in idea_ids if id not in self._idea_counts]
+        if missing:
+            self._idea_counts.update(compute_idea_counts(
+                self.db, self.discussion_id, missing, self.user_id))
+
+    def reset_idea_counts(self):
+        self._idea_counts = None
+
     def reset_hierarchy(self):
         self._parent_dict = None
         self._children_dict = None
         self._post_path_counter = None
+        self._idea_counts = None
 
     def reset_content_links(self):
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._idea_counts = None
@@ -17,10 +17,16 @@ from sqlalchemy import (
     Index,
     or_,
     event,
-    func
+    func,
+    case,
+    cast,
+    inspect,
+    literal,
+    select,
 )
 from sqlalchemy.orm import (
     relationship, backref, deferred, column_property, with_polymorphic)
+from sqlalchemy.orm.attributes import set_committed_value
 
 from ..lib.clean_input import sanitize_text
 from ..lib.sqla import CrudOperation
@@ -270,23 +276,109 @@ class Post(Content, TaggableEntity):
             return body
 
     def _set_ancestry(self, new_ancestry):
-        self.ancestry = new_ancestry
-
-        descendant_ancestry = "%s%d," % (
-            self.ancestry, self.id)
-        for descendant in self.get_descendants():
-            descendant._set_ancestry(descendant_ancestry)
+        self.set_ancestries(self.db, {self: new_ancestry})
 
     def set_parent(self, parent):
-        self.parent = parent
+        self.set_parents(self.db, {self: parent})
+
+    @classmethod
+    def set_ancestries(cls, db, ancestries):
+        """Give new ancestries to posts, and move their descendants along.
+
+        The descendants are updated with a single UPDATE statement,
+        without loading them; those already in the session are updated
+        in place.
+
+        :param dict ancestries: the new ancestry of each post
+        """
+        moves = {}
+        for post, ancestry in ancestries.items():
+            old_prefix = "%s%d," % (post.ancestry or '', post.id)
+            new_prefix = "%s%d," % (ancestry, post.id)
+            if old_prefix != new_prefix:
+                moves[old_prefix] = new_prefix
+        if moves:
+            # Longest prefixes first, for subtrees moved within a moved subtree
+            moves = sorted(
+                moves.items(), key=lambda move: len(move[0]), reverse=True)
+            table = Post.__table__
+            db.execute(table.update().where(or_(*[
+                table.c.ancestry.like(old_prefix + '%')
+                for (old_prefix, _) in moves])
+            ).values(ancestry=case([(
+                table.c.ancestry.like(old_prefix + '%'),
+                new_prefix + func.substr(
+                    table.c.ancestry, len(old_prefix) + 1))
+                for (old_prefix, new_prefix) in moves])))
+            for post in db.identity_map.values():
+                if not isinstance(post, Post):
+                    continue
+                ancestry = inspect(post).dict.get('ancestry', None)
+                if not ancestry:
+                    continue
+                for (old_prefix, new_prefix) in moves:
+                    if ancestry.startswith(old_prefix):
+                        set_committed_value(
+                            post, 'ancestry',
+                            new_prefix + ancestry[len(old_prefix):])
+                        break
+        for post, ancestry in ancestries.items():
+            post.ancestry = ancestry
 
-        self.db.add(self)
-        self.db.flush()
+    @classmethod
+    def set_parents(cls, db, parents):
+        """Re-thread many posts at once.
+
+        :param dict parents: the new parent of each post, or None
+        """
+        for post, parent in parents.items():
+            post.parent = parent
+            db.add(post)
+        db.flush()
+        moved = {
+            "%s%d," % (post.ancestry or '', post.id): post
+            for post in parents}
+
+        def new_path(post):
+            if post in parents:
+                parent = parents[post]
+                return "%s%d," % (
+                    new_path(parent) if parent else '', post.id)
+            path = "%s%d," % (post.ancestry or '', post.id)
+            # The parent may be in a moved subtree
+            for prefix in sorted(moved, key=len, reverse=True):
+                if path.startswith(prefix):
+                    return new_path(moved[prefix]) + path[len(prefix):]
+            return path
+
+        cls.set_ancestries(db, {
+            post: new_path(parent) if parent else ''
+            for (post, parent) in parents.items()})
 
-        self._set_ancestry("%s%d," % (
-            parent.ancestry or '',
-            parent.id
-        ))
+    @classmethod
+    def rebuild_ancestry(cls, db, discussion_id):
+        """Compute again the ancestry of all posts of a discussion
+        from their parents."""
+        table = Post.__table__
+        children = table.alias()
+        # Both terms must have the same type
+        thread = select([
+            table.c.id, cast(literal(''), String).label('ancestry')]).where(
+            (table.c.id == Content.id) &
+            (Content.discussion_id == discussion_id) &
+            (table.c.parent_id == None)  # noqa: E711
+        ).cte('thread', recursive=True)
+        thread = thread.union_all(select([
+            children.c.id,
+            cast(thread.c.ancestry + cast(thread.c.id, String) + ',', String)
+        ]).where(
+            children.c.parent_id == thread.c.id))
+        db.execute(table.update().values(ancestry=thread.c.ancestry).where(
+            (table.c.id == thread.c.id) &
+            table.c.ancestry.is_distinct_from(thread.c.ancestry)))
+        for post in db.identity_map.values():
+            if isinstance(post, Post) and post.discussion_id == discussion_id:
+                db.expire(post, ['ancestry'])
 
     def last_updated(self):
         ancestry_query_string = "%s%d,%%" % (self.ancestry or '', self.id)
@@ -303,6 +395,14 @@ class Post(Content, TaggableEntity):
 
         return query.scalar()
 
+    @classmethod
+    def thread_root_id_clause(cls, alias=None):
+        """SQL expression giving the id of the top-level post of the thread"""
+        alias = alias or cls
+        return case(
+            [(func.coalesce(alias.ancestry, '') == '', alias.id)],
+            else_=cast(func.split_part(alias.ancestry, ',', 1), Integer))
+
     def ancestor_ids(self):
         return [int(ancestor_id) for ancestor_id in self.ancestry.split(',') if ancestor_id]
 
@@ -1049,6 +1049,30 @@ class Preferences(MutableMapping, Base, NamedClassMixin):
             "item_default": ""
         },
 
+        # GraphQL query limits
+        {
+            "id": "graphql_max_cost",
+            "name": _("Maximum cost of GraphQL queries"),
+            "value_type": "dict_of_role_to_int",
+            "show_in_preferences": False,
+            "description": _("The maximum estimated cost of a GraphQL query, by role. The most generous role of the user applies; 0 means no limit. Roles not listed use the server setting"),
+            "allow_user_override": None,
+            "modification_permission": P_SYSADMIN,
+            "default": {},
+            "item_default": {R_PARTICIPANT: 0}
+        },
+        {
+            "id": "graphql_max_depth",
+            "name": _("Maximum depth of GraphQL queries"),
+            "value_type": "dict_of_role_to_int",
+            "show_in_preferences": False,
+            "description": _("The maximum depth of a GraphQL query, by role. The most generous role of the user applies; 0 means no limit. Roles not listed use the server setting"),
+            "allow_user_override": None,
+            "modification_permission": P_SYSADMIN,
+            "default": {},
+            "item_default": {R_PARTICIPANT: 0}
+        },
+
         # Moderation
         {
             "id": "with_moderation",
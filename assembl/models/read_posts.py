@@ -0,0 +1,379 @@
+"""Compact store of the posts read by each user.
+
+Reading a post is recorded as a :py:class:`.action.ViewPost` action, which
+stays as the history of reads. The current read state of a user in a
+discussion is also kept as a single sorted array of post ids, which is
+what read-state queries use.
+
+Posts opened in the UI can also be marked read through a write-behind
+:py:class:`ReadBuffer`, which is written to the database in bulk every few
+seconds; until then, pending reads are merged in the read state."""
+import os
+from collections import defaultdict
+from threading import Lock, Thread
+from time import sleep
+
+from pyramid.settings import asbool
+import transaction
+from sqlalchemy import Column, Integer, ForeignKey, event, func, literal
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by, insert
+from sqlalchemy.sql.expression import literal_column
+
+from ..lib.config import get_config
+from ..lib.logging import getLogger
+from ..lib.sentry import capture_exception
+from ..lib.sqla import Base, FlushChanges, get_session_maker
+from .auth import AgentProfile
+from .discussion import Discussion
+from .generic import Content
+from .action import ViewPost
+from .path_utils import attribute_changed
+
+
+class UserReadPosts(Base):
+    """The posts of a discussion read by a user, as a sorted array"""
+    __tablename__ = 'user_read_posts'
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    user_id = Column(Integer, ForeignKey(
+        AgentProfile.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True, index=True)
+    post_ids = Column(ARRAY(Integer), nullable=False, server_default='{}')
+
+    @classmethod
+    def get_post_ids(cls, db, discussion_id, user_id):
+        "The ids of the posts read by the user, in order"
+        return db.query(cls.post_ids).filter_by(
+            discussion_id=discussion_id, user_id=user_id).scalar() or []
+
+    @classmethod
+    def read_posts_query(cls, db, discussion_id, user_id):
+        "The ids of the posts read by the user, as a post_id column"
+        return db.query(func.unnest(cls.post_ids).label('post_id')).filter(
+            cls.discussion_id == discussion_id, cls.user_id == user_id)
+
+    @classmethod
+    def is_read_clause(cls, db, discussion_id, user_id, post_id):
+        """Whether the post of a post id column was read by the user,
+        including pending reads"""
+        clause = post_id.in_(cls.read_posts_query(db, discussion_id, user_id))
+        pending = cls.pending_post_ids(discussion_id, user_id)
+        if pending:
+            clause = clause | post_id.in_(pending)
+        return clause
+
+    @classmethod
+    def pending_post_ids(cls, discussion_id, user_id):
+        "The ids of the posts read by the user, not written yet"
+        read_buffer = get_read_buffer()
+        if read_buffer is None:
+            return set()
+        return read_buffer.pending(discussion_id, user_id)
+
+    @classmethod
+    def all_post_ids(cls, db, discussion_id, user_id):
+        "The ids of the posts read by the user, including pending reads"
+        post_ids = cls.get_post_ids(db, discussion_id, user_id)
+        pending = cls.pending_post_ids(discussion_id, user_id)
+        if pending:
+            post_ids = sorted(pending.union(post_ids))
+        return post_ids
+
+
+def add_read_posts(db, discussion_id, user_id, post_ids):
+    """Merge post ids in the read posts of a user."""
+    table = UserReadPosts.__table__
+    stmt = insert(table).values(
+        discussion_id=discussion_id, user_id=user_id,
+        post_ids=sorted(set(post_ids)))
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.discussion_id, table.c.user_id],
+        set_=dict(post_ids=literal_column(
+            "ARRAY(SELECT DISTINCT unnest(%s.post_ids || excluded.post_ids)"
+            " ORDER BY 1)" % (table.name,)))))
+
+
+def remove_read_posts(db, discussion_id, user_id, post_ids):
+    """Remove post ids from the read posts of a user."""
+    table = UserReadPosts.__table__
+    remaining = table.c.post_ids
+    for post_id in post_ids:
+        remaining = func.array_remove(remaining, post_id)
+    db.execute(table.update().where(
+        (table.c.discussion_id == discussion_id) &
+        (table.c.user_id == user_id)
+    ).values(post_ids=remaining))
+
+
+def rebuild_read_posts(db, discussion_id):
+    """Compute again the read posts of all users of a discussion
+    from the live ViewPost actions."""
+    table = UserReadPosts.__table__
+    db.execute(table.delete().where(table.c.discussion_id == discussion_id))
+    db.execute(table.insert().from_select(
+        ['discussion_id', 'user_id', 'post_ids'],
+        db.query(
+            literal(discussion_id), ViewPost.actor_id,
+            func.array_agg(aggregate_order_by(
+                ViewPost.post_id.distinct(), ViewPost.post_id))
+        ).join(Content, Content.id == ViewPost.post_id).filter(
+            Content.discussion_id == discussion_id,
+            ViewPost.tombstone_date == None  # noqa: E711
+        ).group_by(ViewPost.actor_id).statement))
+
+
+class LocalReadBuffer(object):
+    """Pending reads, for the current process only."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reads = defaultdict(set)
+
+    def add(self, discussion_id, user_id, post_id):
+        with self.lock:
+            self.reads[(discussion_id, user_id)].add(post_id)
+        return True
+
+    def discard(self, discussion_id, user_id, post_id):
+        with self.lock:
+            self.reads.get((discussion_id, user_id), set()).discard(post_id)
+
+    def pending(self, discussion_id, user_id):
+        with self.lock:
+            return set(self.reads.get((discussion_id, user_id), ()))
+
+    def pop_all(self):
+        with self.lock:
+            reads, self.reads = self.reads, defaultdict(set)
+        return reads
+
+
+class RedisReadBuffer(object):
+    """Pending reads, shared by all processes through redis.
+
+    If redis cannot be reached, add returns False, and the read has to
+    be written directly."""
+
+    def __init__(self, redis, prefix):
+        self.redis = redis
+        self.prefix = prefix
+        self.users_key = prefix + 'users'
+
+    def redis_key(self, discussion_id, user_id):
+        return "%s%d:%d" % (self.prefix, discussion_id, user_id)
+
+    def add(self, discussion_id, user_id, post_id):
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.sadd(self.redis_key(discussion_id, user_id), post_id)
+            pipeline.sadd(self.users_key, "%d:%d" % (discussion_id, user_id))
+            pipeline.execute()
+            return True
+        except Exception:
+            capture_exception()
+            return False
+
+    def discard(self, discussion_id, user_id, post_id):
+        try:
+            self.redis.srem(self.redis_key(discussion_id, user_id), post_id)
+        except Exception:
+            capture_exception()
+
+    def pending(self, discussion_id, user_id):
+        try:
+            return {int(id) for id in self.redis.smembers(
+                self.redis_key(discussion_id, user_id))}
+        except Exception:
+            capture_exception()
+            return set()
+
+    def pop_all(self):
+        reads = defaultdict(set)
+        while True:
+            user = self.redis.spop(self.users_key)
+            if user is None:
+                break
+            (discussion_id, user_id) = [int(x) for x in user.split(':')]
+            key = self.redis_key(discussion_id, user_id)
+            pipeline = self.redis.pipeline()
+            pipeline.smembers(key)
+            pipeline.delete(key)
+            (post_ids, _) = pipeline.execute()
+            reads[(discussion_id, user_id)].update(int(id) for id in post_ids)
+        return reads
+
+
+def flush_reads(db, reads):
+    """Write pending reads, given as post ids by (discussion_id, user_id).
+
+    The ViewPost rows are saved in bulk, without the flush events: the
+    read posts and the idea counters are updated here, and the changes
+    are not sent to the clients."""
+    from .idea_counters import apply_read_changes, lock_idea_counts
+    existing = {id for (id,) in db.query(Content.id).filter(
+        Content.id.in_(set().union(*reads.values())))} if reads else ()
+    new_reads = []
+    for ((discussion_id, user_id), post_ids) in reads.items():
+        post_ids = set(post_ids).intersection(existing).difference(
+            UserReadPosts.get_post_ids(db, discussion_id, user_id))
+        if not post_ids:
+            continue
+        # The ids of the action rows are needed for the action_on_post rows
+        db.bulk_save_objects([
+            ViewPost(post_id=post_id, actor_id=user_id)
+            for post_id in post_ids], return_defaults=True)
+        add_read_posts(db, discussion_id, user_id, post_ids)
+        new_reads.extend((post_id, user_id, 1) for post_id in post_ids)
+    if new_reads:
+        lock_idea_counts(db, {discussion_id for (discussion_id, _) in reads})
+    apply_read_changes(db, new_reads)
+
+
+# A failing read is tried again this many times, then dropped
+MAX_FLUSH_ATTEMPTS = 3
+
+
+def _write_reads(read_buffer, reads, attempts):
+    try:
+        with transaction.manager:
+            flush_reads(get_session_maker()(), reads)
+        for key in reads:
+            attempts.pop(key, None)
+        return
+    except Exception:
+        capture_exception()
+    if len(reads) > 1:
+        # Write the reads of each user apart, to find those which fail
+        for (key, post_ids) in reads.items():
+            _write_reads(read_buffer, {key: post_ids}, attempts)
+        return
+    ((key, post_ids),) = reads.items()
+    attempts[key] += 1
+    if attempts[key] >= MAX_FLUSH_ATTEMPTS:
+        del attempts[key]
+        getLogger().error(
+            "read_buffer_dropped", discussion_id=key[0], user_id=key[1],
+            post_ids=sorted(post_ids))
+        return
+    # Try again next time
+    for post_id in post_ids:
+        read_buffer.add(key[0], key[1], post_id)
+
+
+def _flush_periodically(read_buffer, interval):
+    attempts = defaultdict(int)
+    while True:
+        sleep(interval)
+        try:
+            reads = read_buffer.pop_all()
+        except Exception:
+            capture_exception()
+            continue
+        if reads:
+            _write_reads(read_buffer, reads, attempts)
+
+
+_read_buffer = None
+_read_buffer_pid = None
+
+
+def get_read_buffer():
+    """The write-behind buffer of reads of this process, with its writing
+    thread, or None if ``read_buffer_seconds`` is not set."""
+    global _read_buffer, _read_buffer_pid
+    if _read_buffer_pid == os.getpid():
+        return _read_buffer
+    config = get_config()
+    interval = float(config.get('read_buffer_seconds', 0) or 0)
+    read_buffer = None
+    if interval > 0:
+        if asbool(config.get('read_buffer_redis', False)):
+            from redis import StrictRedis
+            redis = StrictRedis(
+                host=config.get('redis_host'), port=6379,
+                db=config.get('redis_socket'))
+            read_buffer = RedisReadBuffer(redis, 'assembl:read_buffer:')
+        else:
+            read_buffer = LocalReadBuffer()
+        thread = Thread(
+            target=_flush_periodically, args=(read_buffer, interval),
+            name='read_buffer')
+        thread.daemon = True
+        thread.start()
+    _read_buffer, _read_buffer_pid = read_buffer, os.getpid()
+    return read_buffer
+
+
+def mark_post_read(db, discussion_id, post, user_id):
+    """Mark a post read by a user, through the write-behind buffer if
+    there is one. Returns whether the post was not read before."""
+    if post.id in UserReadPosts.all_post_ids(db, discussion_id, user_id):
+        return False
+    read_buffer = get_read_buffer()
+    if read_buffer is None or not read_buffer.add(
+            discussion_id, user_id, post.id):
+        db.add(ViewPost(post=post, actor_id=user_id))
+    return True
+
+
+def mark_post_unread(db, discussion_id, post_id, user_id):
+    """Mark a post unread by a user. Returns whether it was read."""
+    read_buffer = get_read_buffer()
+    was_pending = False
+    if read_buffer is not None:
+        was_pending = post_id in read_buffer.pending(discussion_id, user_id)
+        read_buffer.discard(discussion_id, user_id, post_id)
+    view = db.query(ViewPost).filter_by(
+        post_id=post_id, actor_id=user_id, tombstone_date=None).first()
+    if view:
+        view.is_tombstone = True
+    return was_pending or view is not None
+
+
+# Changes are noted during the flush, and applied at the end of the flush,
+# in the same transaction.
+
+def _note_change(target, read):
+    _changes.note(target, (target.post_id, target.actor_id, read))
+
+
+def _apply_changes(session, changes):
+    discussion_of_post = dict(session.query(
+        Content.id, Content.discussion_id).filter(
+        Content.id.in_({post_id for (post_id, _, _) in changes})))
+    # The last change to a post wins
+    state = {}
+    for (post_id, user_id, read) in changes:
+        if post_id in discussion_of_post:
+            state[(discussion_of_post[post_id], user_id, post_id)] = read
+    added = {}
+    removed = {}
+    for ((discussion_id, user_id, post_id), read) in state.items():
+        (added if read else removed).setdefault(
+            (discussion_id, user_id), []).append(post_id)
+    for ((discussion_id, user_id), post_ids) in added.items():
+        add_read_posts(session, discussion_id, user_id, post_ids)
+    for ((discussion_id, user_id), post_ids) in removed.items():
+        remove_read_posts(session, discussion_id, user_id, post_ids)
+
+
+def _view_inserted(mapper, connection, target):
+    if target.tombstone_date is None:
+        _note_change(target, True)
+
+
+def _view_updated(mapper, connection, target):
+    if attribute_changed(target, 'tombstone_date'):
+        _note_change(target, target.tombstone_date is None)
+
+
+def _view_deleted(mapper, connection, target):
+    if target.tombstone_date is None:
+        _note_change(target, False)
+
+
+_changes = FlushChanges('read_post_changes', _apply_changes)
+event.listen(ViewPost, 'after_insert', _view_inserted, propagate=True)
+event.listen(ViewPost, 'after_update', _view_updated, propagate=True)
+event.listen(ViewPost, 'after_delete', _view_deleted, propagate=True)
@@ -1,23 +1,40 @@
 """This process obtains JSON representations of modified, created or deleted
 database objects through ZeroMQ, and feeds them to browser clients
-through a websocket."""
+through a websocket.
+
+A broker thread receives the changesets from the application processes and
+gives them a sequence number. With ``changes_router_workers`` above 1,
+the websocket connections are spread over that many worker processes,
+which share the listening socket and subscribe to the broker through
+``changes_router_socket``. Each HTTP request may then reach a different
+worker, so only the websocket transport of SockJS is offered: the other
+transports make several requests per session.
+
+Connection and message counts are served at ``/stats`` on
+``changes_stats_port``, on the loopback interface only."""
 from __future__ import print_function
 
 import signal
 import time
 import sys
-from os import makedirs, access, R_OK, W_OK
+from os import makedirs, access, getpid, R_OK, W_OK
 from os.path import exists, dirname
 import ConfigParser
 import traceback
 from time import sleep
+from threading import Thread
+from multiprocessing import Process
+from collections import defaultdict, Counter, deque
 
 import simplejson as json
 import zmq
 from zmq.eventloop import ioloop
 from zmq.eventloop import zmqstream
-import requests
-from tornado import web
+from tornado import web, gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from sockjs.tornado import SockJSRouter, SockJSConnection
 from tornado.httpserver import HTTPServer
 
@@ -34,12 +51,40 @@ if len(sys.argv) != 2:
 
 SECTION = 'app:assembl'
 
-settings = ConfigParser.ConfigParser({'changes_prefix': ''})
+settings = ConfigParser.ConfigParser({
+    'changes_prefix': '',
+    'changes_replay_buffer_size': '200',
+    'changes_replay_grace_period': '300',
+    'changes_permission_cache_ttl': '300',
+    'changes_router_workers': '1',
+    'changes_stats_port': '0',
+    'changes_router_socket': ''})
 settings.read(sys.argv[-1])
 CHANGES_SOCKET = settings.get(SECTION, 'changes_socket')
 CHANGES_PREFIX = settings.get(SECTION, 'changes_prefix')
 TOKEN_SECRET = settings.get(SECTION, 'session.secret')
 WEBSERVER_PORT = settings.getint(SECTION, 'changes_websocket_port')
+# How many changesets are kept per discussion for reconnecting clients
+REPLAY_BUFFER_SIZE = settings.getint(SECTION, 'changes_replay_buffer_size')
+# How long (in seconds) to keep following a discussion without connections
+REPLAY_GRACE_PERIOD = settings.getint(SECTION, 'changes_replay_grace_period')
+# How long (in seconds) to trust a read permission check
+PERMISSION_CACHE_TTL = settings.getint(
+    SECTION, 'changes_permission_cache_ttl')
+NUM_WORKERS = settings.getint(SECTION, 'changes_router_workers')
+# Where the stats are served, on localhost; worker n uses this port + n.
+STATS_PORT = settings.getint(SECTION, 'changes_stats_port')
+# Where workers get the changesets from the broker
+if NUM_WORKERS > 1:
+    ROUTER_SOCKET = settings.get(SECTION, 'changes_router_socket')
+    if not ROUTER_SOCKET:
+        assert CHANGES_SOCKET.startswith('ipc://'),\
+            "changes_router_socket is required with a tcp changes_socket"
+        ROUTER_SOCKET = CHANGES_SOCKET + '_router'
+else:
+    ROUTER_SOCKET = INTERNAL_SOCKET
+# Margin (in ms) for changesets published while we subscribe
+SUBSCRIPTION_MARGIN = 1000
 # NOTE: Not sure those are always what we want.
 SERVER_HOST = settings.get(SECTION, 'public_hostname')
 SERVER_PORT = settings.getint(SECTION, 'public_port')
@@ -50,21 +95,261 @@ if REQUIRES_SECURE and SERVER_PORT == 80:
     SERVER_PORT = 443
 SERVER_URL = "%s://%s:%d" % (SERVER_PROTOCOL, SERVER_HOST, SERVER_PORT)
 
-context = zmq.Context.instance()
-ioloop.install()
-io_loop = ioloop.IOLoop.instance()  # ZMQ loop
 
-if CHANGES_SOCKET.startswith('ipc://'):
-    dir = dirname(CHANGES_SOCKET[6:])
-    if not exists(dir):
-        makedirs(dir)
 
-td = zmq.devices.ThreadDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
-td.bind_in(CHANGES_SOCKET)
-td.bind_out(INTERNAL_SOCKET)
-td.setsockopt_in(zmq.IDENTITY, 'XSUB')
-td.setsockopt_out(zmq.IDENTITY, 'XPUB')
-td.start()
+def run_broker(xsub, xpub):
+    """Forward changesets from the application to the router workers,
+    replacing the publisher's order with a sequence number.
+
+    Sequence numbers follow the clock (in ms) when they can,
+    so they keep increasing across restarts.
+    Subscriptions are forwarded the other way."""
+    poller = zmq.Poller()
+    poller.register(xsub, zmq.POLLIN)
+    poller.register(xpub, zmq.POLLIN)
+    seq = 0
+    while True:
+        try:
+            events = dict(poller.poll())
+            if xsub in events:
+                frames = xsub.recv_multipart()
+                if len(frames) > 2:
+                    seq = max(seq + 1, int(time.time() * 1000))
+                    frames[1] = str(seq)
+                    print(frames)
+                xpub.send_multipart(frames)
+            if xpub in events:
+                xsub.send_multipart(xpub.recv_multipart())
+        except zmq.ContextTerminated:
+            return
+        except Exception:
+            capture_exception()
+
+
+def start_broker(context):
+    "The bound (xsub, xpub) sockets of the broker"
+    broker_in = context.socket(zmq.XSUB)
+    broker_in.bind(CHANGES_SOCKET)
+    broker_out = context.socket(zmq.XPUB)
+    broker_out.bind(ROUTER_SOCKET)
+    return (broker_in, broker_out)
+
+
+def run_broker_process():
+    run_broker(*start_broker(zmq.Context()))
+
+
+class ReplayBuffer(object):
+    """Keeps the last changesets of each discussion, with their sequence
+    number, so reconnecting clients can receive what they missed.
+
+    Changesets for all discussions (``*``) have their own buffer.
+    We remember the sequence number of the last changeset dropped from
+    each buffer: clients that have not seen it need a full reload."""
+
+    def __init__(self, size, start_seq):
+        self.size = size
+        self.start_seq = start_seq
+        self.buffers = {}
+        self.dropped = {}
+
+    def append(self, discussion, seq, public, private):
+        buffer = self.buffers.get(discussion, None)
+        if buffer is None:
+            buffer = self.buffers[discussion] = deque(maxlen=self.size)
+        if len(buffer) == self.size:
+            self.dropped[discussion] = buffer[0][0]
+        buffer.append((seq, public, private))
+
+    def reset(self, discussion, seq):
+        """Forget a discussion's changesets up to the given sequence."""
+        self.buffers.pop(discussion, None)
+        self.dropped[discussion] = seq
+
+    def since(self, discussion, seq):
+        """Return the (seq, public, private) changesets after the given
+        sequence number, or None if some of them were dropped."""
+        entries = []
+        for key in (discussion, '*'):
+            if seq < self.dropped.get(key, self.start_seq):
+                return None
+            entries.extend(entry for entry in self.buffers.get(key, ())
+                           if entry[0] > seq)
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+
+class ReadPermissionCache(object):
+    """Asks the application server whether a user can read a discussion,
+    without blocking the IOLoop, and remembers the answer for a while.
+
+    Concurrent checks for the same user and discussion share a request.
+    Answers are forgotten when the changes feed shows a change of the
+    user's roles, or of the discussion's permissions. The feed only
+    covers discussions with subscribers, so refusals are kept for
+    denied_ttl seconds only."""
+
+    def __init__(self, ttl, denied_ttl=5):
+        self.ttl = ttl
+        self.denied_ttl = denied_ttl
+        self.answers = {}
+        self.pending = {}
+        self.invalidations = 0
+        self.http_client = AsyncHTTPClient()
+
+    @gen.coroutine
+    def can_read(self, discussion, user_id):
+        key = (discussion, str(user_id))
+        answer = self.answers.get(key, None)
+        if answer is not None and answer[0] > time.time():
+            raise gen.Return(answer[1])
+        future = self.pending.get(key, None)
+        if future is None:
+            future = self.pending[key] = self.fetch(key)
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        allowed = yield future
+        raise gen.Return(allowed)
+
+    @gen.coroutine
+    def fetch(self, key):
+        discussion, user_id = key
+        invalidations = self.invalidations
+        response = yield self.http_client.fetch(
+            '%s/api/v1/discussion/%s/permissions/read/u/%s' % (
+                SERVER_URL, discussion, user_id),
+            raise_error=False)
+        print(response.code, response.body)
+        if response.code != 200:
+            raise gen.Return(False)
+        allowed = response.body == 'true'
+        if invalidations == self.invalidations:
+            # Do not cache answers that may predate a change
+            self.answers[key] = (
+                time.time() + (self.ttl if allowed else self.denied_ttl),
+                allowed)
+        raise gen.Return(allowed)
+
+    def invalidate(self, discussion=None, user_id=None):
+        """Forget the answers for a discussion and/or user (None for all)"""
+        self.invalidations += 1
+        for key in self.answers.keys():
+            if discussion not in (None, key[0]):
+                continue
+            if user_id not in (None, key[1]):
+                continue
+            del self.answers[key]
+
+    def on_changes(self, discussion, public, private):
+        """Look for role and permission changes in a changeset."""
+        if discussion == '*':
+            discussion = None
+        if 'DiscussionPermission' in public:
+            self.invalidate(discussion)
+        for user_uri, changes in private.iteritems():
+            if 'UserRole' in changes:
+                self.invalidate(discussion, user_uri.rsplit('/', 1)[-1])
+
+
+class DiscussionFanout(object):
+    """Holds a single subscription to the changes for all discussions,
+    and dispatches each changeset to the connections registered for
+    its discussion.
+
+    Topics are added to the ZMQ subscription when the first connection to a
+    discussion registers, and removed some time after the last one leaves,
+    so clients that reconnect quickly can be given the changes they missed.
+    Each changeset received gets a sequence number."""
+
+    def __init__(self, context, io_loop, permission_cache):
+        self.io_loop = io_loop
+        self.permission_cache = permission_cache
+        self.socket = context.socket(zmq.SUB)
+        self.socket.connect(ROUTER_SOCKET)
+        self.socket.setsockopt(zmq.SUBSCRIBE, '*')
+        self.stream = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
+        self.stream.on_recv(self.on_recv)
+        self.connections = defaultdict(set)
+        self.subscribed = set()
+        self.unsubscribe_timeouts = {}
+        self.last_seq = 0
+        self.replay = ReplayBuffer(REPLAY_BUFFER_SIZE, self.seq_bound())
+        self.messages = Counter()
+        self.deliveries = Counter()
+
+    def seq_bound(self):
+        """A sequence number above any changeset that we may have missed
+        so far. Sequence numbers follow the clock, when they can."""
+        return max(self.last_seq, int(time.time() * 1000)) + \
+            SUBSCRIPTION_MARGIN
+
+    def add(self, discussion, connection):
+        timeout = self.unsubscribe_timeouts.pop(discussion, None)
+        if timeout is not None:
+            self.io_loop.remove_timeout(timeout)
+        if discussion not in self.subscribed:
+            # We may have missed changesets since we last followed it
+            self.replay.reset(discussion, self.seq_bound())
+            self.socket.setsockopt(zmq.SUBSCRIBE, discussion)
+            self.subscribed.add(discussion)
+        self.connections[discussion].add(connection)
+
+    def remove(self, discussion, connection):
+        connections = self.connections.get(discussion, None)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self.connections[discussion]
+            self.messages.pop(discussion, None)
+            self.deliveries.pop(discussion, None)
+            self.unsubscribe_timeouts[discussion] = self.io_loop.call_later(
+                REPLAY_GRACE_PERIOD, self.unsubscribe, discussion)
+
+    def unsubscribe(self, discussion):
+        self.unsubscribe_timeouts.pop(discussion, None)
+        if discussion in self.connections:
+            return
+        self.subscribed.discard(discussion)
+        self.replay.reset(discussion, self.seq_bound())
+        self.socket.setsockopt(zmq.UNSUBSCRIBE, discussion)
+
+    def on_recv(self, frames):
+        # discussion, sequence, public changes, (user uri, private changes)*
+        discussion = frames[0]
+        public = frames[2]
+        private = dict(zip(frames[3::2], frames[4::2]))
+        if discussion == '*':
+            targets = [connection
+                       for connections in self.connections.itervalues()
+                       for connection in connections]
+        elif discussion in self.subscribed:
+            # ZMQ subscriptions match on prefix, so check the exact topic.
+            targets = list(self.connections.get(discussion, ()))
+        else:
+            return
+        self.permission_cache.on_changes(discussion, public, private)
+        seq = int(frames[1])
+        self.last_seq = max(self.last_seq, seq)
+        self.replay.append(discussion, seq, public, private)
+        self.messages[discussion] += 1
+        self.deliveries[discussion] += len(targets)
+        for connection in targets:
+            connection.deliver(seq, public, private)
+
+    def stats(self):
+        return {
+            "pid": getpid(),
+            "discussions": self.discussion_stats()}
+
+    def discussion_stats(self):
+        return {
+            discussion: {
+                "connections": len(connections),
+                "messages": self.messages[discussion],
+                "deliveries": self.deliveries[discussion],
+            } for (discussion, connections) in self.connections.iteritems()}
+
+
 
 
 class ZMQRouter(SockJSConnection):
@@ -72,22 +357,28 @@ class ZMQRouter(SockJSConnection):
     token = None
     discussion = None
     userId = None
+    subscribed = False
+    checking = False
+    since = None
 
     def on_open(self, request):
         self.valid = True
         self.closing = False
 
-    def on_recv(self, data):
+    def deliver(self, seq, public, private):
         try:
-            data = data[-1]
-            if '@private' in data:
-                jsondata = json.loads(data)
-                jsondata = [x for x in jsondata
-                            if x.get('@private', self.userId) == self.userId]
-                if not jsondata:
-                    return
-                data = json.dumps(jsondata)
-            self.send(data)
+            data = public
+            private_data = private.get(self.userId, None)
+            if private_data:
+                # Concatenate the serialized JSON arrays
+                if data == '[]':
+                    data = private_data
+                else:
+                    data = data[:-1] + ',' + private_data[1:]
+            if data == '[]':
+                return
+            # Prepend the sequence number, for resuming
+            self.send('[{"@type":"Sequence","seq":%d},%s' % (seq, data[1:]))
         except Exception:
             capture_exception()
             self.do_close()
@@ -95,20 +386,23 @@ class ZMQRouter(SockJSConnection):
     def do_close(self):
         self.closing = True
         self.close()
-        self.socket = None
-        if getattr(self, "loop", None):
-            self.loop.stop_on_recv()
-            self.loop.close()
-            self.loop = None
+        if self.subscribed:
+            fanout.remove(self.discussion, self)
+            self.subscribed = False
 
     def on_message(self, msg):
         try:
-            if getattr(self, 'socket', None):
+            if self.subscribed:
                 print("closing old socket")
-                self.loop.add_callback(self.do_close)
+                io_loop.add_callback(self.do_close)
                 return
+            if msg.startswith('since:') and self.valid:
+                try:
+                    self.since = int(msg.split(':', 1)[1])
+                except ValueError:
+                    pass
             if msg.startswith('discussion:') and self.valid:
-                self.discussion = msg.split(':', 1)[1]
+                self.discussion = str(msg.split(':', 1)[1])
             if msg.startswith('token:') and self.valid:
                 try:
                     self.token = decode_token(
@@ -117,27 +411,39 @@ class ZMQRouter(SockJSConnection):
                         self.token['userId'])
                 except TokenInvalid:
                     pass
-            if self.token and self.discussion:
-                # Check if token authorizes discussion
-                r = requests.get(
-                    '%s/api/v1/discussion/%s/permissions/read/u/%s' %
-                    (SERVER_URL, self.discussion,
-                        self.token['userId']))
-                print(r.text)
-                if r.text != 'true':
-                    return
-                self.socket = context.socket(zmq.SUB)
-                self.socket.connect(INTERNAL_SOCKET)
-                self.socket.setsockopt(zmq.SUBSCRIBE, '*')
-                self.socket.setsockopt(zmq.SUBSCRIBE, str(self.discussion))
-                self.loop = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
-                self.loop.on_recv(self.on_recv)
-                print("connected")
-                self.send('[{"@type":"Connection"}]')
+            if self.token and self.discussion and not self.checking:
+                self.subscribe()
         except Exception:
             capture_exception()
             self.do_close()
 
+    @gen.coroutine
+    def subscribe(self):
+        self.checking = True
+        try:
+            # Check if token authorizes discussion
+            allowed = yield permission_cache.can_read(
+                self.discussion, self.token['userId'])
+            if not allowed or self.closing:
+                return
+            fanout.add(self.discussion, self)
+            self.subscribed = True
+            print("connected")
+            replay = None
+            if self.since is not None:
+                replay = fanout.replay.since(self.discussion, self.since)
+            self.send(json.dumps([{
+                "@type": "Connection",
+                "seq": fanout.last_seq,
+                "resumed": replay is not None}]))
+            for (seq, public, private) in replay or ():
+                self.deliver(seq, public, private)
+        except Exception:
+            capture_exception()
+            self.do_close()
+        finally:
+            self.checking = False
+
     def on_close(self):
         if self.closing:
             return
@@ -149,37 +455,31 @@ class ZMQRouter(SockJSConnection):
             raise
 
 
-def logger(msg):
-    print(msg)
-
+class StatsHandler(web.RequestHandler):
+    """Connection and message counts per discussion, for local monitoring.
+    Served on its own port, as requests proxied by nginx come from
+    localhost too."""
 
-def log_queue():
-    socket = context.socket(zmq.SUB)
-    socket.connect(INTERNAL_SOCKET)
-    socket.setsockopt(zmq.SUBSCRIBE, '')
-    loop = zmqstream.ZMQStream(socket, io_loop=io_loop)
-    loop.on_recv(logger)
+    def get(self):
+        self.write(fanout.stats())
 
-log_queue()
 
-sockjs_router = SockJSRouter(
-    ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop,
-    user_settings={"websocket_allow_origin": SERVER_URL})
-routes = sockjs_router.urls
-web_app = web.Application(routes, debug=False)
+def log_stats():
+    stats = fanout.discussion_stats()
+    if stats:
+        print("stats", getpid(), json.dumps(stats))
 
 
 def term(*_ignore):
     web_server.stop()
+    if stats_server is not None:
+        stats_server.stop()
     io_loop.add_timeout(time.time() + 0.3, io_loop.stop)
 
-signal.signal(signal.SIGTERM, term)
 
-web_server = HTTPServer(web_app)
-web_server.listen(WEBSERVER_PORT)
-try:
-    if CHANGES_SOCKET.startswith('ipc://'):
-        sname = CHANGES_SOCKET[6:]
+def check_ipc_socket(socket_name):
+    if socket_name.startswith('ipc://'):
+        sname = socket_name[6:]
         for i in range(5):
             if exists(sname):
                 break
@@ -188,6 +488,69 @@ try:
             raise RuntimeError("could not create socket " + sname)
         if not access(sname, R_OK | W_OK):
             raise RuntimeError(sname + " cannot be accessed")
+
+
+for socket_name in (CHANGES_SOCKET, ROUTER_SOCKET):
+    if socket_name.startswith('ipc://'):
+        dir = dirname(socket_name[6:])
+        if not exists(dir):
+            makedirs(dir)
+
+if NUM_WORKERS > 1:
+    # A ZMQ context cannot be used across a fork, so the broker runs in
+    # its own process, and no context is created before the workers fork.
+    broker = Process(target=run_broker_process, name='changes_broker')
+    broker.daemon = True
+    broker.start()
+    check_ipc_socket(CHANGES_SOCKET)
+    check_ipc_socket(ROUTER_SOCKET)
+    # The listening socket is shared by the workers
+    http_sockets = bind_sockets(WEBSERVER_PORT)
+    # Only returns in the workers; the parent restarts them as needed.
+    task_id = fork_processes(NUM_WORKERS)
+    # pyzmq does not check the pid in Context.instance()
+    zmq.Context._instance = None
+    context = zmq.Context.instance()
+else:
+    context = zmq.Context.instance()
+    broker = Thread(target=run_broker, args=start_broker(context))
+    broker.daemon = True
+    broker.start()
+    check_ipc_socket(CHANGES_SOCKET)
+    check_ipc_socket(ROUTER_SOCKET)
+    http_sockets = bind_sockets(WEBSERVER_PORT)
+    task_id = 0
+
+ioloop.install()
+io_loop = ioloop.IOLoop.instance()  # ZMQ loop
+permission_cache = ReadPermissionCache(PERMISSION_CACHE_TTL)
+fanout = DiscussionFanout(context, io_loop, permission_cache)
+
+stats_logger = PeriodicCallback(log_stats, 60000, io_loop=io_loop)
+stats_logger.start()
+
+sockjs_settings = {"websocket_allow_origin": SERVER_URL}
+if NUM_WORKERS > 1:
+    # Workers do not share sessions
+    sockjs_settings["disabled_transports"] = [
+        'xhr', 'xhr_send', 'xhr_streaming', 'jsonp', 'jsonp_send',
+        'htmlfile', 'eventsource']
+sockjs_router = SockJSRouter(
+    ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop,
+    user_settings=sockjs_settings)
+web_app = web.Application(sockjs_router.urls, debug=False)
+
+signal.signal(signal.SIGTERM, term)
+
+web_server = HTTPServer(web_app)
+web_server.add_sockets(http_sockets)
+stats_server = None
+if STATS_PORT:
+    stats_server = HTTPServer(
+        web.Application([('/stats', StatsHandler)], debug=False))
+    stats_server.add_sockets(
+        bind_sockets(STATS_PORT + task_id, '127.0.0.1'))
+try:
     io_loop.start()
 except KeyboardInterrupt:
     term()
@@ -386,6 +386,9 @@ def clone_discussion(
         from_session, discussion_id, to_session=None, new_slug=None):
     from assembl.models import (
         DiscussionBoundBase, Discussion, Post, User, Preferences, HistoryMixin)
+    from assembl.models.idea_counters import rebuild_idea_counts
+    from assembl.models.idea_post_membership import \
+        rebuild_idea_post_membership
     global user_refs
     discussion = from_session.query(Discussion).get(discussion_id)
     assert discussion
@@ -592,9 +595,10 @@ def clone_discussion(
     copy = recursive_clone(discussion, path)
     stage_2_rec_clone(discussion, path)
     to_session.flush()
-    for p in to_session.query(Post).filter_by(
-            discussion=copy, parent_id=None).all():
-        p._set_ancestry('')
+    Post.rebuild_ancestry(to_session, copy.id)
+    # The ancestries were set in bulk, without the usual flush events
+    rebuild_idea_post_membership(to_session, copy.id)
+    rebuild_idea_counts(to_session, copy.id)
     to_session.flush()
     return copy
 
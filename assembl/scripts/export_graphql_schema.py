@@ -1,5 +1,7 @@
-"""Export complete schema model from GraphQL to JSON."""
+"""Export complete schema model from GraphQL to JSON, and optionally the
+persisted queries of the front end."""
 import argparse
+import os
 import traceback
 import pdb
 
@@ -13,6 +15,7 @@ from assembl.lib.sqla import configure_engine
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("configuration", help="The configuration of the application.", default="local.ini")
+    parser.add_argument("--persisted-queries", help="Also write the registry of persisted queries to this file.")
     args = parser.parse_args()
     env = bootstrap(args.configuration)
     settings = get_appsettings(args.configuration, 'assembl')
@@ -23,6 +26,11 @@ def main():
     try:
         from assembl.graphql.schema import Schema, generate_schema_json_from_schema
         generate_schema_json_from_schema(Schema, spec_wrap=True)
+        if args.persisted_queries:
+            from assembl.graphql.documents import write_registry
+            graphql_dir = os.path.join(os.path.dirname(os.path.dirname(
+                __file__)), 'static2', 'js', 'app', 'graphql')
+            write_registry(graphql_dir, args.persisted_queries)
 
     except Exception as _:
         traceback.print_exc()
@@ -0,0 +1,49 @@
+"""Compute again the stored idea hierarchy, the posts ideas show,
+the posts read by users, and the post counts of ideas."""
+from __future__ import print_function
+import logging.config
+import argparse
+
+from pyramid.paster import get_appsettings, bootstrap
+import transaction
+
+from assembl.lib.sqla import configure_engine, get_session_maker
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "configuration",
+        help="configuration file with destination database configuration")
+    parser.add_argument(
+        "-d", "--discussion", type=int, action="append",
+        help="id of a discussion to rebuild (default: all)")
+    args = parser.parse_args()
+    bootstrap(args.configuration)
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    from assembl.models import Discussion
+    from assembl.models.idea_counters import rebuild_idea_counts
+    from assembl.models.idea_closure import rebuild_idea_closure
+    from assembl.models.idea_post_membership import \
+        rebuild_idea_post_membership
+    from assembl.models.read_posts import rebuild_read_posts
+    session = get_session_maker()()
+    discussion_ids = args.discussion or [
+        id for (id,) in session.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        with transaction.manager:
+            rebuild_idea_closure(session, discussion_id)
+            rebuild_idea_post_membership(session, discussion_id)
+            rebuild_read_posts(session, discussion_id)
+            rebuild_idea_counts(session, discussion_id)
+        print("Rebuilt the idea counters of discussion %d" % discussion_id)
+
+
+if __name__ == '__main__':
+    main()
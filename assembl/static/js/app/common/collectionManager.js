@@ -329,7 +329,11 @@ var CollectionManager = Marionette.Object.extend({
     this._allMessageStructureCollection.collectionManager = this;
     this._allMessageStructureCollectionPromise = Promise.resolve(this._allMessageStructureCollection.fetch())
       .then(function() {
-        that.listenTo(Assembl.vent, 'socket:open', function() {
+        that.listenTo(Assembl.vent, 'socket:open', function(resumed) {
+          if (resumed) {
+            // The changes router sent us what we missed
+            return;
+          }
           //Yes, I want that in sentry for now
           console.debug("collectionManager: getAllMessageStructureCollectionPromise re-fetching because of socket re-open.");
           //console.log(that._allMessageStructureCollection);
@@ -58,6 +58,10 @@ Socket.prototype.onOpen = function(ev) {
   if (Ctx.debugSocket) {
     console.log("Socket::onOpen()");
   }
+  if (this.lastSeq !== undefined) {
+    // Ask for the changes we missed while disconnected
+    this.socket.send("since:" + this.lastSeq);
+  }
   this.socket.send("token:" + Ctx.getCsrfToken());
   this.socket.send("discussion:" + Ctx.getDiscussionId());
   if (Ctx.debugSocket) {
@@ -84,19 +88,25 @@ Socket.prototype.onMessage = function(ev) {
   if (Ctx.debugSocket) {
     console.log("Socket::onMessage()");
   }
+  var data = JSON.parse(ev.data),
+      i = 0,
+      len = data.length;
+
   if (this.state === Socket.STATE_CONNECTING) {
+    // The first message describes the connection.
+    // If resumed, the changes we missed follow, and need not be refetched.
+    var resumed = len > 0 && data[0].resumed === true;
+    if (len > 0 && !resumed && data[0].seq !== undefined) {
+      this.lastSeq = data[0].seq;
+    }
     this.connectCallback(this);
-    App.vent.trigger('socket:open');
+    App.vent.trigger('socket:open', resumed);
     if (Ctx.debugSocket) {
       console.log("Socket::onOpen() state is now STATE_OPEN");
     }
     this.state = Socket.STATE_OPEN;
   }
 
-  var data = JSON.parse(ev.data),
-      i = 0,
-      len = data.length;
-
   for (; i < len; i += 1) {
     this.processData(data[i]);
   }
@@ -144,6 +154,10 @@ Socket.prototype.processData = function(item) {
     if (item['@type'] == "Connection") {
       //Ignore Connections
       return;
+    }
+    else if (item['@type'] == "Sequence") {
+      this.lastSeq = item.seq;
+      return;
     } 
     else {
       if (Ctx.debugSocket) {
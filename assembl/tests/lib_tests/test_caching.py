@@ -2,7 +2,7 @@ import pytest
 import mock
 from assembl.models import Discussion
 
-from assembl.lib.caching import create_analytics_region
+from assembl.lib.caching import create_analytics_region, RedisVersionStamps
 
 
 def test_dogpile_cache():
@@ -45,3 +45,18 @@ def test_cache_key(test_session):
     test_session.delete(preferences)
     test_session.delete(d)
     test_session.flush()
+
+
+def test_version_stamps_after_failed_incr():
+    redis = mock.MagicMock()
+    redis.get.return_value = '3'
+    redis.incr.side_effect = Exception("connection refused")
+    versions = RedisVersionStamps(redis, 'test:')
+    versions.incr(('discussion', 1))
+    # Entries cached now would not be reloaded
+    assert versions.get(('discussion', 2)) is None
+    assert versions.get_many([('discussion', 2)]) is None
+    redis.incr.side_effect = None
+    assert versions.get(('discussion', 2)) == 3
+    redis.incr.assert_called_with('test:discussion:1')
+    assert not versions.failed
@@ -0,0 +1,57 @@
+from time import sleep
+
+from sqlalchemy.sql import column, table
+
+from assembl.lib.read_write_session import (
+    LocalPrimaryPins, ReadWriteSession, ReplicaMonitor)
+
+
+class FakeEngine(object):
+    pass
+
+
+class FakeMonitor(ReplicaMonitor):
+    def __init__(self, lags, check_interval=0):
+        super(FakeMonitor, self).__init__(None, 5, check_interval)
+        self.lags = lags
+
+    def lag(self):
+        lag = self.lags.pop(0)
+        if lag is None:
+            raise RuntimeError("replica is down")
+        return lag
+
+
+def test_read_write_session_bind():
+    primary, replica = FakeEngine(), FakeEngine()
+    session = ReadWriteSession(bind=primary, read_bind=replica)
+    assert session.get_bind() is primary
+    session.set_readonly()
+    assert session.get_bind() is replica
+    # writes go to the primary, and so do later reads
+    assert session.get_bind(clause=table('t', column('a')).insert()) is primary
+    assert session.wrote
+    assert session.get_bind() is primary
+    assert not session.can_use_replica()
+
+
+def test_replica_monitor():
+    monitor = FakeMonitor([1, 10, 2, None])
+    assert monitor.is_available()
+    assert not monitor.is_available()
+    assert monitor.is_available()
+    assert not monitor.is_available()
+    # the lag is checked once per interval
+    monitor = FakeMonitor([10, 1], check_interval=60)
+    assert not monitor.is_available()
+    assert not monitor.is_available()
+    assert monitor.lags == [1]
+
+
+def test_primary_pins():
+    pins = LocalPrimaryPins(0.1)
+    pins.pin(1)
+    assert pins.is_pinned(1)
+    assert not pins.is_pinned(2)
+    sleep(0.2)
+    assert not pins.is_pinned(1)
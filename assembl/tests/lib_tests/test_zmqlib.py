@@ -0,0 +1,59 @@
+import time
+
+import simplejson as json
+import mock
+import zmq
+
+from assembl.lib import zmqlib
+from assembl.lib.zmqlib import split_private_changes, send_changes
+
+
+def test_split_private_changes():
+    changes = [
+        {"@id": "local:Post/1"},
+        {"@id": "local:UserRole/2", "@private": "local:AgentProfile/3"},
+        {"@id": "local:UserRole/4", "@private": "local:AgentProfile/3"},
+        {"@id": "local:UserRole/5", "@private": "local:AgentProfile/6"},
+    ]
+    public, private = split_private_changes(changes)
+    assert public == changes[:1]
+    assert private == {
+        "local:AgentProfile/3": changes[1:3],
+        "local:AgentProfile/6": changes[3:],
+    }
+
+
+def test_send_changes_frames():
+    socket = mock.MagicMock()
+    changes = [
+        {"@id": "local:Post/1"},
+        {"@id": "local:UserRole/2", "@private": "local:AgentProfile/3"},
+    ]
+    send_changes(socket, "1", changes)
+    frames = socket.send_multipart.call_args[0][0]
+    assert frames[0] == "1"
+    assert json.loads(frames[2]) == changes[:1]
+    assert frames[3] == "local:AgentProfile/3"
+    assert json.loads(frames[4]) == changes[1:]
+
+
+def test_pub_socket_waits_for_subscriber():
+    context = zmqlib.get_context()
+    subscriber = context.socket(zmq.SUB)
+    subscriber.bind('inproc://test_zmqlib')
+    subscriber.setsockopt(zmq.SUBSCRIBE, '')
+    try:
+        with mock.patch.multiple(
+                zmqlib, CHANGES_SOCKET='inproc://test_zmqlib',
+                MULTIPLEX=False, _publishers=zmqlib.local()):
+            start = time.time()
+            socket = zmqlib.get_pub_socket()
+            # Ready well before the timeout
+            assert time.time() - start < zmqlib.READY_TIMEOUT / 1000.0
+            assert zmqlib.get_pub_socket() is socket
+            send_changes(socket, "1", [{"@id": "local:Post/1"}])
+            assert subscriber.poll(1000)
+            assert subscriber.recv_multipart()[0] == "1"
+            socket.close()
+    finally:
+        subscriber.close()
@@ -64,6 +64,83 @@ def test_post_is_read_by_participant2_user(discussion, post_viewed,
     assert len(ids) == 0
 
 
+def test_read_posts_store(discussion, test_session, participant1_user,
+                          root_post_1, reply_post_1, reply_post_2):
+    from assembl.models import ViewPost
+    user_id = participant1_user.id
+    views = [ViewPost(post=post, actor_id=user_id)
+             for post in (reply_post_2, root_post_1, reply_post_1)]
+    test_session.add_all(views)
+    test_session.flush()
+    assert discussion.read_post_ids(user_id) == sorted(
+        [root_post_1.id, reply_post_1.id, reply_post_2.id])
+    views[2].is_tombstone = True
+    test_session.flush()
+    assert discussion.read_post_ids(user_id) == sorted(
+        [root_post_1.id, reply_post_2.id])
+    for view in views:
+        test_session.delete(view)
+    test_session.flush()
+    assert discussion.read_post_ids(user_id) == []
+
+
+def test_flush_read_buffer(discussion, test_session, participant1_user,
+                           root_post_1, reply_post_1):
+    from assembl.models import ViewPost
+    from assembl.models.read_posts import LocalReadBuffer, flush_reads
+    user_id = participant1_user.id
+    read_buffer = LocalReadBuffer()
+    for post in (reply_post_1, root_post_1, reply_post_1):
+        read_buffer.add(discussion.id, user_id, post.id)
+    assert read_buffer.pending(discussion.id, user_id) == {
+        root_post_1.id, reply_post_1.id}
+    flush_reads(test_session, read_buffer.pop_all())
+    assert read_buffer.pending(discussion.id, user_id) == set()
+    assert discussion.read_post_ids(user_id) == sorted(
+        [root_post_1.id, reply_post_1.id])
+    assert test_session.query(ViewPost).filter_by(
+        actor_id=user_id, post_id=root_post_1.id).count() == 1
+    # Flushing again the same reads adds nothing
+    flush_reads(test_session, {(discussion.id, user_id): {root_post_1.id}})
+    assert discussion.read_post_ids(user_id) == sorted(
+        [root_post_1.id, reply_post_1.id])
+
+
+def test_buffered_reads(discussion, test_session, participant1_user,
+                        root_post_1, reply_post_1, monkeypatch):
+    from assembl.lib.config import get_config
+    from assembl.models import ViewPost
+    from assembl.models import read_posts
+    user_id = participant1_user.id
+    # Long enough that the writing thread stays asleep
+    monkeypatch.setitem(get_config(), 'read_buffer_seconds', '3600')
+    monkeypatch.setitem(get_config(), 'read_buffer_redis', 'false')
+    monkeypatch.setattr(read_posts, '_read_buffer', None)
+    monkeypatch.setattr(read_posts, '_read_buffer_pid', None)
+    read_buffer = read_posts.get_read_buffer()
+    assert isinstance(read_buffer, read_posts.LocalReadBuffer)
+    for post in (root_post_1, reply_post_1):
+        assert read_posts.mark_post_read(
+            test_session, discussion.id, post, user_id)
+    test_session.flush()
+    # Pending, but already part of the read state
+    assert not test_session.query(ViewPost).filter_by(
+        actor_id=user_id).count()
+    assert discussion.read_post_ids(user_id) == sorted(
+        [root_post_1.id, reply_post_1.id])
+    assert not read_posts.mark_post_read(
+        test_session, discussion.id, root_post_1, user_id)
+    read_posts.flush_reads(test_session, read_buffer.pop_all())
+    assert read_posts.UserReadPosts.get_post_ids(
+        test_session, discussion.id, user_id) == sorted(
+        [root_post_1.id, reply_post_1.id])
+    assert test_session.query(ViewPost).filter_by(
+        actor_id=user_id).count() == 2
+    for view in test_session.query(ViewPost).filter_by(actor_id=user_id):
+        test_session.delete(view)
+    test_session.flush()
+
+
 def test_get_next_synthesis_id(discussion, discussion2):
     next_synthesis = discussion.get_next_synthesis_id()
     next_synthesis2 = discussion2.get_next_synthesis_id()
@@ -71,6 +148,30 @@ def test_get_next_synthesis_id(discussion, discussion2):
     assert discussion2.next_synthesis.id == next_synthesis2[0]
 
 
+def test_permission_cache(discussion_with_permissions, participant1_user,
+                          test_session):
+    from assembl.auth import P_ADMIN_DISC, R_ADMINISTRATOR
+    from assembl.auth.util import (
+        get_role_permissions, get_roles, user_has_permission)
+    from assembl.models import LocalUserRole, Role
+    discussion = discussion_with_permissions
+    assert P_ADMIN_DISC in get_role_permissions(discussion.id)[R_ADMINISTRATOR]
+    assert not user_has_permission(
+        discussion.id, participant1_user.id, P_ADMIN_DISC)
+    role = LocalUserRole(
+        user=participant1_user, discussion=discussion,
+        role=Role.get_role(R_ADMINISTRATOR, test_session))
+    test_session.add(role)
+    # Changes in the session are seen at once
+    assert user_has_permission(
+        discussion.id, participant1_user.id, P_ADMIN_DISC)
+    assert R_ADMINISTRATOR in get_roles(participant1_user.id, discussion.id)
+    test_session.delete(role)
+    test_session.flush()
+    assert not user_has_permission(
+        discussion.id, participant1_user.id, P_ADMIN_DISC)
+
+
 def test_get_user_permissions(discussion_with_permissions, participant1_user):
     user_permissions = discussion_with_permissions.get_user_permissions(
         participant1_user.id)
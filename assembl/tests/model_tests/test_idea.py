@@ -33,3 +33,84 @@ def test_idea_copy_and_commit(subidea_1_1, test_session):
         test_session.delete(entry)
     test_session.delete(boba_fett)
     test_session.commit()
+
+
+def test_children_dict_cache(discussion, root_idea, subidea_1, test_session):
+    from assembl.models import Idea, IdeaLink, LangString
+    test_session.commit()
+    children = Idea.children_dict(discussion.id)
+    assert children[root_idea.id] == [subidea_1.id]
+    assert Idea.children_dict(discussion.id) is children
+
+    idea = Idea(title=LangString.create(u"Cached or not", 'en'),
+                discussion=discussion)
+    link = IdeaLink(source=subidea_1, target=idea)
+    test_session.add(link)
+    test_session.flush()
+    # Uncommitted changes are not cached
+    assert Idea.children_dict(discussion.id)[subidea_1.id] == [idea.id]
+    assert Idea.children_dict(discussion.id)[subidea_1.id] == [idea.id]
+    assert subidea_1.id not in children
+
+    test_session.commit()
+    children = Idea.children_dict(discussion.id)
+    assert children[subidea_1.id] == [idea.id]
+    assert Idea.children_dict(discussion.id) is children
+
+    test_session.delete(link)
+    test_session.delete(idea)
+    test_session.commit()
+    assert subidea_1.id not in Idea.children_dict(discussion.id)
+
+
+def test_discussion_graph(
+        discussion, root_idea, subidea_1, subidea_1_1, subidea_1_1_1,
+        subidea_1_2, test_session):
+    from assembl.models import Idea
+    from assembl.models.idea import AppendingVisitor
+    graph = Idea.discussion_graph(discussion.id)
+    assert graph.root_id == root_idea.id
+    assert graph.parents[subidea_1_1_1.id] == [subidea_1_1.id]
+    # Sibling links have the same order
+    descendants = graph.descendant_ids(subidea_1.id)
+    assert descendants[0] == subidea_1.id
+    assert set(descendants) == {
+        subidea_1.id, subidea_1_1.id, subidea_1_1_1.id, subidea_1_2.id}
+    assert descendants.index(subidea_1_1_1.id) == \
+        descendants.index(subidea_1_1.id) + 1
+    assert Idea.visit_idea_ids_depth_first(
+        AppendingVisitor(), discussion.id)[:2] == [root_idea.id, subidea_1.id]
+    visitor = AppendingVisitor()
+    subidea_1.visit_ideas_depth_first(visitor)
+    assert [idea.id for idea in visitor.ideas] == descendants
+    visitor = AppendingVisitor()
+    subidea_1.visit_ideas_breadth_first(visitor)
+    assert visitor.ideas[0] == subidea_1
+    assert visitor.ideas[-1] == subidea_1_1_1
+
+
+def test_idea_closure(
+        discussion, root_idea, subidea_1, subidea_1_1, subidea_1_1_1,
+        subidea_1_2, test_session):
+    from assembl.models import Idea, IdeaClosure
+    assert set(subidea_1_1_1.get_all_ancestors(id_only=True)) == {
+        root_idea.id, subidea_1.id, subidea_1_1.id, subidea_1_1_1.id}
+    assert set(subidea_1.get_all_descendants(
+        id_only=True, inclusive=False)) == {
+        subidea_1_1.id, subidea_1_1_1.id, subidea_1_2.id}
+    query = Idea.get_ancestors_query_cls(
+        [subidea_1_1_1.id, subidea_1_2.id], inclusive=False)
+    assert {id for (id,) in test_session.query(query)} == {
+        root_idea.id, subidea_1.id, subidea_1_1.id}
+    assert IdeaClosure.ancestors_by_idea(
+        test_session, [subidea_1_1_1.id])[subidea_1_1_1.id] == [
+        subidea_1_1_1.id, subidea_1_1.id, subidea_1.id, root_idea.id]
+    # Moving a subtree
+    link = subidea_1_1.source_links[0]
+    link.source = subidea_1_2
+    test_session.flush()
+    assert set(subidea_1_1_1.get_all_ancestors(id_only=True)) == {
+        root_idea.id, subidea_1.id, subidea_1_2.id, subidea_1_1.id,
+        subidea_1_1_1.id}
+    link.source = subidea_1
+    test_session.flush()
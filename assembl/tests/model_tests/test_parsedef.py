@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-from assembl.auth import P_SYSADMIN
+from assembl.auth import P_SYSADMIN, Everyone
 
 
 def _test_load_fixture(test_webrequest, discussion, admin, fixture):
@@ -61,3 +61,27 @@ def test_load_mailbox(
         test_webrequest, discussion, admin_user, jack_layton_mailbox):
     _test_load_fixture(
         test_webrequest, discussion, admin_user, jack_layton_mailbox)
+
+
+def test_serialization_plan_is_cached(discussion, root_post_1):
+    cls = root_post_1.__class__
+    plan = cls.get_serialization_plan('default')
+    assert plan is cls.get_serialization_plan('default')
+    assert plan is not cls.get_serialization_plan('id_only')
+    json = root_post_1.generic_json(permissions=(P_SYSADMIN, ))
+    assert json == plan(root_post_1, Everyone, (P_SYSADMIN, ))
+    assert json['@view'] == 'default'
+
+
+def test_eager_loading_options_follow_view_def(discussion, root_post_1):
+    cls = root_post_1.__class__
+    plan = cls.get_serialization_plan('default')
+    relation_names = {reln.key for (reln, view_name) in plan.relations}
+    assert 'attachments' in relation_names
+    assert 'subject' in relation_names
+    options = cls.eager_loading_options('default')
+    assert len(options) >= len(plan.relations)
+    posts = discussion.db.query(cls).filter_by(
+        discussion_id=discussion.id).options(*options).all()
+    assert root_post_1 in posts
+    assert cls.eager_loading_options('no_such_view') == []
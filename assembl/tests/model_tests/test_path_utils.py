@@ -158,3 +158,132 @@ def test_delete_posts(
     assert reply_post_2.publication_state == PublicationStates.DELETED_BY_ADMIN
     assert reply_post_2.is_tombstone
     assert reply_post_1.is_tombstone
+
+
+def test_idea_counters_are_updated(
+        test_session, test_webrequest, participant1_user, reply_post_1,
+        reply_post_2, subidea_1_1, extract_post_1_to_subidea_1_1):
+    from assembl.models import IdeaCounters, IdeaUserCounters, ViewPost
+
+    def stored_counts():
+        return test_session.query(
+            IdeaCounters.num_posts, IdeaCounters.num_contributors
+        ).filter_by(idea_id=subidea_1_1.id).one()
+
+    def read_count():
+        return test_session.query(IdeaUserCounters.num_read_posts).filter_by(
+            idea_id=subidea_1_1.id, user_id=participant1_user.id).scalar()
+
+    # Stored when the extract was added, not when first read
+    assert stored_counts() == (2, 2)
+    assert subidea_1_1.num_posts == 2
+    view = ViewPost(post=reply_post_1, actor=participant1_user)
+    test_session.add(view)
+    test_session.flush()
+    assert read_count() == 1
+    reply_post_2.publication_state = PublicationStates.DELETED_BY_ADMIN
+    test_session.flush()
+    assert stored_counts() == (1, 1)
+    reply_post_1.publication_state = PublicationStates.DELETED_BY_ADMIN
+    test_session.flush()
+    assert stored_counts() == (0, 0)
+    assert read_count() == 0
+    test_session.delete(view)
+    test_session.flush()
+
+
+def test_idea_counters_follow_moved_posts(
+        test_session, test_webrequest, root_post_1, reply_post_1,
+        reply_post_2, reply_post_3, subidea_1, subidea_1_1,
+        extract_post_1_to_subidea_1_1):
+    from assembl.models import IdeaCounters
+    from assembl.models.idea_counters import compute_idea_counts
+
+    def stored_counts():
+        return dict(test_session.query(
+            IdeaCounters.idea_id, IdeaCounters.num_posts).filter(
+            IdeaCounters.idea_id.in_((subidea_1.id, subidea_1_1.id))))
+
+    def computed_counts():
+        return {idea_id: counts[0] for (idea_id, counts)
+                in compute_idea_counts(
+                    test_session, subidea_1.discussion_id,
+                    (subidea_1.id, subidea_1_1.id)).items()}
+
+    before = stored_counts()
+    assert before[subidea_1_1.id] == 2
+    reply_post_3.set_parent(reply_post_1)
+    test_session.flush()
+    assert stored_counts()[subidea_1_1.id] == 3
+    assert stored_counts() == computed_counts()
+    reply_post_3.set_parent(root_post_1)
+    test_session.flush()
+    assert stored_counts() == before
+
+
+def test_idea_post_membership_follows_links(
+        test_session, test_webrequest, root_post_1, reply_post_1,
+        reply_post_2, reply_post_3, root_idea, subidea_1, subidea_1_1,
+        extract_post_1_to_subidea_1_1):
+    from assembl.models import IdeaPostMembership
+
+    def members(idea):
+        return {id for (id,) in test_session.query(
+            IdeaPostMembership.post_id).filter_by(idea_id=idea.id)}
+
+    related = {reply_post_1.id, reply_post_2.id}
+    assert members(subidea_1_1) == related
+    assert related <= members(subidea_1)
+    assert related <= members(root_idea)
+    assert {id for (id,) in test_session.query(
+        subidea_1_1.get_related_posts_query(True))} == related
+    # Moving a post under the extract brings it in
+    reply_post_3.set_parent(reply_post_1)
+    test_session.flush()
+    assert members(subidea_1_1) == related | {reply_post_3.id}
+    reply_post_3.set_parent(root_post_1)
+    test_session.flush()
+    # Moving the extract to the parent idea empties the idea
+    extract_post_1_to_subidea_1_1.idea_id = subidea_1.id
+    test_session.flush()
+    assert not members(subidea_1_1)
+    assert related <= members(subidea_1)
+    extract_post_1_to_subidea_1_1.idea_id = subidea_1_1.id
+    test_session.flush()
+
+
+def test_set_parent_moves_thread(
+        test_session, root_post_1, reply_post_1, reply_post_2, reply_post_3):
+    reply_post_1.set_parent(reply_post_3)
+    test_session.flush()
+    expected = "%d,%d,%d," % (root_post_1.id, reply_post_3.id, reply_post_1.id)
+    assert reply_post_2.ancestry == expected
+    test_session.expire(reply_post_2, ['ancestry'])
+    assert reply_post_2.ancestry == expected
+    # Many posts at once, one moved below the other
+    Post.set_parents(test_session, {
+        reply_post_1: root_post_1, reply_post_3: reply_post_1})
+    test_session.flush()
+    assert reply_post_1.ancestry == "%d," % (root_post_1.id,)
+    assert reply_post_3.ancestry == "%d,%d," % (
+        root_post_1.id, reply_post_1.id)
+    assert reply_post_2.ancestry == "%d,%d," % (
+        root_post_1.id, reply_post_1.id)
+    reply_post_3.set_parent(root_post_1)
+    test_session.flush()
+
+
+def test_idea_ids_showing_posts(
+        test_session, test_webrequest, root_post_1, reply_post_1,
+        reply_post_2, subidea_1, subidea_1_1, extract_post_1_to_subidea_1_1):
+    from assembl.models import Idea
+    post_ids = [root_post_1.id, reply_post_1.id, reply_post_2.id]
+    by_post = Idea.get_idea_ids_showing_posts(post_ids)
+    for post_id in post_ids:
+        assert sorted(by_post[post_id]) == sorted(
+            Idea.get_idea_ids_showing_post(post_id))
+    assert by_post[root_post_1.id] == []
+    assert {subidea_1.id, subidea_1_1.id} <= set(by_post[reply_post_2.id])
+    counts = Idea.idea_read_counts_by_post(
+        subidea_1.discussion_id, post_ids, None)
+    assert dict(counts[reply_post_1.id])[subidea_1_1.id] == 0
@@ -398,6 +398,29 @@ def test_api_get_posts_queries(
     # TODO: Other query types, and sorting
 
 
+def test_api_get_posts_paginated_by_thread(
+        discussion, test_app, test_session, participant1_user,
+        root_post_1, reply_post_1, reply_post_2, root_post_for_tags):
+    base_post_url = get_url(discussion, 'posts')
+
+    url = base_post_url + "?view=id_only&order=chronological&page_size=1"
+    res = test_app.get(url)
+    assert res.status_code == 200
+    res_data = json.loads(res.body)
+    assert res_data['total'] == 4
+    assert res_data['threads'] == 2
+    assert res_data['maxPage'] == 2
+    assert {p['@id'] for p in res_data['posts']} == {
+        root_post_1.uri(), reply_post_1.uri(), reply_post_2.uri()}
+
+    res = test_app.get(url + "&page=2")
+    assert res.status_code == 200
+    res_data = json.loads(res.body)
+    assert res_data['total'] == 4
+    assert [p['@id'] for p in res_data['posts']] == [
+        root_post_for_tags.uri()]
+
+
 def test_api_weird_failure_on_joinedload(
         discussion, test_app, test_session, participant1_user,
         root_post_1, reply_post_1, reply_post_2):
@@ -156,6 +156,26 @@ def test_get_ideas(discussion, test_app, synthesis_1,
     assert subidea_1_1_1_id not in syn_ideas
 
 
+def test_collection_keyset_pagination(
+        test_app, discussion, root_post_1, reply_post_1, reply_post_2):
+    url = '/data/Discussion/%d/posts' % (discussion.id,)
+    all_posts = test_app.get(url + '?view=id_only').json
+    all_posts.sort(key=lambda uri: Post.get_database_id(uri))
+    assert len(all_posts) >= 3
+    first_page = test_app.get(url + '?view=id_only&limit=2')
+    assert first_page.json == all_posts[:2]
+    assert 'rel="next"' in first_page.headers['Link']
+    last_id = Post.get_database_id(all_posts[1])
+    rest = test_app.get(url + '?view=id_only&after=%d' % (last_id,))
+    assert rest.json == all_posts[2:]
+    streamed = test_app.get(url + '?view=id_only&stream=true')
+    assert streamed.json == all_posts
+    streamed = test_app.get(url + '?stream=true&limit=2')
+    assert [p['@id'] for p in streamed.json] == all_posts[:2]
+    bad = test_app.get(url + '?limit=0', expect_errors=True)
+    assert bad.status_code == 400
+
+
 def test_add_idea_in_synthesis(
         discussion, test_app, test_session, subidea_1_1):
     synthesis = discussion.next_synthesis
@@ -72,3 +72,18 @@ def test_mutation_add_extract_comment_reply(admin_user, graphql_request, idea_in
 
     assert res.data['createPost']['post']['parentExtractId'] == extract_id
     assert res.data['createPost']['post']['parentId'] == comment_id
+
+
+def test_loaders_batch_related_rows(graphql_request, root_post_1, reply_post_1):
+    from assembl.graphql.loaders import get_loaders
+    loaders = get_loaders(graphql_request)
+    assert get_loaders(graphql_request) is loaders
+    counts = loaders.sentiment_counts.load_many(
+        [root_post_1.id, reply_post_1.id]).get()
+    assert [c['like'] for c in counts] == [0, 0]
+    creators = loaders.agent_profiles.load_many(
+        [root_post_1.creator_id, reply_post_1.creator_id]).get()
+    assert creators == [root_post_1.creator, reply_post_1.creator]
+    assert loaders.post_creator_ids.load(
+        reply_post_1.id).get() == reply_post_1.creator_id
+    assert loaders.extracts.load(root_post_1.id).get() == ()
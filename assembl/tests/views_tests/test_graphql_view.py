@@ -81,3 +81,159 @@ def test_graphql_cors_option_request(discussion, test_webrequest, admin_user, te
 
     discussion.preferences['graphql_valid_cors'] = old_pref
     test_session.flush()
+
+
+def test_graphql_document_cache(graphql_registry):
+    from assembl.graphql.documents import DocumentCache
+    from assembl.graphql.schema import Schema
+    cache = DocumentCache(Schema, max_entries=1)
+    query = graphql_registry['userQuery']
+    (document, errors) = cache.get(query)
+    assert not errors
+    assert cache.get(query)[0] is document
+    (_, errors) = cache.get(u'query Invalid { noSuchField }')
+    assert errors
+    # The least recently used document was dropped
+    assert cache.get(query)[0] is not document
+    (_, errors) = cache.get(u'query {')
+    assert errors
+
+
+def test_graphql_persisted_query(discussion, test_app, test_webrequest, admin_user, graphql_registry):
+    from assembl.views import create_get_route
+    from assembl.graphql import documents
+    get_route = create_get_route(test_webrequest, discussion)
+    route = get_route('graphql')
+    query = graphql_registry['userQuery']
+    key = documents.query_hash(query)
+    old_registry = documents._registry
+    documents._registry = {key: query}
+    try:
+        parameters = {
+            "extensions": {"persistedQuery": {"version": 1, "sha256Hash": key}},
+            "variables": {
+                "id": admin_user.graphene_id()
+            }
+        }
+        resp = test_app.post(
+            route,
+            xhr=True,
+            content_type='application/json',
+            params=json.dumps(parameters)
+        )
+        assert resp.status_code == 200
+        body = json.loads(resp.body)
+        user_id = int(Node.from_global_id(body['data']['user']['id'])[1])
+        assert user_id == admin_user.id
+
+        parameters = {"id": "unknown", "variables": {}}
+        resp = test_app.post(
+            route,
+            xhr=True,
+            content_type='application/json',
+            params=json.dumps(parameters),
+            expect_errors=True
+        )
+        assert resp.status_code == 400
+        body = json.loads(resp.body)
+        assert body['errors'][0]['message'] == 'PersistedQueryNotFound'
+    finally:
+        documents._registry = old_registry
+
+
+def test_graphql_bad_json_request(discussion, test_app, test_webrequest, admin_user, graphql_registry):
+    from assembl.views import create_get_route
+    get_route = create_get_route(test_webrequest, discussion)
+    route = get_route('graphql')
+    query = graphql_registry['userQuery']
+    for body in ('{"query": ', json.dumps([query]),
+                 json.dumps({"query": query, "variables": '{"id": '}),
+                 json.dumps({"query": query, "variables": [1]})):
+        resp = test_app.post(
+            route,
+            xhr=True,
+            content_type='application/json',
+            params=body,
+            expect_errors=True
+        )
+        assert resp.status_code == 400
+        assert json.loads(resp.body)['errors']
+
+
+def test_graphql_profile_extension(discussion, test_app, test_webrequest, admin_user, graphql_registry, monkeypatch):
+    from assembl.views import create_get_route
+    from assembl.lib.config import get_config
+    monkeypatch.setitem(get_config(), 'graphql_profiling', 'true')
+    monkeypatch.setitem(get_config(), 'graphql_profiling_in_response', 'true')
+    get_route = create_get_route(test_webrequest, discussion)
+    route = get_route('graphql')
+    parameters = {
+        "query": graphql_registry['userQuery'],
+        "variables": {
+            "id": admin_user.graphene_id()
+        }
+    }
+    resp = test_app.post(
+        route,
+        xhr=True,
+        content_type='application/json',
+        params=json.dumps(parameters)
+    )
+    assert resp.status_code == 200
+    profile = json.loads(resp.body)['extensions']['profile']
+    assert profile['operation'] == 'User'
+    fields = {stats['field']: stats for stats in profile['fields']}
+    assert fields['Query.node']['calls'] == 1
+    assert fields['AgentProfile.name']['calls'] == 1
+    assert profile['sql_count'] == sum(
+        stats['sql_count'] for stats in profile['fields'])
+
+
+def test_graphql_cost_estimator():
+    from graphql import parse
+    from assembl.graphql.cost import CONNECTION_SIZE, CostEstimator
+    from assembl.graphql.schema import Schema
+    query = u"""query Posts($id: ID!, $first: Int) {
+      idea: node(id: $id) {
+        ... on Idea {
+          numPosts
+          posts(first: $first) { edges { node { ... on Post { id creator { name } } } } }
+        }
+      }
+    }"""
+    document = parse(query)
+    # node, numPosts, posts, then edges, node and creator for each post
+    (cost, depth) = CostEstimator(Schema, document, {'first': 5}).estimate()
+    assert cost == 1 + 2 + 1 + 5 * 3
+    assert depth == 6
+    (cost, _) = CostEstimator(Schema, document, {}).estimate()
+    assert cost == 1 + 2 + 1 + CONNECTION_SIZE * 3
+
+
+def test_graphql_cost_limits(discussion, test_app, test_webrequest, admin_user, test_session, graphql_registry):
+    from assembl.auth import R_SYSADMIN
+    from assembl.views import create_get_route
+    get_route = create_get_route(test_webrequest, discussion)
+    route = get_route('graphql')
+    discussion.preferences['graphql_max_depth'] = {R_SYSADMIN: 1}
+    test_session.flush()
+    parameters = {
+        "query": graphql_registry['userQuery'],
+        "variables": {
+            "id": admin_user.graphene_id()
+        }
+    }
+    try:
+        resp = test_app.post(
+            route,
+            xhr=True,
+            content_type='application/json',
+            params=json.dumps(parameters),
+            expect_errors=True
+        )
+        assert resp.status_code == 400
+        body = json.loads(resp.body)
+        assert 'over the limit of 1' in body['errors'][0]['message']
+    finally:
+        discussion.preferences['graphql_max_depth'] = {}
+        test_session.flush()
@@ -91,11 +91,9 @@ def get_descendants(ideas):
     if not ideas:
         return []
 
-    descendants = []
-    for idea in ideas:
-        descendants.extend(idea.get_all_descendants(id_only=True, inclusive=True))
-
-    return descendants
+    query = models.Idea.get_descendants_query_cls(
+        [idea.id for idea in ideas], inclusive=True)
+    return [id for (id,) in ideas[0].db.query(query)]
 
 
 def get_multicolumns_ideas(discussion, start=None, end=None):
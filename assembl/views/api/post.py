@@ -1,6 +1,7 @@
 """Cornice API for posts"""
 from math import ceil
-from collections import defaultdict
+from collections import Counter, defaultdict
+from itertools import chain
 
 import simplejson as json
 from cornice import Service
@@ -10,11 +11,11 @@ from pyramid.i18n import TranslationStringFactory
 from pyramid.settings import asbool
 from pyramid.security import Everyone
 
-from sqlalchemy import String, text
+from sqlalchemy import String, text, func
 
 from sqlalchemy.orm import (
     joinedload_all, aliased, subqueryload_all, undefer)
-from sqlalchemy.sql.expression import bindparam, and_
+from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.sql import cast, column
 from sqlalchemy.sql.functions import count
 
@@ -35,8 +36,12 @@ from assembl.models import (
     get_database_id, Post, AssemblPost, SynthesisPost,
     Synthesis, Discussion, Content, Idea, ViewPost, User,
     IdeaRelatedPostLink, AgentProfile, LangString,
-    DummyContext, LanguagePreferenceCollection, SentimentOfPost)
-from assembl.models.post import deleted_publication_states
+    DummyContext, LanguagePreferenceCollection, SentimentOfPost,
+    UserReadPosts)
+from assembl.models.post import (
+    deleted_publication_states, countable_publication_states)
+from assembl.models.read_posts import (
+    mark_post_read as mark_read, mark_post_unread as mark_unread)
 from assembl.lib.sentry import capture_message
 
 log = logging.getLogger()
@@ -71,6 +76,8 @@ def get_posts(request):
     posted_after_date, posted_before_date: date selection (ISO format)
     post_author: filter by author
     classifier: filter on message_classifier, or absence thereof (classifier=null). Can be negated with "!"
+    page, page_size: paginate by top-level thread; each page holds whole threads.
+    Without those parameters, all posts are returned.
     """
     localizer = request.localizer
     discussion_id = int(request.matchdict['discussion_id'])
@@ -85,7 +92,13 @@ def get_posts(request):
     permissions = get_permissions(user_id, discussion_id)
 
     DEFAULT_PAGE_SIZE = 25
-    page_size = DEFAULT_PAGE_SIZE
+    paginate = 'page' in request.GET or 'page_size' in request.GET
+    try:
+        page_size = int(request.GET.getone('page_size'))
+    except (ValueError, KeyError):
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size < 1:
+        page_size = DEFAULT_PAGE_SIZE
 
     filter_names = [
         filter_name for filter_name
@@ -325,26 +338,20 @@ def get_posts(request):
     if user_id != Everyone:
         # This is horrible, but the join creates complex subqueries that
         # virtuoso cannot decode properly.
-        read_posts = {v.post_id for v in discussion.db.query(
-            ViewPost).filter(
-                ViewPost.tombstone_condition(),
-                ViewPost.actor_id == user_id,
-                *ViewPost.get_discussion_conditions(discussion_id))}
+        read_posts = set(UserReadPosts.all_post_ids(
+            discussion.db, discussion_id, user_id))
         my_sentiments = {l.post_id: l for l in discussion.db.query(
             SentimentOfPost).filter(
                 SentimentOfPost.tombstone_condition(),
                 SentimentOfPost.actor_id == user_id,
                 *SentimentOfPost.get_discussion_conditions(discussion_id))}
+        is_read = UserReadPosts.is_read_clause(
+            discussion.db, discussion_id, user_id, PostClass.id)
         if is_unread != None:
-            posts = posts.outerjoin(
-                ViewPost, and_(
-                    ViewPost.actor_id==user_id,
-                    ViewPost.post_id==PostClass.id,
-                    ViewPost.tombstone_date == None))
             if is_unread == "true":
-                posts = posts.filter(ViewPost.id == None)
+                posts = posts.filter(~is_read)
             elif is_unread == "false":
-                posts = posts.filter(ViewPost.id != None)
+                posts = posts.filter(is_read)
         user = AgentProfile.get(user_id)
         service = discussion.translation_service()
         if service.canTranslate is not None:
@@ -363,6 +370,30 @@ def get_posts(request):
         posts = posts.filter(Post.body_text_index.contains(
             text_search.encode('utf-8'), offband=offband))
 
+    if paginate:
+        # Paginate by thread, so threading is not garbled.
+        # Counts are computed on the whole result set.
+        no_of_posts = posts.with_entities(
+            count(PostClass.id.distinct())).scalar()
+        if user_id != Everyone:
+            no_of_posts_viewed_by_user = posts.filter(is_read).with_entities(
+                count(PostClass.id.distinct())).scalar()
+        else:
+            no_of_posts_viewed_by_user = 0
+        thread_root_id = Post.thread_root_id_clause(PostClass)
+        if order == 'chronological':
+            thread_order = func.min(PostClass.creation_date)
+        else:
+            # most recently active threads first
+            thread_order = func.max(PostClass.creation_date).desc()
+        threads = posts.with_entities(thread_root_id).group_by(
+            thread_root_id)
+        no_of_threads = threads.count()
+        page_thread_ids = [root_id for (root_id,) in threads.order_by(
+            thread_order, thread_root_id).limit(page_size).offset(
+            (page - 1) * page_size)]
+        posts = posts.filter(thread_root_id.in_(page_thread_ids))
+
     # posts = posts.options(contains_eager(Post.source))
     # Horrible hack... But useful for structure load
     if view_def == 'id_only':
@@ -410,8 +441,9 @@ def get_posts(request):
         posts = posts.order_by(Content.id)
     # print str(posts)
 
-    no_of_posts = 0
-    no_of_posts_viewed_by_user = 0
+    if not paginate:
+        no_of_posts = 0
+        no_of_posts_viewed_by_user = 0
 
     if deleted is True:
         # We just got deleted posts, now we want their ancestors for context
@@ -460,7 +492,8 @@ def get_posts(request):
             if view_def != "id_only":
                 translate_content(
                     post, translation_table=translations, service=service)
-        no_of_posts += 1
+        if not paginate:
+            no_of_posts += 1
         serializable_post = post.generic_json(
             view_def, user_id, permissions) or {}
         if order == 'score':
@@ -469,14 +502,11 @@ def get_posts(request):
 
         if viewpost:
             serializable_post['read'] = True
-            no_of_posts_viewed_by_user += 1
+            if not paginate:
+                no_of_posts_viewed_by_user += 1
         elif user_id != Everyone and root_post is not None and root_post.id == post.id:
             # Mark post read, we requested it explicitely
-            viewed_post = ViewPost(
-                actor_id=user_id,
-                post=root_post
-                )
-            discussion.db.add(viewed_post)
+            mark_read(discussion.db, discussion_id, root_post, user_id)
             serializable_post['read'] = True
         else:
             serializable_post['read'] = False
@@ -492,29 +522,21 @@ def get_posts(request):
 
         post_data.append(serializable_post)
 
-    # Benoitg:  For now, this completely garbles threading without intelligent
-    #handling of pagination.  Disabling
-    #posts = posts.limit(page_size).offset(data['startIndex']-1)
-    # This code isn't up to date.  If limiting the query by page, we need to
-    # calculate the counts with a separate query to have the right number of
-    # results
-    #no_of_messages_viewed_by_user = discussion.db.query(ViewPost).join(
-    #    Post
-    #).filter(
-    #    Post.discussion_id == discussion_id,
-    #    ViewPost.actor_id == user_id,
-    #).count() if user_id else 0
-
     data = {}
     data["page"] = page
     data["unread"] = no_of_posts - no_of_posts_viewed_by_user
     data["total"] = no_of_posts
-    data["maxPage"] = max(1, ceil(float(data["total"])/page_size))
+    # When paginating, pages and indices count threads, not posts.
+    no_of_items = no_of_threads if paginate else no_of_posts
+    if paginate:
+        data["threads"] = no_of_threads
+        data["pageSize"] = page_size
+    data["maxPage"] = max(1, ceil(float(no_of_items)/page_size))
     #TODO:  Check if we want 1 based index in the api
     data["startIndex"] = (page_size * page) - (page_size-1)
 
     if data["page"] == data["maxPage"]:
-        data["endIndex"] = data["total"]
+        data["endIndex"] = no_of_items
     else:
         data["endIndex"] = data["startIndex"] + (page_size-1)
     data["posts"] = post_data
@@ -553,25 +575,26 @@ def mark_post_read(request):
     read_data = json.loads(request.body)
     db = discussion.db
     change = False
+    read = read_data.get('read', None) is not False
     with transaction.manager:
-        if read_data.get('read', None) is False:
-            view = db.query(ViewPost).filter_by(
-                post_id=post_id, actor_id=user_id,
-                tombstone_date=None).first()
-            if view:
-                change = True
-                view.is_tombstone = True
+        if read:
+            change = mark_read(db, discussion_id, post, user_id)
         else:
-            count = db.query(ViewPost).filter_by(
-                post_id=post_id, actor_id=user_id,
-                tombstone_date=None).count()
-            if not count:
-                change = True
-                db.add(ViewPost(post=post, actor_id=user_id))
+            change = mark_unread(db, discussion_id, post_id, user_id)
 
     new_counts = []
     if change:
         new_counts = Idea.idea_read_counts(discussion_id, post_id, user_id)
+        pending = UserReadPosts.pending_post_ids(discussion_id, user_id)
+        if pending:
+            # Buffered reads are not counted yet
+            counted = [id for (id,) in db.query(Post.id).filter(
+                Post.id.in_(pending), Post.hidden == False,  # noqa: E712
+                Post.publication_state.in_(countable_publication_states))]
+            pending_by_idea = Counter(chain(
+                *Idea.get_idea_ids_showing_posts(counted).values()))
+            new_counts = [(idea_id, read_posts + pending_by_idea[idea_id])
+                          for (idea_id, read_posts) in new_counts]
 
     return { "ok": True, "ideas": [
         {"@id": Idea.uri_generic(idea_id),
@@ -40,6 +40,7 @@ import os
 import datetime
 import inspect as pyinspect
 
+import transaction
 
 from sqlalchemy import inspect
 from pyramid.view import view_config
@@ -68,6 +69,7 @@ API_PREFIX = '/data/'
 FORM_HEADER = "Content-Type:(application/x-www-form-urlencoded)|(multipart/form-data)"
 JSON_HEADER = "Content-Type:application/(.*\+)?json"
 MULTIPART_HEADER = "Content-Type:multipart/form-data"
+STREAM_BATCH_SIZE = 500
 
 
 def check_permissions(
@@ -90,6 +92,116 @@ class CreationResponse(Response):
             location=uri, status_code=201)
 
 
+def parse_pagination(request, cls):
+    """Read the keyset pagination parameters of a collection request.
+
+    ``after`` is the id (or URI) of the last instance already seen,
+    ``limit`` the maximum number of instances to return."""
+    after = request.GET.get('after', None)
+    limit = request.GET.get('limit', None)
+    if after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            after = cls.get_database_id(after)
+            if after is None:
+                raise HTTPBadRequest("Invalid after parameter")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            raise HTTPBadRequest("limit should be a positive integer")
+    return after, limit
+
+
+def keyset_page(query, alias, after=None, limit=None):
+    """Restrict a query ordered by id to the rows after a given id."""
+    query = query.order_by(alias.id)
+    if after is not None:
+        query = query.filter(alias.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def stream_collection(query, alias, to_json, after=None, limit=None,
+                      batch_size=STREAM_BATCH_SIZE, id_only=False):
+    """Generate a JSON array, element by element, from a query.
+
+    Identifiers come from a server-side cursor. Full instances are
+    fetched in keyset batches instead, as eager loading of collections
+    cannot be combined with yield_per."""
+    yield '['
+    count = 0
+    try:
+        if id_only:
+            rows = keyset_page(query, alias, after, limit).yield_per(
+                batch_size)
+        else:
+            rows = _keyset_batches(query, alias, batch_size, after, limit)
+        for row in rows:
+            json = to_json(row)
+            if json is None:
+                continue
+            yield (',' if count else '') + dumps(json)
+            count += 1
+    finally:
+        # The request transaction is over when the body is iterated.
+        transaction.abort()
+    yield ']'
+
+
+def _keyset_batches(query, alias, batch_size, after=None, limit=None):
+    last_id = after
+    while limit is None or limit > 0:
+        size = batch_size if limit is None else min(batch_size, limit)
+        batch = keyset_page(query, alias, last_id, size).all()
+        for instance in batch:
+            yield instance
+        if len(batch) < size:
+            break
+        last_id = batch[-1].id
+        if limit is not None:
+            limit -= size
+
+
+def collection_results(request, query, view, user_id, permissions):
+    """Serialize the results of a class or collection query.
+
+    Supports keyset pagination (``after`` and ``limit``), with a ``Link``
+    header to the next page, and streaming of the JSON array
+    (``stream=true``) for large collections."""
+    ctx = request.context
+    cls = ctx.get_target_class()
+    alias = ctx.get_target_alias()
+    id_only = view == 'id_only'
+    after, limit = parse_pagination(request, cls)
+    if id_only:
+        def to_json(row):
+            return cls.uri_generic(row[0])
+    else:
+        def to_json(instance):
+            return instance.generic_json(view, user_id, permissions)
+    if asbool(request.GET.get('stream', False)):
+        return Response(
+            app_iter=stream_collection(
+                query, alias, to_json, after, limit, id_only=id_only),
+            content_type='application/json', charset='utf-8')
+    if after is None and limit is None:
+        rows = query.all()
+    else:
+        rows = keyset_page(query, alias, after, limit).all()
+        if limit is not None and len(rows) == limit:
+            last_id = rows[-1][0] if id_only else rows[-1].id
+            request.response.headers['Link'] = '<%s>; rel="next"' % (
+                request.current_route_url(_query=dict(
+                    request.GET, after=last_id, limit=limit)),)
+    results = [to_json(row) for row in rows]
+    return [x for x in results if x is not None]
+
+
 @view_config(context=ClassContext, renderer='json',
              request_method='GET', permission=P_READ)
 def class_view(request):
@@ -100,16 +212,12 @@ def class_view(request):
     check = check_permissions(ctx, user_id, permissions, CrudPermissions.READ)
     view = request.GET.get('view', None) or ctx.get_default_view() or 'id_only'
     tombstones = asbool(request.GET.get('tombstones', False))
-    q = ctx.create_query(view == 'id_only', tombstones)
+    q = ctx.create_query(view == 'id_only', tombstones, view)
     if check == IF_OWNED:
         if user_id == Everyone:
             raise HTTPUnauthorized()
         q = ctx.get_target_class().restrict_to_owners(q, user_id)
-    if view == 'id_only':
-        return [ctx._class.uri_generic(x) for (x,) in q.all()]
-    else:
-        r = [i.generic_json(view, user_id, permissions) for i in q.all()]
-        return [x for x in r if x is not None]
+    return collection_results(request, q, view, user_id, permissions)
 
 
 @view_config(context=InstanceContext, renderer='json',
@@ -138,16 +246,12 @@ def collection_view(request, default_view='default'):
     check = check_permissions(ctx, user_id, permissions, CrudPermissions.READ)
     view = request.GET.get('view', None) or ctx.get_default_view() or default_view
     tombstones = asbool(request.GET.get('tombstones', False))
-    q = ctx.create_query(view == 'id_only', tombstones)
+    q = ctx.create_query(view == 'id_only', tombstones, view)
     if check == IF_OWNED:
         if user_id == Everyone:
             raise HTTPUnauthorized()
         q = ctx.get_target_class().restrict_to_owners(q, user_id)
-    if view == 'id_only':
-        return [ctx.collection_class.uri_generic(x) for (x,) in q.all()]
-    else:
-        res = [i.generic_json(view, user_id, permissions) for i in q.all()]
-        return [x for x in res if x is not None]
+    return collection_results(request, q, view, user_id, permissions)
 
 
 def collection_add(request, args):
@@ -549,6 +549,8 @@ def extract_taxonomy_csv(request):
     tags_names = ["Tag{}".format(index + 1) for index in range(len_tags)]
     fieldnames.extend(tags_names)
     user_info_by_id = {}
+    idea_ids_by_post = m.Idea.get_idea_ids_showing_posts(
+        list({extract.content_id for extract in extracts}))
     for extract in extracts:
         if extract.idea_id:
             thematic = db.query(m.Idea).get(extract.idea_id)
@@ -579,7 +581,7 @@ def extract_taxonomy_csv(request):
             message = "no message"
 
         if thematic == no_thematic_associated:
-            idea_ids = m.Idea.get_idea_ids_showing_post(content.id)
+            idea_ids = idea_ids_by_post.get(content.id, [])
             for thematic_id in reversed(idea_ids):
                 thematic_title = db.query(m.Idea).get(thematic_id).title
                 if thematic_title:
@@ -217,7 +217,11 @@ class ClassContext(TraversalContext):
             return my_default
         return self.__parent__.get_default_view()
 
-    def create_query(self, id_only=True, tombstones=False):
+    def create_query(self, id_only=True, tombstones=False, view_def=None):
+        """Create the query for this class.
+
+        If a view_def is given, relationships it will traverse are
+        loaded eagerly."""
         from assembl.models import TombstonableMixin
         cls = self._class
         alias = self.class_alias
@@ -225,6 +229,9 @@ class ClassContext(TraversalContext):
             query = self._class.default_db.query(alias.id)
         else:
             query = self._class.default_db.query(alias)
+            if view_def:
+                query = query.options(
+                    *cls.eager_loading_options(view_def, alias))
         # TODO: Distinguish tombstone condition from other base_conditions
         if issubclass(cls, TombstonableMixin) and not tombstones:
             query = query.filter(and_(*cls.base_conditions(alias)))
@@ -475,7 +482,11 @@ class CollectionContext(TraversalContext):
     def get_target_alias(self):
         return self.class_alias
 
-    def create_query(self, id_only=True, tombstones=False):
+    def create_query(self, id_only=True, tombstones=False, view_def=None):
+        """Create the query for this collection.
+
+        If a view_def is given, relationships it will traverse are
+        loaded eagerly."""
         alias = self.class_alias
         if id_only:
             query = self.parent_instance.db.query(alias.id)
@@ -486,6 +497,10 @@ class CollectionContext(TraversalContext):
             # and a distinct subquery takes forever.
             # Oh, and quietcast loses the distinct. Just great.
             query = self.parent_instance.db.query(alias)
+            if view_def:
+                query = query.options(
+                    *self.collection_class.eager_loading_options(
+                        view_def, alias))
             return self.decorate_query(query, self, tombstones)
 
     def decorate_query(self, query, ctx, tombstones=False):
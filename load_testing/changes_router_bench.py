@@ -0,0 +1,113 @@
+"""Open many websocket connections on the changes router, and measure
+how long they take to be accepted and how many changesets they receive.
+
+Runs in the assembl virtualenv, which has tornado. Example:
+
+    python load_testing/changes_router_bench.py -n 2000 -d 60 \\
+        --discussion 1 --token "$TOKEN" ws://localhost:8090/socket
+
+The token can be obtained from /api/v1/token when logged in.
+Do not forget to raise the open files limit (ulimit -n)."""
+from __future__ import print_function
+import argparse
+import json
+import time
+from datetime import timedelta
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+
+class Stats(object):
+    def __init__(self):
+        self.connect_times = []
+        self.ready_times = []
+        self.failures = 0
+        self.closed = 0
+        self.frames = 0
+        self.changes = 0
+
+    def report(self, duration):
+        def percentiles(values):
+            if not values:
+                return "n/a"
+            values = sorted(values)
+            return " ".join(
+                "p%d=%.1fms" % (p, 1000 * values[
+                    min(len(values) - 1, len(values) * p // 100)])
+                for p in (50, 90, 99, 100))
+        print("connections: %d ok, %d failed, %d closed early" % (
+            len(self.connect_times), self.failures, self.closed))
+        print("connect:", percentiles(self.connect_times))
+        print("subscribed:", percentiles(self.ready_times))
+        print("received %d frames, %d changes (%.1f changes/s)" % (
+            self.frames, self.changes, self.changes / float(duration)))
+
+
+@gen.coroutine
+def client(url, token, discussion, stats, deadline):
+    start = time.time()
+    try:
+        conn = yield websocket_connect(url)
+    except Exception:
+        stats.failures += 1
+        return
+    stats.connect_times.append(time.time() - start)
+    conn.write_message("token:" + token)
+    conn.write_message("discussion:" + discussion)
+    ready = False
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            # A number would be an absolute IOLoop.time() deadline
+            msg = yield gen.with_timeout(
+                timedelta(seconds=remaining), conn.read_message(),
+                quiet_exceptions=(Exception,))
+        except gen.TimeoutError:
+            break
+        if msg is None:
+            stats.closed += 1
+            return
+        data = json.loads(msg)
+        if not ready:
+            if data and data[0].get('@type') == 'Connection':
+                stats.ready_times.append(time.time() - start)
+                ready = True
+            continue
+        stats.frames += 1
+        stats.changes += len([
+            x for x in data if x.get('@type') != 'Sequence'])
+    conn.close()
+
+
+@gen.coroutine
+def main(args):
+    url = args.url.rstrip('/') + '/websocket'
+    stats = Stats()
+    deadline = time.time() + args.duration
+    clients = []
+    for i in range(args.connections):
+        clients.append(client(
+            url, args.token, args.discussion, stats, deadline))
+        if args.ramp and i % args.ramp == args.ramp - 1:
+            yield gen.sleep(0.1)
+    yield clients
+    stats.report(args.duration)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', help="changes router prefix, "
+                        "eg ws://localhost:8090/socket")
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--discussion', required=True)
+    parser.add_argument('-n', '--connections', type=int, default=1000)
+    parser.add_argument('-d', '--duration', type=int, default=30,
+                        help="seconds")
+    parser.add_argument('--ramp', type=int, default=100,
+                        help="open that many connections per 100ms, "
+                        "0 for all at once")
+    IOLoop.current().run_sync(lambda: main(parser.parse_args()))